@@ -44,6 +44,8 @@ def layers2scene(global_info, layer_info_list):
             print("No web scene created.")
     except:
         raise Exception("Error in layers2scene!")
+    finally:
+        A3D_common_lib.metadata_cache.report()
 
 
 def auto2D_3D(gis_org,
@@ -53,7 +55,8 @@ def auto2D_3D(gis_org,
               units,
               scene_service_item_id,
               fixed_layer_id,
-              offset):
+              offset,
+              dtm_raster=None):
     '''
         takes the layers from a webmap or feature layer collection and adds them to a scene.
         Layer rendering is  modified in the web scene definition to improve 3D visualization.
@@ -87,6 +90,7 @@ def auto2D_3D(gis_org,
         :param fixed_layer_id: the layer id of the tree/sign layer in the web scene. If 'create_layer_id', it will be
          created.
         :param offset: layer offset
+        :param dtm_raster: elevation raster for street signs the elevation service can't sample
         :return: True or False
     '''
 
@@ -97,6 +101,7 @@ def auto2D_3D(gis_org,
             global_info.scene_service_item_id = scene_service_item_id
             global_info.web_scene_layer_id = fixed_layer_id
             global_info.layer_offset = float(offset)
+            global_info.dtm_raster = dtm_raster
 
             try:
                 input_item = gis_org.content.get(str(global_info.input_item_id))
@@ -1,10 +1,16 @@
 # A3D common functions and classes
 import arcpy
 import datetime
+import functools
+import hashlib
 import json
 import numpy as np
+import pandas as pd
+import random
+import time
 import urllib.request
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from arcgis.features import FeatureLayer
 from arcgis.geometry import Geometry
@@ -34,6 +40,8 @@ class GlobalInfo(object):
         self.org_portal_url = None
         self.web_scene_layer_id = None
         self.layer_offset = 0
+        # local elevation raster for points the elevation service can't sample
+        self.dtm_raster = None
 
 
 class ItemInfo(object):
@@ -76,8 +84,9 @@ class LayerInfo(object):
 
 class SpatialInfo(object):
     def __init__(self):
-        self.fs_df = None
-        self.fs_dict = None
+        self.table = None
+        self._fs_df = None
+        self._fs_dict = None
         self.has_z = None
         self.wkid = None
         self.linear_unit = None
@@ -85,6 +94,263 @@ class SpatialInfo(object):
         self.url = None
         self.service_url = None
 
+    # fs_df and fs_dict are only built from the columnar table when a caller asks for them
+    @property
+    def fs_df(self):
+        if self._fs_df is None and self.table is not None:
+            self._fs_df = self.table.to_sdf()
+        return self._fs_df
+
+    @fs_df.setter
+    def fs_df(self, value):
+        self._fs_df = value
+
+    @property
+    def fs_dict(self):
+        if self._fs_dict is None and self.table is not None:
+            self._fs_dict = self.table.to_dict()
+        return self._fs_dict
+
+    @fs_dict.setter
+    def fs_dict(self, value):
+        self._fs_dict = value
+
+    def to_table(self):
+        '''
+            columnar table of the features, rebuilt from fs_dict when that has been read or replaced
+        '''
+        if self._fs_dict is not None:
+            self.table = FeatureTable.from_featureset_dict(self._fs_dict)
+            self._fs_dict = None
+            self._fs_df = None
+        return self.table
+
+    def features_json(self):
+        '''
+            features to upload: json strings written from the table, or the dictionaries while fs_dict is in use
+        '''
+        if self._fs_dict is None and self.table is not None:
+            return self.table.features_json()
+        return self.fs_dict.get('features')
+
+
+class FeatureTable(object):
+    '''
+        columnar feature set: attributes in a DataFrame and geometry as flat coordinate arrays
+        vertices of part p are coords[part_offsets[p]:part_offsets[p + 1]]
+        parts of feature f are part_offsets[feature_offsets[f]:feature_offsets[f + 1]]
+        points have one part with one vertex, empty geometries have no parts
+    '''
+    GEOMETRY_PARTS_KEY = {'esriGeometryPolygon': 'rings', 'esriGeometryPolyline': 'paths',
+                          'esriGeometryMultipoint': 'points'}
+    INTEGER_FIELD_TYPES = ('esriFieldTypeOID', 'esriFieldTypeInteger', 'esriFieldTypeSmallInteger',
+                           'esriFieldTypeBigInteger')
+
+    def __init__(self):
+        self.fields = list()
+        self.attributes = pd.DataFrame()
+        self.geometry_type = None
+        self.spatial_reference = None
+        self.object_id_field_name = None
+        self.has_z = False
+        self.has_m = False
+        self.coords = np.empty((0, 2))
+        self.part_offsets = np.zeros(1, dtype=np.int64)
+        self.feature_offsets = np.zeros(1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.feature_offsets) - 1
+
+    @property
+    def dims(self):
+        return 2 + self.has_z + self.has_m
+
+    @classmethod
+    def from_featureset_dict(cls, fs_dict):
+        table = cls()
+        table.fields = fs_dict.get('fields', list())
+        table.geometry_type = fs_dict.get('geometryType')
+        table.spatial_reference = fs_dict.get('spatialReference')
+        table.object_id_field_name = fs_dict.get('objectIdFieldName')
+        table.has_z = bool(fs_dict.get('hasZ', False))
+        table.has_m = bool(fs_dict.get('hasM', False))
+
+        features = fs_dict.get('features', list())
+        table.attributes = pd.DataFrame.from_records([f.get('attributes', dict()) for f in features],
+                                                     columns=[f.get('name') for f in table.fields] or None)
+
+        # integer columns with nulls would become float (5 -> 5.0), keep them as nullable integers
+        for field in table.fields:
+            if field.get('type') in cls.INTEGER_FIELD_TYPES and field.get('name') in table.attributes:
+                table.attributes[field.get('name')] = table.attributes[field.get('name')].astype('Int64')
+
+        # x, y, then z and m when the layer has them
+        dims = table.dims
+        parts_key = cls.GEOMETRY_PARTS_KEY.get(table.geometry_type)
+        coords = list()
+        part_lengths = list()
+        feature_parts = list()
+
+        for feature in features:
+            geometry = feature.get('geometry') or dict()
+            if parts_key:
+                parts = geometry.get(parts_key) or list()
+                if parts_key == 'points':
+                    parts = [parts] if parts else list()
+            elif 'x' in geometry and geometry.get('x') is not None:
+                vertex = [geometry.get('x'), geometry.get('y')]
+                if table.has_z:
+                    vertex.append(geometry.get('z', 0))
+                if table.has_m:
+                    vertex.append(geometry.get('m'))
+                parts = [[vertex]]
+            else:
+                parts = list()
+
+            for part in parts:
+                coords.extend((list(v[:dims]) + [0] * (dims - len(v)))[:dims] for v in part)
+                part_lengths.append(len(part))
+            feature_parts.append(len(parts))
+
+        table.coords = np.array(coords, dtype=np.float64).reshape(-1, dims)
+        table.part_offsets = np.concatenate(([0], np.cumsum(part_lengths, dtype=np.int64)))
+        table.feature_offsets = np.concatenate(([0], np.cumsum(feature_parts, dtype=np.int64)))
+        return table
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [t for t in tables if t is not None]
+        if not tables:
+            return cls()
+
+        table = cls()
+        first = tables[0]
+        table.fields = first.fields
+        table.geometry_type = first.geometry_type
+        table.spatial_reference = first.spatial_reference
+        table.object_id_field_name = first.object_id_field_name
+        table.has_z = first.has_z
+        table.has_m = first.has_m
+        table.attributes = pd.concat([t.attributes for t in tables], ignore_index=True)
+        table.coords = np.concatenate([t.coords for t in tables])
+
+        # shift the offsets of each table by the vertices / parts of the tables before it
+        vertex_shift = np.cumsum([0] + [len(t.coords) for t in tables[:-1]])
+        part_shift = np.cumsum([0] + [len(t.part_offsets) - 1 for t in tables[:-1]])
+        table.part_offsets = np.concatenate([[0]] + [t.part_offsets[1:] + v for t, v in zip(tables, vertex_shift)])
+        table.feature_offsets = np.concatenate([[0]] + [t.feature_offsets[1:] + p
+                                                        for t, p in zip(tables, part_shift)])
+        return table
+
+    def geometry(self, index):
+        '''
+            returns the esri json geometry of feature index
+        '''
+        parts = [self.coords[self.part_offsets[p]:self.part_offsets[p + 1]].tolist()
+                 for p in range(self.feature_offsets[index], self.feature_offsets[index + 1])]
+
+        parts_key = self.GEOMETRY_PARTS_KEY.get(self.geometry_type)
+        if parts_key == 'points':
+            geometry = {parts_key: parts[0] if parts else list()}
+        elif parts_key:
+            geometry = {parts_key: parts}
+        elif parts:
+            vertex = parts[0][0]
+            geometry = {'x': vertex[0], 'y': vertex[1]}
+            if self.has_z:
+                geometry['z'] = vertex[2]
+            if self.has_m:
+                geometry['m'] = None if np.isnan(vertex[-1]) else vertex[-1]
+        else:
+            geometry = dict()
+
+        if self.has_z and parts_key:
+            geometry['hasZ'] = True
+        if self.has_m and parts_key:
+            geometry['hasM'] = True
+        if self.spatial_reference:
+            geometry['spatialReference'] = self.spatial_reference
+        return geometry
+
+    def attribute_records(self):
+        for attributes in self.attributes.to_dict('records'):
+            # pandas turns missing values into nan, which is not valid json
+            yield {k: (None if v is pd.NA or isinstance(v, float) and np.isnan(v) else
+                       v.item() if isinstance(v, np.generic) else v) for k, v in attributes.items()}
+
+    def features(self):
+        '''
+            yields the features as esri json dictionaries
+        '''
+        for index, attributes in enumerate(self.attribute_records()):
+            yield {'attributes': attributes, 'geometry': self.geometry(index)}
+
+    def features_json(self):
+        '''
+            yields the features as esri json strings, the geometry text is written from slices of the coordinate
+            array without building or mutating the nested feature dictionaries
+        '''
+        parts_key = self.GEOMETRY_PARTS_KEY.get(self.geometry_type)
+
+        if not parts_key or parts_key == 'points':
+            for feature in self.features():
+                yield json.dumps(feature)
+            return
+
+        # one tolist() for all coordinates, the c encoder then writes each feature's parts
+        coords = self.coords.tolist()
+        encoder = json.JSONEncoder(separators=(',', ':'))
+        part_offsets = self.part_offsets.tolist()
+        feature_offsets = self.feature_offsets.tolist()
+
+        geometry_tail = ''
+        if self.has_z:
+            geometry_tail += ',"hasZ":true'
+        if self.has_m:
+            geometry_tail += ',"hasM":true'
+        if self.spatial_reference:
+            geometry_tail += ',"spatialReference":' + encoder.encode(self.spatial_reference)
+
+        for index, attributes in enumerate(self.attribute_records()):
+            parts = [coords[part_offsets[p]:part_offsets[p + 1]]
+                     for p in range(feature_offsets[index], feature_offsets[index + 1])]
+            yield ('{"attributes":' + encoder.encode(attributes) + ',"geometry":{"' + parts_key + '":' +
+                   encoder.encode(parts) + geometry_tail + '}}')
+
+    def add_z(self, z_values):
+        '''
+            sets the z of every vertex to the value of its feature
+            :param z_values: array with one z value per feature
+        '''
+        vertex_feature = np.repeat(np.repeat(np.arange(len(self)), np.diff(self.feature_offsets)),
+                                   np.diff(self.part_offsets))
+        coords = np.empty((len(self.coords), 3 + self.has_m), dtype=np.float64)
+        coords[:, :2] = self.coords[:, :2]
+        coords[:, 2] = np.asarray(z_values, dtype=np.float64)[vertex_feature]
+        if self.has_m:
+            coords[:, 3] = self.coords[:, -1]
+        self.coords = coords
+        self.has_z = True
+
+    def to_dict(self):
+        return {
+            'objectIdFieldName': self.object_id_field_name,
+            'geometryType': self.geometry_type,
+            'spatialReference': self.spatial_reference,
+            'hasZ': self.has_z,
+            'hasM': self.has_m,
+            'fields': self.fields,
+            'features': list(self.features())
+        }
+
+    def to_sdf(self):
+        from arcgis.features import GeoAccessor  # registers the .spatial accessor
+
+        sdf = self.attributes.copy()
+        sdf['SHAPE'] = [Geometry(self.geometry(i)) for i in range(len(self))]
+        sdf.spatial.set_geometry('SHAPE')
+        return sdf
+
 
 class RelationshipInfo(object):
     def __init__(self):
@@ -107,7 +373,26 @@ def is_number(s):
         pass
 
 
+def get_signin_token(gis=None):
+    '''
+        returns the token of the portal ArcGIS Pro is signed in to
+        when Pro is not signed in, the token of gis (or the active arcgis connection) is used, None without either
+    '''
+    signin = arcpy.GetSigninToken()
+    if signin and signin.get('token'):
+        return signin.get('token')
+
+    if gis is None:
+        from arcgis import env
+        gis = env.active_gis
+
+    return getattr(getattr(gis, '_con', None), 'token', None)
+
+
 def set_global_info(gis, input_item_id, input_web_scene_id, rpk_id):
+    # a new tool run starts with an empty metadata cache, items may have changed since the previous run
+    metadata_cache.invalidate()
+
     global_info = GlobalInfo(gis, input_item_id, input_web_scene_id, rpk_id)
 
     now = datetime.datetime.now()
@@ -121,8 +406,7 @@ def set_global_info(gis, input_item_id, input_web_scene_id, rpk_id):
     global_info.web_scene_description_prefix = "A web scene generated from "
     global_info.unique_tag = None
 
-    global_info.token = arcpy.GetSigninToken().get('token')
-     #global_info.token = gis._con.token
+    global_info.token = get_signin_token(gis)
     global_info.my_username = gis.users.me.username
 
     # create url parameters
@@ -233,49 +517,339 @@ def get_vertex_list_from_feature_sdf(fs_df,  geom_type, has_z):
     return vertex_list
 
 
-def get_spatial_info_from_service_url(url):
+# number of concurrent requests and retries when talking to feature services
+HTTP_POOL_SIZE = 8
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 0.5
+# (connect, read) seconds
+HTTP_TIMEOUT = (10, 120)
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_http_session = None
+
+
+def get_http_session():
+    '''
+        returns a requests session shared by all requests, with a connection pool sized for HTTP_POOL_SIZE
+        concurrent requests and retries on throttling and server errors
+        urllib3 retries failed connections for every method, but only resends idempotent requests that reached the
+        server, posts are retried by post_json where that is safe
+    '''
+    global _http_session
+
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                      status_forcelist=HTTP_RETRY_STATUS)
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_session = session
+
+    return _http_session
+
+
+class ServiceError(RuntimeError):
+    '''
+        json error response of a rest endpoint, returned with http status 200
+    '''
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.code = error.get('code') if isinstance(error, dict) else None
+
+
+def is_transient_error(error):
+    '''
+        True for errors worth sending the same request again: connection problems, timeouts, throttling and
+        server errors, whether reported as http status or as json error code
+    '''
+    import requests
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in HTTP_RETRY_STATUS
+    if isinstance(error, ServiceError):
+        return error.code in HTTP_RETRY_STATUS
+    return False
+
+
+def post_json(url, params, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, timeout=HTTP_TIMEOUT):
+    '''
+        posts params to a rest endpoint and returns the json response
+        transient errors (see is_transient_error) are retried with exponential backoff and jitter, any other error
+        is raised right away
+    '''
+    attempt = 0
+    while True:
+        try:
+            response = get_http_session().post(url, data=params, timeout=timeout)
+            response.raise_for_status()
+            response_json = response.json()
+
+            if isinstance(response_json, dict) and 'error' in response_json:
+                raise ServiceError(response_json.get('error'))
+
+            return response_json
+        except Exception as e:
+            attempt += 1
+            if attempt > retries or not is_transient_error(e):
+                raise
+            time.sleep(backoff * (2 ** (attempt - 1)) * (1 + random.random()))
+
+
+# seconds a cached portal or service metadata response stays valid
+METADATA_CACHE_TTL = 300
+
+
+class MetadataCache(object):
+    '''
+        session scoped cache of portal item, layer and relationship metadata
+        entries expire after ttl seconds and are dropped by invalidate() after publish and update calls
+    '''
+    def __init__(self, ttl=METADATA_CACHE_TTL):
+        import threading
+
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = dict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_key(url, params):
+        # the token itself is not kept in the key, only a hash of it: a user only gets responses of its own requests
+        return url, credential_fingerprint(params.get('token')), \
+            tuple(sorted((k, str(v)) for k, v in params.items() if k != 'token'))
+
+    def get(self, key, fetch, fresh=False):
+        '''
+            returns the cached value of key or stores the result of fetch()
+            a caller asking for a key that is being fetched waits for that fetch instead of sending its own
+            exceptions of fetch are not cached
+            :param fresh: don't return a cached value, a fetch that is running is still joined
+        '''
+        from concurrent.futures import Future
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not fresh and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._pending[key] = Future()
+
+        if pending is not None:
+            return pending.result()
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            # also on KeyboardInterrupt and SystemExit, callers waiting for the pending fetch must not hang
+            with self._lock:
+                self._pending.pop(key).set_exception(e)
+            raise
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._pending.pop(key).set_result(value)
+        return value
+
+    def invalidate(self, match=None):
+        '''
+            drops the entries whose key contains match, all entries when match is None
+        '''
+        with self._lock:
+            if match is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if match in str(k)]:
+                    del self._entries[key]
+
+    def report(self):
+        message = "Metadata cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + \
+                  str(self.hits) + " round-trips avoided."
+        arcpy.AddMessage(message)
+        print(message)
+
+
+metadata_cache = MetadataCache()
+
+
+def credential_fingerprint(token):
+    '''
+        short hash of a token, part of metadata cache keys so cached responses are never shared between sign-ins
+    '''
+    if not token:
+        return None
+    return hashlib.sha256(str(token).encode("utf-8")).hexdigest()[:16]
+
+
+def gis_fingerprint(gis=None):
+    '''
+        portal url and token hash of gis, or of the active arcgis connection, for metadata cache keys
+    '''
+    if gis is None:
+        from arcgis import env
+        gis = env.active_gis
+
+    token = getattr(getattr(gis, '_con', None), 'token', None)
+    return getattr(gis, 'url', None), credential_fingerprint(token) or id(gis)
+
+
+def get_json_cached(url, params):
+    '''
+        posts params with urllib like the other portal calls and caches the response text
+        :return: the json response, parsed again on every call so callers can change it
+    '''
+    def fetch():
+        json_response = urllib.request.urlopen(url, urllib.parse.urlencode(params).encode("utf-8"))
+        return json_response.read()
+
+    key = MetadataCache.request_key(url, params)
+    response = json.loads(metadata_cache.get(key, fetch))
+
+    # don't keep errors around, the next call asks again
+    if isinstance(response, dict) and 'error' in response:
+        metadata_cache.invalidate(url)
+
+    return response
+
+
+def get_feature_layer_properties(url):
+    return metadata_cache.get(('layer_properties', gis_fingerprint(), url), lambda: FeatureLayer(url).properties)
+
+
+def run_concurrently(calls, max_workers=HTTP_POOL_SIZE):
+    '''
+        runs independent lookups side by side
+        :param calls: list of (function, args) tuples
+        :return: list of results in the order of calls, None for calls that raised
+    '''
+    def run(call):
+        try:
+            return call[0](*call[1])
+        except Exception:
+            return None
+
+    if len(calls) < 2:
+        return [run(call) for call in calls]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, calls))
+
+
+def prefetch_layer_properties(urls):
+    '''
+        loads the properties of the feature and map service layers into the metadata cache concurrently
+    '''
+    urls = [url for url in dict.fromkeys(urls) if url and ('FeatureServer' in url or 'MapServer' in url)]
+    run_concurrently([(get_feature_layer_properties, (url,)) for url in urls])
+
+
+def get_object_id_pages(url, token, page_size):
+    '''
+        splits the layer into object id ranges of at most page_size features
+        :return: object id field name, list of (first, last) object ids
+    '''
+    response = post_json(url + "/query", {"where": "1=1", "returnIdsOnly": "true", "f": "json", "token": token})
+    object_id_field_name = response.get('objectIdFieldName')
+    object_ids = np.sort(np.array(response.get('objectIds') or list(), dtype=np.int64))
+
+    pages = list()
+    for start in range(0, len(object_ids), page_size):
+        page = object_ids[start:start + page_size]
+        pages.append((int(page[0]), int(page[-1])))
+
+    return object_id_field_name, pages
+
+
+def download_features_paged(url, token, page_size=None, max_workers=HTTP_POOL_SIZE, return_z=True):
+    '''
+        downloads all features of a feature layer in object id pages, fetched concurrently
+        :param url: feature layer url
+        :param token: login token
+        :param page_size: features per request, defaults to the maxRecordCount of the layer
+        :param max_workers: number of concurrent requests
+        :return: FeatureTable with all features in object id order
+    '''
+    if not page_size:
+        layer_properties = post_json(url, {"f": "json", "token": token})
+        page_size = layer_properties.get('maxRecordCount') or 1000
+
+    object_id_field_name, pages = get_object_id_pages(url, token, page_size)
+
+    def fetch_page(page):
+        query_dict = {
+            "where": "{0} >= {1} AND {0} <= {2}".format(object_id_field_name, page[0], page[1]),
+            "outFields": "*",
+            "returnZ": "true" if return_z else "false",
+            "orderByFields": object_id_field_name,
+            "f": "json",
+            "token": token
+        }
+        return FeatureTable.from_featureset_dict(post_json(url + "/query", query_dict))
+
+    if len(pages) == 0:
+        # still get the schema of the empty layer
+        tables = [fetch_page((0, -1))]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map keeps the page order, and each page is parsed into arrays as soon as it arrives
+            tables = list(executor.map(fetch_page, pages))
+
+    table = FeatureTable.concat(tables)
+    table.object_id_field_name = table.object_id_field_name or object_id_field_name
+    return table
+
+
+def get_spatial_info_from_service_url(url, token=None):
+    # falls back to the active arcgis connection like FeatureLayer(url) did, and to anonymous requests without one
+    if token is None:
+        token = get_signin_token()
+
     try:
-        linear_unit = 'meter'
-        fl = FeatureLayer(url)
+
         spatial_info = SpatialInfo()
 
-        # spatial data frame
-        expression = '1=1'
-        fs = fl.query(where=expression, return_z=True)
-        spatial_info.has_z = fs.has_z
-        spatial_info.fs_df = fs.sdf
-        spatial_info.fs_dict = fs.to_dict()
-        spatial_info.object_id_field_name = fs.object_id_field_name
+        # columnar feature table, fs_df and fs_dict are derived from it when needed
+        table = download_features_paged(url, token)
+        spatial_info.table = table
+        spatial_info.has_z = table.has_z
+        spatial_info.object_id_field_name = table.object_id_field_name
         spatial_info.url = url
 
-        for feature in fs.features:
-            try:
-                linear_unit = Geometry(feature.geometry).as_arcpy.spatialReference.linearUnitName
-                break
-            except:
-                arcpy.AddMessage("Failed to retrieve linear units from service url: " + url +
-                                 ". Assuming meters as linear unit.")
-                print("Failed to retrieve linear units from service url: " + url + ". Assuming meters as linear unit.")
-                linear_unit = 'meter'
-                break
+        # get spatial ref
+        spatial_ref = table.spatial_reference
+        if spatial_ref:
+            spatial_info.wkid = spatial_ref.get('latestWkid') or spatial_ref.get('wkid')
+        else:
+            arcpy.AddMessage("Found no spatial reference for service url: " + url)
+            print("Found no spatial reference for service url: " + url)
+
+        try:
+            linear_unit = arcpy.SpatialReference(spatial_info.wkid).linearUnitName
+        except:
+            arcpy.AddMessage("Failed to retrieve linear units from service url: " + url +
+                             ". Assuming meters as linear unit.")
+            print("Failed to retrieve linear units from service url: " + url + ". Assuming meters as linear unit.")
+            linear_unit = 'meter'
 
         if 'feet' in linear_unit.lower() or 'foot' in linear_unit.lower():
             spatial_info.linear_unit = 'feet'
         else:
             spatial_info.linear_unit = 'meter'
 
-        # get spatial ref
-        try:
-            spatial_ref = fs.spatial_reference
-
-            try:
-                spatial_info.wkid = spatial_ref.get('latestWkid')
-            except:
-                spatial_info.wkid = spatial_ref.get('wkid')
-        except:
-            arcpy.AddMessage("Found no spatial reference for service url: " + url)
-            print("Found no spatial reference for service url: " + url)
-
         return spatial_info
 
     except:
@@ -286,11 +860,8 @@ def is_typeof_scene_service(item, typeof):
     typeof_layer = False
 
     try:
-        layers = item.layers
-        zero_layer = layers[0]
-        lp = zero_layer.properties
-
-        l_type = lp.layerType
+        l_type = metadata_cache.get(('scene_layer_type', gis_fingerprint(getattr(item, '_gis', None)), item.id),
+                                    lambda: item.layers[0].properties.layerType)
         if l_type == typeof:
             typeof_layer = True
     except:
@@ -304,18 +875,17 @@ def get_layer_info(layer, layer_info, item_id):
     layer_info.url = layer.url
 
     if 'FeatureServer' in layer_info.url:
-        feature_layer = FeatureLayer(layer.url)
-
         # first check if we have FeatureLayer properties
         try:
             # get info from feature layer properties
-            layer_info.layer_properties = feature_layer.properties
+            layer_properties = get_feature_layer_properties(layer.url)
+            layer_info.layer_properties = layer_properties
             layer_info.item_id = item_id
-            layer_info.layer_type = feature_layer.properties.type
-            layer_info.title = feature_layer.properties.name
-            layer_info.rendering_info = feature_layer.properties.drawingInfo.renderer
+            layer_info.layer_type = layer_properties.type
+            layer_info.title = layer_properties.name
+            layer_info.rendering_info = layer_properties.drawingInfo.renderer
             try:
-                layer_info.labeling_info = feature_layer.properties.drawingInfo.labelingInfo
+                layer_info.labeling_info = layer_properties.drawingInfo.labelingInfo
             except:
                 pass
 
@@ -346,17 +916,16 @@ def get_layer_info(layer, layer_info, item_id):
         # it is a map
 
         try:
-            feature_layer = FeatureLayer(layer.url)
-
             try:
                 # get info from feature layer properties
-                layer_info.layer_properties = feature_layer.properties
+                layer_properties = get_feature_layer_properties(layer.url)
+                layer_info.layer_properties = layer_properties
                 layer_info.item_id = item_id
-                layer_info.layer_type = feature_layer.properties.type
-                layer_info.title = feature_layer.properties.name
-                layer_info.rendering_info = feature_layer.properties.drawingInfo.renderer
+                layer_info.layer_type = layer_properties.type
+                layer_info.title = layer_properties.name
+                layer_info.rendering_info = layer_properties.drawingInfo.renderer
                 try:
-                    layer_info.labeling_info = feature_layer.properties.drawingInfo.labelingInfo
+                    layer_info.labeling_info = layer_properties.drawingInfo.labelingInfo
                 except:
                     pass
 
@@ -424,6 +993,8 @@ def get_layers_info(layers):
     sub_layer_info_list = list()
     item_url_list = list()
 
+    prefetch_layer_properties([layer.url for layer in layers])
+
     i = 0
 
     for layer in layers:
@@ -442,89 +1013,206 @@ def get_layers_info(layers):
     return sub_layer_info_list
 
 
-def check_item_status(token, url, item_id, job_id):
-    '''
-        checks the status of the item
-        :param token: login token
-        :param url: base url used to check status of item
-        :param item_id: id of the item
-        :param job_id: job_id to check
-        :return: status as string
-    '''
+# status polling starts at POLL_INITIAL_DELAY seconds and backs off to POLL_MAX_DELAY
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 30.0
+POLL_PRINT_INTERVAL = 10
+# a job is only given up as failed after this many status requests in a row failed
+POLL_MAX_FETCH_ERRORS = 5
 
-    status_url = url + "/items/" + item_id + "/status"
 
+class StatusJob(object):
+    '''
+        a portal item or server job whose status is polled until it is completed or failed
+    '''
+    def __init__(self, job_id, status_url, params):
+        self.job_id = job_id
+        self.status_url = status_url
+        self.params = params
+        self.status = 'started'
+        self.response = None
+        self.elapsed = 0
+        self.last_print = 0
+
+    def fetch(self):
+        self.response = post_json(self.status_url, self.params, retries=2)
+        self.status = self.response.get("status") or self.status
+        return self.status
+
+    @property
+    def done(self):
+        return self.status.lower() in ('completed', 'failed')
+
+
+def item_status_job(token, url, item_id, job_id):
     status_dict = {
         "jobId": job_id,
         "f": "json",
         "token": token
     }
+    return StatusJob(job_id, url + "/items/" + item_id + "/status", status_dict)
 
-    t = datetime.datetime.now()
-    second_count = 0
-    last_print = 0
 
-    status = 'started'
+def server_job_status_job(token, url, job_id):
+    status_url = url + "/jobs/" + job_id
+    status_url = status_url.replace("rest/services", "rest/admin/services")
 
-    while status.lower() != 'completed':
-        json_response = urllib.request.urlopen(status_url, urllib.parse.urlencode(status_dict).encode("utf-8"))
-        response = json.loads(json_response.read())
+    job_dict = {
+        "f": "json",
+        "token": token
+    }
+    return StatusJob(job_id, status_url, job_dict)
 
-        status = response.get("status")
-        delta_seconds = (datetime.datetime.now() - t).seconds
-        if delta_seconds and delta_seconds != second_count:
-            second_count = delta_seconds
-            if delta_seconds - last_print == 10:
-                arcpy.AddMessage("Status: " + status + ". Processing time for job: " + job_id +
-                                 " is " + str(second_count) + " seconds.")
-                print("Status: " + status + ". Processing time for job: " + job_id +
-                      " is " + str(second_count) + " seconds.")
-                last_print = delta_seconds
 
-    return status
+def print_job_progress(job):
+    if job.elapsed - job.last_print >= POLL_PRINT_INTERVAL:
+        arcpy.AddMessage("Status: " + job.status + ". Processing time for job: " + job.job_id +
+                         " is " + str(int(job.elapsed)) + " seconds.")
+        print("Status: " + job.status + ". Processing time for job: " + job.job_id +
+              " is " + str(int(job.elapsed)) + " seconds.")
+        job.last_print = job.elapsed
+
 
+def is_tool_cancelled():
+    return bool(getattr(arcpy.env, 'isCancelled', False))
 
-def check_job_status(token, url, job_id):
+
+async def wait_for_job(job, timeout=None, progress=print_job_progress, is_cancelled=is_tool_cancelled,
+                       initial_delay=POLL_INITIAL_DELAY, max_delay=POLL_MAX_DELAY):
     '''
-        checks the status of the job
+        polls the job with exponential backoff and jitter until it is completed or failed
+        :return: final status, 'timeout' when timeout seconds passed or 'cancelled' when the tool was cancelled
+    '''
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    delay = initial_delay
+    fetch_errors = 0
+
+    while True:
+        try:
+            # the request is blocking, so it runs in the default thread pool
+            await loop.run_in_executor(None, job.fetch)
+            fetch_errors = 0
+        except Exception:
+            # the status is unknown, not failed: keep polling unless the status can't be read several times in a row
+            fetch_errors += 1
+            if fetch_errors >= POLL_MAX_FETCH_ERRORS:
+                job.status = 'failed'
+
+        job.elapsed = time.monotonic() - start
+        if progress:
+            progress(job)
+
+        if job.done:
+            return job.status
+
+        if is_cancelled and is_cancelled():
+            job.status = 'cancelled'
+            return job.status
+
+        if timeout is not None and job.elapsed >= timeout:
+            job.status = 'timeout'
+            return job.status
+
+        sleep = delay * (0.5 + random.random())
+        if timeout is not None:
+            sleep = min(sleep, max(timeout - job.elapsed, 0))
+        await asyncio.sleep(sleep)
+        delay = min(delay * 2, max_delay)
+
+
+async def wait_for_all_jobs(jobs, **kwargs):
+    import asyncio
+
+    return await asyncio.gather(*(wait_for_job(job, **kwargs) for job in jobs))
+
+
+def run_async(coroutine):
+    '''
+        runs a coroutine to completion, also when called from code that already runs an event loop
+    '''
+    import asyncio
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def wait_for_jobs(jobs, timeout=None, progress=print_job_progress, is_cancelled=is_tool_cancelled):
+    '''
+        waits for several jobs at once from a single event loop
+        :return: list of final statuses in the order of jobs
+    '''
+    return run_async(wait_for_all_jobs(jobs, timeout=timeout, progress=progress, is_cancelled=is_cancelled))
+
+
+def run_job_steps(steps, timeout=None):
+    '''
+        runs generators that yield status jobs and get the final status of each job sent back
+        the generators run one at a time on the calling thread; the jobs they are waiting for are polled together,
+        with a single wait_for_jobs call per round
+        :param steps: list of generators, the value a generator returns is its result. An exception raised by a
+                      generator stops all of them, so generators handle their own errors
+        :param timeout: seconds to wait for the jobs of a round
+        :return: list of results in the order of steps
+    '''
+    results = [None] * len(steps)
+    waiting = list()
+
+    def advance(index, status):
+        try:
+            waiting.append((index, steps[index].send(status)))
+        except StopIteration as e:
+            results[index] = e.value
+
+    for index in range(len(steps)):
+        advance(index, None)
+
+    while waiting:
+        jobs = list(waiting)
+        del waiting[:]
+        statuses = wait_for_jobs([job for _, job in jobs], timeout=timeout)
+        for (index, _), status in zip(jobs, statuses):
+            advance(index, status)
+
+    return results
+
+
+def check_item_status(token, url, item_id, job_id, timeout=None):
+    '''
+        checks the status of the item
         :param token: login token
-        :param url: base url used to check status of job
+        :param url: base url used to check status of item
+        :param item_id: id of the item
         :param job_id: job_id to check
+        :param timeout: seconds to wait before giving up
         :return: status as string
     '''
-    status_url = url + "/jobs/" + job_id
-    status_url = status_url.replace("rest/services", "rest/admin/services")
-
-    job_dict = {
-        "f": "json",
-        "token": token
-    }
+    return wait_for_jobs([item_status_job(token, url, item_id, job_id)], timeout=timeout)[0]
 
-    t = datetime.datetime.now()
-    second_count = 0
-    last_print = 0
 
-    status = 'started'
+def check_job_status(token, url, job_id, timeout=None):
+    '''
+        checks the status of the job
+        :param token: login token
+        :param url: base url used to check status of job
+        :param job_id: job_id to check
+        :param timeout: seconds to wait before giving up
+        :return: status as string
+    '''
     arcpy.AddMessage("Status: starting cache rebuild.")
     print("Status: starting cache rebuild.")
 
-    while status.lower() != 'completed':
-        json_response = urllib.request.urlopen(status_url, urllib.parse.urlencode(job_dict).encode("utf-8"))
-        response = json.loads(json_response.read())
-        status = response.get("status")
-
-        delta_seconds = (datetime.datetime.now() - t).seconds
-        if delta_seconds and delta_seconds != second_count:
-            second_count = delta_seconds
-            if delta_seconds - last_print > 9:
-                arcpy.AddMessage("Status: " + status + ". Processing time for job: " + job_id + " is " + str(
-                    second_count) + " seconds.")
-                print("Status: " + status + ". Processing time for job: " + job_id + " is " + str(
-                    second_count) + " seconds.")
-                last_print = delta_seconds
+    status = wait_for_jobs([server_job_status_job(token, url, job_id)], timeout=timeout)[0]
 
-        if status.lower() == 'failed':
-            raise Exception("Cache rebuild failed!")
+    if status.lower() == 'failed':
+        raise Exception("Cache rebuild failed!")
 
     return status
 
@@ -704,11 +1392,7 @@ def get_related_item(item_id, items_url, token):
         }
 
         related_item_url = items_url + item_id + "/relatedItems"
-        json_response = urllib.request.urlopen(related_item_url,
-                                               urllib.parse.urlencode(related_item_dict).encode("utf-8"))
-        # pprint(json_response)
-        response = json.loads(json_response.read())
-        # pprint(response)
+        response = get_json_cached(related_item_url, related_item_dict)
 
         related_items_list = response.get('relatedItems')
 
@@ -739,10 +1423,7 @@ def get_source_item(token, layer_info):
         }
 
         sources_item_url = layer_info.url + "/sources"
-        json_response = urllib.request.urlopen(sources_item_url,
-                                               urllib.parse.urlencode(sources_item_dict).encode("utf-8"))
-        # pprint(json_response)
-        response = json.loads(json_response.read())
+        response = get_json_cached(sources_item_url, sources_item_dict)
         # pprint(response)
 
         sources_layers_list = response.get('layers')
@@ -770,10 +1451,7 @@ def get_view_layer_item(token, layer_info):
         }
 
         views_item_url = layer_info.url + "/views"
-        json_response = urllib.request.urlopen(views_item_url,
-                                               urllib.parse.urlencode(view_item_dict).encode("utf-8"))
-        # pprint(json_response)
-        response = json.loads(json_response.read())
+        response = get_json_cached(views_item_url, view_item_dict)
         # pprint(response)
 
         view_layers_list = response.get('layers')
@@ -799,22 +1477,16 @@ def get_item_data(item_id, items_url, token):
         }
 
         item_data_url = items_url + item_id + "/data"
-        json_response = urllib.request.urlopen(item_data_url,
-                                               urllib.parse.urlencode(item_data_dict).encode("utf-8"))
-        if json_response.status == 200:
-            # pprint(json_response)
-            try:
-                response = json.loads(json_response.read())
-                #pprint(response)
+        try:
+            # urlopen raises on any status other than 200
+            response = get_json_cached(item_data_url, item_data_dict)
 
-                try:
-                    item_data_layers = response.get('layers')
-                    return item_data_layers
-                except:
-                    return None
+            try:
+                item_data_layers = response.get('layers')
+                return item_data_layers
             except:
                 return None
-        else:
+        except:
             return None
     else:
         return None
@@ -860,16 +1532,14 @@ def check_z_values(url, geom_type):
 
 
 def get_layer_properties_by_url(item, url):
-    item_layers = item.layers
-
-    layer_properties = None
-
-    for layer in item_layers:
-        if layer.url == url:
-            layer_properties = layer.properties
-            break
+    def fetch():
+        for layer in item.layers:
+            if layer.url == url:
+                return layer.properties
+        return None
 
-    return layer_properties
+    key = ('item_layer_properties', gis_fingerprint(getattr(item, '_gis', None)), item.id, url)
+    return metadata_cache.get(key, fetch)
 
 
 def get_first_point_feature_layer(item):
@@ -904,16 +1574,120 @@ def is_point_feature_layer(item, max_layers):
     return success
 
 
-def z_values_from_elevation_service(token, url, geom_dict):
+# elevation samples are cached by coordinates rounded to this many meters
+ELEVATION_CACHE_RESOLUTION = 0.01
+ELEVATION_CACHE_NAME = 'a3d_elevation_cache.sqlite'
+
+
+@functools.lru_cache(maxsize=None)
+def elevation_cache_quantum(wkid, resolution=ELEVATION_CACHE_RESOLUTION):
+    '''
+        the rounding step in units of the spatial reference for a resolution in meters
+        :return: quantum, True when the units are angular (the x step is then scaled by the latitude)
     '''
+    if not wkid:
+        return resolution, False
+
+    try:
+        sr = arcpy.SpatialReference(wkid)
+    except Exception:
+        # unknown spatial references are quantized in map units
+        return resolution, False
+
+    if sr.type == 'Geographic':
+        return resolution / (sr.semiMajorAxis * sr.radiansPerUnit), True
+
+    return resolution / (sr.metersPerUnit or 1), False
 
+
+class ElevationCache(object):
+    '''
+        persistent elevation sample cache, keyed by elevation service url, wkid and x / y quantized to the resolution
+        in meters
+    '''
+    def __init__(self, path=None, resolution=ELEVATION_CACHE_RESOLUTION):
+        import os
+        import sqlite3
+
+        if not path:
+            import tempfile
+            folder = arcpy.env.scratchFolder or tempfile.gettempdir()
+            path = os.path.join(folder, ELEVATION_CACHE_NAME)
+
+        self.path = path
+        self.resolution = resolution
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS elevation_samples (url TEXT, wkid INTEGER, "
+                                "resolution REAL, qx INTEGER, qy INTEGER, z REAL, "
+                                "PRIMARY KEY (url, wkid, resolution, qx, qy))")
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def quantize(self, wkid, xy):
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        quantum, angular = elevation_cache_quantum(wkid, self.resolution)
+        qy = np.round(xy[:, 1] / quantum)
+        x = xy[:, 0]
+        if angular:
+            # a degree of longitude is shorter away from the equator, rows share the latitude of their qy
+            x = x * np.cos(np.radians(qy * quantum))
+        qx = np.round(x / quantum)
+        return np.column_stack([qx, qy]).astype(np.int64)
+
+    def get(self, url, wkid, xy):
+        '''
+            :return: z values for the xy array, nan where not cached
+        '''
+        z = np.full(len(xy), np.nan)
+        if len(xy) == 0:
+            return z
+
+        q = self.quantize(wkid, xy)
+        rows = self.connection.execute("SELECT qx, qy, z FROM elevation_samples WHERE url = ? AND wkid = ? "
+                                       "AND resolution = ? AND qx BETWEEN ? AND ? AND qy BETWEEN ? AND ?",
+                                       (url, wkid or 0, self.resolution, int(q[:, 0].min()), int(q[:, 0].max()),
+                                        int(q[:, 1].min()), int(q[:, 1].max()))).fetchall()
+        cached = {(qx, qy): value for qx, qy, value in rows}
+        for i, key in enumerate(zip(q[:, 0].tolist(), q[:, 1].tolist())):
+            value = cached.get(key)
+            if value is not None:
+                z[i] = value
+
+        found = int(np.count_nonzero(~np.isnan(z)))
+        self.hits += found
+        self.misses += len(z) - found
+        return z
+
+    def put(self, url, wkid, xy, z):
+        q = self.quantize(wkid, xy)
+        valid = ~np.isnan(z)
+        self.connection.executemany("INSERT OR REPLACE INTO elevation_samples VALUES (?, ?, ?, ?, ?, ?)",
+                                    ((url, wkid or 0, self.resolution, qx, qy, value) for qx, qy, value in
+                                     zip(q[valid, 0].tolist(), q[valid, 1].tolist(), z[valid].tolist())))
+        self.connection.commit()
+
+
+def sample_elevation_service(token, url, xy, wkid, max_workers=HTTP_POOL_SIZE):
+    '''
+        samples the elevation service at xy in chunks of the service maxRecordCount, posted concurrently
+        :return: z values, nan where sampling failed
     '''
     try:
+        service_info = post_json(url.rsplit('/getSamples', 1)[0], {"f": "json", "token": token})
+        chunk_size = service_info.get('maxRecordCount') or 1000
+    except Exception:
+        chunk_size = 1000
 
-        geom_def = json.dumps(geom_dict)
+    z = np.full(len(xy), np.nan)
 
+    def fetch_chunk(start):
+        geom_dict = {"points": xy[start:start + chunk_size].tolist(), "spatialReference": {"wkid": wkid}}
         params_dict = {
-            "geometry": geom_def,
+            "geometry": json.dumps(geom_dict),
             "geometryType": "esriGeometryMultipoint",
             "returnFirstValueOnly": "true",
             "interpolation": "RSP_NearestNeighbor",
@@ -921,40 +1695,122 @@ def z_values_from_elevation_service(token, url, geom_dict):
             "f": "json",
             "token": token
         }
+        return start, post_json(url, params_dict).get('samples') or list()
 
-        json_response = urllib.request.urlopen(url,
-                                               urllib.parse.urlencode(params_dict).encode("utf-8"))
-        #pprint(json_response)
-        response = json.loads(json_response.read())
-        #pprint(response)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_chunk, start) for start in range(0, len(xy), chunk_size)]
+        for future in futures:
+            try:
+                start, samples_list = future.result()
+            except Exception:
+                continue
 
-        try:
-            samples_list = response['samples']
-            vertex_list = []
-            z_list = list()
+            for i, point in enumerate(samples_list):
+                # locationId is the index of the point in the request
+                location_id = point.get('locationId', i)
+                try:
+                    z[start + location_id] = float(point['value'])
+                except (KeyError, TypeError, ValueError):
+                    pass
 
-            if len(samples_list) > 0:
-                for point in samples_list:
-                    xyz_list = list()
-                    x_value = point['location']['x']
-                    y_value = point['location']['y']
+    return z
 
-                    xyz_list.append(x_value)
-                    xyz_list.append(y_value)
 
-                    z_value = point['value']
-                    xyz_list.append(z_value)
-                    z_list.append(z_value)
-                    vertex_list.append(xyz_list)
+def sample_dtm_raster(dtm_raster, xy, wkid):
+    '''
+        samples a local elevation raster at xy (nearest cell)
+        :return: z values, nan outside the raster or on NoData
+    '''
+    raster = arcpy.Raster(dtm_raster)
+    raster_sr = raster.spatialReference
 
-                return vertex_list, z_list
-        except:
+    if wkid and raster_sr.factoryCode and raster_sr.factoryCode != wkid:
+        input_sr = arcpy.SpatialReference(wkid)
+        projected = [arcpy.PointGeometry(arcpy.Point(x, y), input_sr).projectAs(raster_sr).firstPoint
+                     for x, y in xy.tolist()]
+        xy = np.array([[p.X, p.Y] for p in projected]).reshape(-1, 2)
+
+    extent = raster.extent
+    width, height = raster.meanCellWidth, raster.meanCellHeight
+    cols = np.floor((xy[:, 0] - extent.XMin) / width).astype(np.int64)
+    rows = np.floor((extent.YMax - xy[:, 1]) / height).astype(np.int64)
+    inside = (cols >= 0) & (cols < raster.width) & (rows >= 0) & (rows < raster.height)
+
+    z = np.full(len(xy), np.nan)
+    if not inside.any():
+        return z
+
+    # only the cells around the points are read, not the whole raster
+    col0, col1 = int(cols[inside].min()), int(cols[inside].max()) + 1
+    row0, row1 = int(rows[inside].min()), int(rows[inside].max()) + 1
+    lower_left = arcpy.Point(extent.XMin + col0 * width, extent.YMax - row1 * height)
+    array = arcpy.RasterToNumPyArray(raster, lower_left_corner=lower_left, ncols=col1 - col0, nrows=row1 - row0,
+                                     nodata_to_value=np.nan).astype(np.float64)
+
+    z[inside] = array[rows[inside] - row0, cols[inside] - col0]
+    return z
+
+
+def z_values_from_elevation_service(token, url, geom_dict, dtm_raster=None, cache_path=None, default_z=None):
+    '''
+        gets z values for the points of a multipoint geometry dictionary
+        previously sampled locations come from the elevation cache, the rest is sampled from the elevation service
+        in concurrent chunks. if dtm_raster is given, points the service could not sample are sampled from it.
+        points without a z value after that get default_z, or fail the call when default_z is None
+        :return: list of [x, y, z], list of z. None, None when z values are missing
+    '''
+    try:
+        xy = np.array([p[:2] for p in geom_dict.get('points')], dtype=np.float64).reshape(-1, 2)
+        wkid = geom_dict.get('spatialReference', dict()).get('wkid')
+
+        cache = ElevationCache(cache_path)
+        try:
+            z = cache.get(url, wkid, xy)
+            missing = np.isnan(z)
+
+            if missing.any():
+                z[missing] = sample_elevation_service(token, url, xy[missing], wkid)
+                cache.put(url, wkid, xy[missing], z[missing])
+
+            arcpy.AddMessage("Elevation cache: " + str(cache.hits) + " cached, " + str(cache.misses) +
+                             " sampled points.")
+            print("Elevation cache: " + str(cache.hits) + " cached, " + str(cache.misses) + " sampled points.")
+        finally:
+            cache.close()
+
+        missing = np.isnan(z)
+        if missing.any() and dtm_raster:
+            arcpy.AddMessage("Sampling " + str(int(missing.sum())) + " points from " + str(dtm_raster) + ".")
+            print("Sampling " + str(int(missing.sum())) + " points from " + str(dtm_raster) + ".")
+            z[missing] = sample_dtm_raster(dtm_raster, xy[missing], wkid)
+            missing = np.isnan(z)
+
+        if missing.all():
             arcpy.AddMessage("Failed retrieve z values.")
             print("Failed retrieve z values.")
             return None, None
+
+        if missing.any():
+            if default_z is None:
+                arcpy.AddError("Failed to retrieve z values for " + str(int(missing.sum())) + " of " +
+                               str(len(z)) + " points. Pass an elevation raster (dtm_raster) that covers them.")
+                print("Failed to retrieve z values for " + str(int(missing.sum())) + " of " + str(len(z)) +
+                      " points. Pass an elevation raster (dtm_raster) that covers them.")
+                return None, None
+
+            arcpy.AddWarning("Failed to retrieve z values for " + str(int(missing.sum())) + " points, using " +
+                             str(default_z) + ".")
+            print("Failed to retrieve z values for " + str(int(missing.sum())) + " points, using " +
+                  str(default_z) + ".")
+            z[missing] = default_z
+
+        z_list = z.tolist()
+        vertex_list = [[x, y, value] for (x, y), value in zip(xy.tolist(), z_list)]
+
+        return vertex_list, z_list
     except:
-        arcpy.AddMessage("Failed to rebuild cache for scene layer.")
-        print("Failed to rebuild cache for scene layer.")
+        arcpy.AddMessage("Failed retrieve z values.")
+        print("Failed retrieve z values.")
         return None, None
 
 
@@ -991,9 +1847,7 @@ def get_portal_id(token, url):
             "token": token
         }
 
-        json_response = urllib.request.urlopen(portal_url,
-                                               urllib.parse.urlencode(portal_dict).encode("utf-8"))
-        response = json.loads(json_response.read())
+        response = get_json_cached(portal_url, portal_dict)
 
         try:
             portal_id = response.get('id')
@@ -1017,11 +1871,7 @@ def get_item_info(token, item_url):
         "token": token
     }
 
-    json_response = urllib.request.urlopen(item_url,
-                                           urllib.parse.urlencode(sources_item_dict).encode("utf-8"))
-    # pprint(json_response)
-    response = json.loads(json_response.read())
-    #pprint(response)
+    response = get_json_cached(item_url, sources_item_dict)
 
     return response
 
@@ -1043,9 +1893,7 @@ def check_service_name(token, url, name, service_type):
             "token": token
         }
 
-        json_response = urllib.request.urlopen(service_name_url,
-                                               urllib.parse.urlencode(service_name_dict).encode("utf-8"))
-        response = json.loads(json_response.read())
+        response = get_json_cached(service_name_url, service_name_dict)
 
         try:
             available = response.get('available')
@@ -1099,6 +1947,9 @@ def create_service(token, content_users_url, username, input_item, item_folder,
                                                urllib.parse.urlencode(create_service_dict).encode("utf-8"))
         #pprint(json_response)
         response = json.loads(json_response.read())
+
+        # the portal changed, cached item and service metadata may be stale
+        metadata_cache.invalidate()
         #pprint(response)
 
         try:
@@ -1164,6 +2015,9 @@ def update_item(token, content_users_url, username, input_item, item_folder,
                                                urllib.parse.urlencode(update_item_dict).encode("utf-8"))
         #pprint(json_response)
         response = json.loads(json_response.read())
+
+        # the portal changed, cached item and service metadata may be stale
+        metadata_cache.invalidate()
         #pprint(response)
 
         try:
@@ -1230,6 +2084,9 @@ def add_definition(token, content_users_url, username, input_item, item_folder,
                                                urllib.parse.urlencode(add_def_dict).encode("utf-8"))
         #pprint(json_response)
         response = json.loads(json_response.read())
+
+        # the portal changed, cached item and service metadata may be stale
+        metadata_cache.invalidate()
         #pprint(response)
 
         try:
@@ -1251,67 +2108,164 @@ def polygons_add_z(spatial_info, base_elev_attribute, object_units, converted):
         conv_factor = 1
     else:
         conv_factor = unit_conversion(spatial_info.linear_unit, object_units, 0)
-    fs_dict = spatial_info.fs_dict
-    features = fs_dict.get('features')
 
-    f = 0
-    if len(features) > 0:
-        for ftr in features:
-            geom = ftr.get('geometry')
-            attr = ftr.get('attributes')
-            base_elev = attr[base_elev_attribute]
+    table = spatial_info.to_table()
 
-            if is_number(str(base_elev)):
-                if base_elev != 0:
-                    z_value = base_elev*conv_factor
-                else:
-                    z_value = 0
-            else:
-                z_value = 0
+    if table is not None and len(table) > 0:
+        # base elevations that are not a number put the feature at 0
+        base_elev = pd.to_numeric(table.attributes[base_elev_attribute], errors='coerce').fillna(0)
 
-            rings = geom.get('rings')
-
-            for ring in rings:
-                for point in ring:
-                    point.append(z_value)
-
-            geom['hasZ'] = True
-            f += 1
+        table.add_z(base_elev.to_numpy(dtype=np.float64) * conv_factor)
 
         # set geometry type to 'esriGeometryPolygon'
-        fs_dict['geometryType'] = 'esriGeometryPolygon'
+        table.geometry_type = 'esriGeometryPolygon'
 
         return True
     else:
         return False
 
 
-def add_records_hosted_layer_via_rest(token, item_3D, spatial_info):
-    success = False
+# byte budget of a single applyEdits request and number of requests in flight
+UPLOAD_BATCH_BYTES = 4 * 1024 * 1024
+UPLOAD_WORKERS = 4
+UPLOAD_BATCH_RETRIES = 2
 
-    item_layers = item_3D.layers
 
-    if len(item_layers) == 1:
-        layer_url = item_layers[0].url
-        apply_edits_url = layer_url + "/applyEdits"
-        apply_edits_url = apply_edits_url.replace(" ", "%20")
+def batch_features_by_size(features, max_bytes=UPLOAD_BATCH_BYTES):
+    '''
+        serializes each feature once and groups them into json arrays of at most max_bytes
+        features that are json strings already are used as they are
+        a feature larger than max_bytes gets a batch of its own
+        :return: list of (index of first feature, number of features, json array string)
+    '''
+    batches = list()
+    batch = list()
+    batch_bytes = 2
+    first = 0
+
+    for index, feature in enumerate(features):
+        feature_json = feature if isinstance(feature, str) else json.dumps(feature)
+        feature_bytes = len(feature_json) + 1
+
+        if batch and batch_bytes + feature_bytes > max_bytes:
+            batches.append((first, len(batch), '[' + ','.join(batch) + ']'))
+            batch = list()
+            batch_bytes = 2
+            first = index
+
+        batch.append(feature_json)
+        batch_bytes += feature_bytes
+
+    if batch:
+        batches.append((first, len(batch), '[' + ','.join(batch) + ']'))
+
+    return batches
+
+
+def is_unsent_request_error(error):
+    '''
+        True when a request failed before it reached the server (no connection could be made), so sending it again
+        cannot apply it twice
+    '''
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # requests wraps the urllib3 MaxRetryError, whose reason is the error of the last connection attempt
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+    return False
+
+
+def apply_edits_adds(layer_url, token, features, rollback_on_failure=True, max_bytes=UPLOAD_BATCH_BYTES,
+                     max_workers=UPLOAD_WORKERS, batch_retries=UPLOAD_BATCH_RETRIES):
+    '''
+        adds features to a feature layer in size bounded applyEdits batches, posted concurrently
+        adds are not idempotent: a batch is only sent again when its request never reached the server, a batch that
+        failed in any other way may have been applied and is reported as failed without resending it
+        rollbackOnFailure applies per batch, batches that succeeded stay committed when a later batch fails
+        :param rollback_on_failure: when False, valid features of a batch are added and the error of each
+                                    failed feature is returned
+        :return: number of added features, list of (feature index, error) for features that were not added
+    '''
+    apply_edits_url = (layer_url + "/applyEdits").replace(" ", "%20")
+    pending = batch_features_by_size(features, max_bytes)
+    total = sum(b[1] for b in pending)
+    added = 0
+    errors = list()
+    t = time.time()
+
+    def post_batch(batch):
         query_dict = {
-            "adds": json.dumps(spatial_info.fs_dict.get('features')),
+            "adds": batch[2],
+            "rollbackOnFailure": "true" if rollback_on_failure else "false",
             "f": "json",
             "token": token
         }
+        return post_json(apply_edits_url, query_dict, retries=0)
 
-        json_response = urllib.request.urlopen(apply_edits_url, urllib.parse.urlencode(query_dict).encode("utf-8"))
-        response = json.loads(json_response.read())
+    attempt = 0
+    while pending:
+        unsent = list()
 
-        add_result_list = response["addResults"]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(batch, executor.submit(post_batch, batch)) for batch in pending]
+
+            for batch, future in futures:
+                first = batch[0]
+                try:
+                    add_result_list = future.result().get("addResults") or list()
+                except Exception as e:
+                    if is_unsent_request_error(e) and attempt < batch_retries:
+                        unsent.append(batch)
+                    else:
+                        errors.extend((first + i, str(e)) for i in range(batch[1]))
+                    continue
+
+                for i, record_result in enumerate(add_result_list):
+                    if record_result.get("success"):
+                        added += 1
+                    else:
+                        errors.append((first + i, record_result.get("error")))
+
+        attempt += 1
+        if unsent:
+            arcpy.AddMessage("Resending " + str(len(unsent)) + " applyEdits batches that could not be sent...")
+            print("Resending " + str(len(unsent)) + " applyEdits batches that could not be sent...")
+        pending = unsent
+
+    seconds = max(time.time() - t, 0.001)
+    arcpy.AddMessage("Uploaded " + str(added) + " of " + str(total) + " features in " +
+                     "{:.1f} seconds ({:.0f} features per second).".format(seconds, added / seconds))
+    print("Uploaded " + str(added) + " of " + str(total) + " features in " +
+          "{:.1f} seconds ({:.0f} features per second).".format(seconds, added / seconds))
+
+    if errors and added > 0 and rollback_on_failure:
+        message = ("Partial upload: " + str(added) + " features of batches that succeeded stay committed, " +
+                   str(len(errors)) + " features of failed batches were rolled back or not added.")
+        arcpy.AddWarning(message)
+        print(message)
+
+    return added, errors
+
+
+def add_records_hosted_layer_via_rest(token, item_3D, spatial_info, rollback_on_failure=True):
+    success = False
+
+    item_layers = item_3D.layers
+
+    if len(item_layers) == 1:
+        layer_url = item_layers[0].url
+
+        count, errors = apply_edits_adds(layer_url, token, spatial_info.features_json(),
+                                         rollback_on_failure=rollback_on_failure)
+
+        if len(errors) > 0:
+            arcpy.AddWarning("Failed to add " + str(len(errors)) + " features to layer. First error: " +
+                             str(errors[0][1]))
 
-        count = 0
-        for record_result in add_result_list:
-            r_success = record_result["success"]
-            if r_success:
-                count += 1
         if count > 0:
             arcpy.AddMessage("Added: " + str(count) + " features to layer.")
             success = True
@@ -1325,14 +2279,10 @@ def create_feature_copies(spatial_info, num_copies_attribute, below_ground):
     try:
         fs_df = spatial_info.fs_df
 
-        # duplicate features based on num_copies_attribute
-
-        if not below_ground:
-            fs_df[num_copies_attribute] = fs_df[num_copies_attribute].fillna(0)
-            copies_fs_df = fs_df.loc[fs_df.index.repeat(fs_df[num_copies_attribute])].reset_index(drop=True)
-        else:
-            fs_df[num_copies_attribute] = fs_df[num_copies_attribute].fillna(0)
-            copies_fs_df = fs_df.loc[fs_df.index.repeat(fs_df[num_copies_attribute])].reset_index(drop=True)
+        # duplicate features based on num_copies_attribute, the same for above and below ground copies
+        fs_df[num_copies_attribute] = fs_df[num_copies_attribute].fillna(0)
+        num_copies = np.maximum(fs_df[num_copies_attribute].to_numpy(dtype=np.float64), 0).astype(np.int64)
+        copies_fs_df = fs_df.iloc[np.repeat(np.arange(len(fs_df)), num_copies)].reset_index(drop=True)
 
         # set index column name
         index_name = copies_fs_df.index.name
@@ -1380,31 +2330,21 @@ def test_feature_copies(url, num_copies_attribute):
         return None
 
 
-def set_levelid_attribute(sdf, levelid_attribute, below_ground):
-
-    # get unique list of index values
-    object_id_list = sorted(sdf['orig_object_id'].unique())
-
-    # select all rows for each object_id
-    for object_id in object_id_list:
-
-        mask = sdf['orig_object_id'] == object_id
-
-        index = sdf.index
-        mask_indices_list = index[mask].tolist()
-
-        i = 0
+def get_level_number(sdf):
+    '''
+        0 based position of each row among the rows with the same orig_object_id, in row order
+    '''
+    return sdf.groupby('orig_object_id', sort=False).cumcount().to_numpy()
 
-        for indx in mask_indices_list:
-            if not below_ground:
-                i += 1
-            else:
-                i -= 1
 
-            sdf.loc[index == indx, levelid_attribute] = int(i)
+def set_levelid_attribute(sdf, levelid_attribute, below_ground):
+    # levels count up from 1 above ground and down from -1 below ground
+    level_id = get_level_number(sdf) + 1
 
-    sdf[levelid_attribute] = sdf[levelid_attribute].astype(int)
+    if below_ground:
+        level_id = -level_id
 
+    sdf[levelid_attribute] = level_id.astype(int)
 
 
 def set_id_attribute(sdf, id_attr, attr1, attr2):
@@ -1426,89 +2366,48 @@ def set_id_attribute(sdf, id_attr, attr1, attr2):
     return success
 
 
-def set_level_elevation_attribute_level_id(sdf, elevation_attribute, default_floor_height,
-                                           floor_height_attribute, conv_factor, level_attribute):
-
-    # get unique list of index values
-    object_id_list = sorted(sdf['orig_object_id'].unique())
-
-    # select all rows for each object_id
-    for object_id in object_id_list:
-        mask = sdf['orig_object_id'] == object_id
-
-        index = sdf.index
-        mask_indices_list = index[mask].tolist()
-        i = 0
-
-        above_floor_elevation = 0
-        below_floor_elevation = 0
-
-        for indx in mask_indices_list:
-            value_series = sdf.loc[index == indx, elevation_attribute]
-            elevation_value = value_series.iloc[0]
-
-            if i == 0:
-                above_floor_elevation = elevation_value
-                below_floor_elevation = elevation_value
+def get_first_in_level_group(sdf, attribute):
+    '''
+        value of the first row of each orig_object_id group, broadcast to all rows of the group
+    '''
+    first_row = sdf[attribute].where(get_level_number(sdf) == 0)
+    return first_row.groupby(sdf['orig_object_id'], sort=False).transform('first').to_numpy(dtype=np.float64)
 
-            value_series = sdf.loc[index == indx, level_attribute]
-            level_value = value_series.iloc[0].astype(int)
 
-            if level_value < 0:
-                below_ground = True
-            else:
-                below_ground = False
+def set_level_elevation_attribute_level_id(sdf, elevation_attribute, default_floor_height,
+                                           floor_height_attribute, conv_factor, level_attribute):
+    # all levels of a feature start from the elevation of its first row
+    base_elevation = get_first_in_level_group(sdf, elevation_attribute)
 
-            value_series = sdf.loc[index == indx, floor_height_attribute]
-            floor_height = value_series.iloc[0]
+    # use default floor height from settings.json
+    sdf[floor_height_attribute] = sdf[floor_height_attribute].fillna(default_floor_height)
+    floor_height = sdf[floor_height_attribute].to_numpy(dtype=np.float64)
 
-            # use default floor height from settings.json
-            if np.isnan(floor_height):
-                floor_height = default_floor_height
-                sdf.loc[index == indx, floor_height_attribute] = default_floor_height
+    below_ground = sdf[level_attribute].to_numpy().astype(int) < 0
+    group = sdf['orig_object_id']
 
-            if not below_ground:
-                sdf.loc[index == indx, elevation_attribute] = above_floor_elevation * conv_factor
-                above_floor_elevation += floor_height #  * conv_factor
-            else:
-                sdf.loc[index == indx, elevation_attribute] = (below_floor_elevation - floor_height) * conv_factor
-                below_floor_elevation -= floor_height #  * conv_factor
+    # above ground levels sit on the floors above ground before them,
+    # below ground levels hang under the floors below ground up to and including themselves
+    above_height = pd.Series(np.where(below_ground, 0, floor_height), index=sdf.index)
+    below_height = pd.Series(np.where(below_ground, floor_height, 0), index=sdf.index)
+    floors_above = above_height.groupby(group, sort=False).cumsum().to_numpy() - above_height.to_numpy()
+    floors_below = below_height.groupby(group, sort=False).cumsum().to_numpy()
 
-            i += 1
+    sdf[elevation_attribute] = np.where(below_ground,
+                                        (base_elevation - floors_below) * conv_factor,
+                                        (base_elevation + floors_above) * conv_factor)
 
 
 def set_level_elevation_attribute(sdf, elevation_attribute, default_floor_height,
                                   conv_factor, below_ground):
+    # all levels of a feature start from the elevation of its first row
+    base_elevation = get_first_in_level_group(sdf, elevation_attribute)
+    floors = get_level_number(sdf) * default_floor_height * conv_factor
 
-    # get unique list of index values
-    object_id_list = sorted(sdf['orig_object_id'].unique())
-
-    # select all rows for each object_id
-    for object_id in object_id_list:
-        mask = sdf['orig_object_id'] == object_id
-
-        index = sdf.index
-        mask_indices_list = index[mask].tolist()
-        i = 0
-
-        floor_elevation = 0
-        floor_height = default_floor_height
-
-        for indx in mask_indices_list:
-            value_series = sdf.loc[index == indx, elevation_attribute]
-            elevation_value = value_series.iloc[0]
-
-            if i == 0:
-                floor_elevation = elevation_value
-
-            if not below_ground:
-                sdf.loc[index == indx, elevation_attribute] = floor_elevation * conv_factor
-                floor_elevation += floor_height * conv_factor
-            else:
-                sdf.loc[index == indx, elevation_attribute] = (floor_elevation - default_floor_height) * conv_factor
-                floor_elevation -= floor_height * conv_factor
-
-            i += 1
+    if not below_ground:
+        sdf[elevation_attribute] = (base_elevation + floors) * conv_factor
+    else:
+        sdf[elevation_attribute] = (base_elevation - floors - default_floor_height) * conv_factor
 
 
 def test_polygons_add_z(fs_dict, base_elev_attribute):
@@ -1591,11 +2490,7 @@ def get_relationship_list_from_url(token, url):
 
         layer_info_url = url
 
-        json_response = urllib.request.urlopen(layer_info_url,
-                                               urllib.parse.urlencode(rel_info_dict).encode("utf-8"))
-        # pprint(json_response)
-        response = json.loads(json_response.read())
-        #pprint(response)
+        response = get_json_cached(layer_info_url, rel_info_dict)
 
         try:
             if response.get('relationships'):
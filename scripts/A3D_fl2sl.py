@@ -10,7 +10,6 @@ import urllib.parse
 from arcgis.features import FeatureLayer
 import arcpy
 
-
 def delete_associated_scene_layer(global_info, layer_info):
     success = False
 
@@ -32,6 +31,9 @@ def delete_associated_scene_layer(global_info, layer_info):
                 print("Deleted associated scene layer item: " + result.title + " of type: " + result.type)
                 success = True
 
+    if success:
+        A3D_common_lib.metadata_cache.invalidate()
+
     return success
 
 
@@ -59,6 +61,9 @@ def delete_associated_scene_items(global_info, layer_info):
                 print("Deleted associated scene layer item: " + result.title + " of type: " + result.type)
                 success = True
 
+    if success:
+        A3D_common_lib.metadata_cache.invalidate()
+
     return success
 
 
@@ -84,6 +89,8 @@ def publish_slpk(global_info, slpk_filepath, item_folder):
         arcpy.AddMessage("Published " + published_item.title + " to the home folder.")
         print("Published " + published_item.title + " to the home folder.")
 
+    A3D_common_lib.metadata_cache.invalidate()
+
     return published_item
 
 
@@ -160,14 +167,14 @@ def get_valid_service_name(global_info, name):
         return 'failed'
 
 
-def publish_scene_layer(global_info, item_id, name, update):
+def start_publish_scene_layer(global_info, item_id, name, update):
     '''
-         publish the scene layer
+         submits the publish request of the scene layer without waiting for it to finish
          :param global_info: global info
          :item_id: id of the layer item
          :param name: layer name
          :param update: update scene service True / False
-         :return: return services dictionary
+         :return: service item id, service url and status job or None, None, None
     '''
     scene_service_item_name = get_valid_service_name(global_info, name)
 
@@ -202,33 +209,72 @@ def publish_scene_layer(global_info, item_id, name, update):
             response = json.loads(json_response.read())
             #pprint(response)
 
+            # new service: related items and service names in the cache are stale
+            A3D_common_lib.metadata_cache.invalidate()
+
             try:
                 services_dict = response.get('services')[0]
                 job_id = services_dict.get('jobId')
                 service_item_id = services_dict.get('serviceItemId')
                 service_url = services_dict.get('serviceurl')
                 service_url = service_url.replace(" ", "%20")
-                encoded_service_url = services_dict.get('encodedServiceURL')
 
-                # check status of publishing
-                status = A3D_common_lib.check_item_status(global_info.token, url,
-                                                          service_item_id, job_id)
-
-                if status.lower() == 'completed':
-                    return service_item_id, service_url
+                job = A3D_common_lib.item_status_job(global_info.token, url, service_item_id, job_id)
+                return service_item_id, service_url, job
             except:
                 arcpy.AddMessage("Failed to retrieve the services dictionary.")
                 print("Failed to retrieve the services dictionary.")
 
-            return None, None
+            return None, None, None
         except:
             arcpy.AddMessage("Failed to retrieve the services dictionary.")
             print("Failed to retrieve the services dictionary.")
-            return None, None
+
+    return None, None, None
+
+
+def publish_scene_layer_steps(global_info, item_id, name, update):
+    '''
+         publishes the scene layer, yielding the publish job so it can be waited for together with the jobs of other
+         layers, see A3D_common_lib.run_job_steps
+         :param global_info: global info
+         :item_id: id of the layer item
+         :param name: layer name
+         :param update: update scene service True / False
+         :return: service item id and service url, None, None if failed
+    '''
+    service_item_id, service_url, job = start_publish_scene_layer(global_info, item_id, name, update)
+
+    if job:
+        status = yield job
+        if status.lower() == 'completed':
+            return service_item_id, service_url
+
+    return None, None
+
+
+def publish_scene_layer(global_info, item_id, name, update):
+    '''
+         publish the scene layer
+         :param global_info: global info
+         :item_id: id of the layer item
+         :param name: layer name
+         :param update: update scene service True / False
+         :return: return services dictionary
+    '''
+    return A3D_common_lib.run_job_steps([publish_scene_layer_steps(global_info, item_id, name, update)])[0]
 
 
 # convert point feature layer into scene layer
 def convert_point_layer_to_scene_layer(global_info, new_layer_info):
+    return A3D_common_lib.run_job_steps([convert_point_layer_to_scene_layer_steps(global_info, new_layer_info)])[0]
+
+
+def convert_point_layer_to_scene_layer_steps(global_info, new_layer_info):
+    '''
+        converts the point layer, yielding the publish and cache jobs it waits for, see A3D_common_lib.run_job_steps
+        :return: rc, new layer info list
+    '''
     new_layer_info_list = None
     rc = "no_return"
     sign_attrs = ['assetid', 'attachid', 'assettype',
@@ -273,9 +319,8 @@ def convert_point_layer_to_scene_layer(global_info, new_layer_info):
         if num_fs > 0:
             if num_fs > scene_service_threshold:
                 # if over threshold -> convert to tree scene layer
-                new_layer_info_list = A3D_fl2sl_trees.convert_point_layer_to_tree_layer(global_info,
-                                                                                        new_layer_info,
-                                                                                        tree_attrs)
+                new_layer_info_list = yield from A3D_fl2sl_trees.convert_point_layer_to_tree_layer_steps(
+                    global_info, new_layer_info, tree_attrs)
                 if new_layer_info_list:
                     rc = "tree_scene_service"
                 else:
@@ -289,88 +334,82 @@ def convert_point_layer_to_scene_layer(global_info, new_layer_info):
     return rc, new_layer_info_list
 
 
+def get_point_layer_slots(layer_info_list):
+    '''
+        finds the point layers, including the sub layers of group layers, in web map order
+        :param layer_info_list: list of layer info objects
+        :return: list of (owning list, index in that list, layer info)
+    '''
+    slots = list()
+
+    for li, layer_info in enumerate(layer_info_list):
+        if layer_info.group_layer:
+            for sli, sub_layer_info in enumerate(layer_info.sub_layer_info_list):
+                if sub_layer_info.layer_properties:
+                    if sub_layer_info.layer_properties.geometryType == 'esriGeometryPoint':
+                        slots.append((layer_info.sub_layer_info_list, sli, sub_layer_info))
+        else:
+            if layer_info.layer_properties:
+                if layer_info.layer_properties.geometryType == 'esriGeometryPoint':
+                    slots.append((layer_info_list, li, layer_info))
+
+    return slots
+
+
+def convert_layer_in_slot(global_info, layer_info):
+    '''
+        converts a single point layer, yielding the jobs it waits for
+        :return: rc and new layer info list; None if the conversion raised
+    '''
+    arcpy.AddMessage("Checking if " + layer_info.title + " has features...")
+    print("Checking if " + layer_info.title + " has features...")
+
+    try:
+        # check if can convert to 3D trees or street signs scene layer
+        return (yield from convert_point_layer_to_scene_layer_steps(global_info, layer_info))
+    except:
+        arcpy.AddMessage("Can't convert features in layer: " + layer_info.title + ". Skipping conversion...")
+        print("Can't convert features in layer: " + layer_info.title + ". Skipping conversion...")
+        return None
+
+
 # convert point feature layers into scene layers
 def convert_to_scene_layers(global_info, layer_info_list):
+    '''
+        converts the point layers on the calling thread, arcpy is not thread safe and the conversions share
+        global_info. The publish and cache jobs of all layers are waited for together. Layers are not generated
+        side by side: slpk generation is disabled in convert_point_layer_to_sign_layer, and when enabled the PRT
+        shards of a layer already use the process pool of generate_slpks.
+        Results are applied in web map order, so the layer order of the web scene is unchanged.
+        :param global_info: global info
+        :param layer_info_list: list of layer info objects
+        :return: updated layer_info_list
+    '''
     if layer_info_list:
-        li = 0
-
-        # Step through layers in layer_info_list and convert if possible
-        for layer_info in layer_info_list:
-            if layer_info.group_layer:
-                sli = 0
-                for sub_layer_info in layer_info.sub_layer_info_list:
-                    # only point features are processed
-                    if sub_layer_info.layer_properties:
-                        if sub_layer_info.layer_properties.geometryType == 'esriGeometryPoint':
-                            arcpy.AddMessage("Checking if " + sub_layer_info.title + " has features...")
-                            print("Checking if " + sub_layer_info.title + " has features...")
-
-                            try:
-                                # check if can convert to 3D trees or street signs scene layer
-                                rc, new_layer_info_list = convert_point_layer_to_scene_layer(global_info,
-                                                                                             sub_layer_info)
-                                if "scene_service" in rc:
-                                    # update the layer_info_list with the new layer
-                                    if new_layer_info_list:
-                                        arcpy.AddMessage("Converted" + sub_layer_info.title + " to scene layer...")
-                                        print("Converted " + sub_layer_info.title + " to scene layer...")
-                                        del layer_info.sub_layer_info_list[sli]
-                                        layer_info.sub_layer_info_list.insert(sli, new_layer_info_list[0])
-                                    else:
-                                        # something failed in conversion, we don't want the original layer
-                                        # added to the web scene
-                                        layer_info.sub_layer_info_list[sli].process_layer = False
-                                else:
-                                    # process layer, attributes not ok for conversion
-                                    layer_info.sub_layer_info_list[sli].process_layer = True
-
-                            except:
-                                arcpy.AddMessage(
-                                    "Can't convert features in layer: " + layer_info.title + ". Skipping conversion...")
-                                print("Can't convert features in layer: " +
-                                      layer_info.title + ". Skipping conversion...")
-                        else:
-                            pass
-                            # arcpy.AddMessage("Layer: " + sub_layer_info.title + " is not a point feature layer.")
-
-                    sli += 1
+        slots = get_point_layer_slots(layer_info_list)
+        results = A3D_common_lib.run_job_steps([convert_layer_in_slot(global_info, layer_info)
+                                                for _, _, layer_info in slots])
+
+        for (owner_list, index, layer_info), result in zip(slots, results):
+            if not result:
+                continue
+
+            rc, new_layer_info_list = result
+
+            if "scene_service" in rc:
+                # update the layer_info_list with the new layer
+                if new_layer_info_list:
+                    arcpy.AddMessage("Converted " + layer_info.title + " to scene layer...")
+                    print("Converted " + layer_info.title + " to scene layer...")
+                    # there will be only 1 scene layer
+                    owner_list[index] = new_layer_info_list[0]
+                else:
+                    # something failed in conversion, we don't want the original layer
+                    # added to the web scene
+                    owner_list[index].process_layer = False
             else:
-                # only point features are processed
-                if layer_info.layer_properties:
-                    if layer_info.layer_properties.geometryType == 'esriGeometryPoint':
-
-                        arcpy.AddMessage("Checking if " + layer_info.title + " has features...")
-                        print("Checking if " + layer_info.title + " has features...")
-
-                        try:
-                            # check if can convert to 3D trees or street signs
-                            rc, new_layer_info_list = convert_point_layer_to_scene_layer(global_info,
-                                                                                         layer_info)
-
-                            if "scene_service" in rc:
-                                # update the layer_info_list with the new layer
-                                if new_layer_info_list:
-                                    del layer_info_list[li]
-                                    layer_info_list.insert(li, new_layer_info_list[0])
-                                    # there will be only 1 scene layer
-                                else:
-                                    # something failed in conversion, we don't want the original layer
-                                    # added to the web scene
-                                    layer_info_list[li].process_layer = False
-                            else:
-                                # process layer, attributes not ok for conversion
-                                layer_info_list[li].process_layer = True
-
-                        except:
-                            arcpy.AddMessage("Can't convert features in layer: " + layer_info.title +
-                                             ". Skipping conversion...")
-                            print("Can't convert features in layer: " + layer_info.title +
-                                  ". Skipping conversion...")
-                    else:
-                        pass
-                        # arcpy.AddMessage("Layer: " + layer_info.title + " is not a point feature layer.")
-
-                li += 1
+                # process layer, attributes not ok for conversion
+                owner_list[index].process_layer = True
 
     return layer_info_list
 
@@ -383,6 +422,8 @@ def get_layer_info_from_item(item):
 
     i = 0
 
+    A3D_common_lib.prefetch_layer_properties([layer.url for layer in item_layers])
+
     for layer in item_layers:
         layer_info = A3D_common_lib.LayerInfo()
         layer_info.layer_no_id = i
@@ -2,6 +2,7 @@ import arcpy
 import scripts.A3D_common_lib as A3D_common_lib
 import scripts.A3D_fl2sl as A3D_fl2sl
 import numpy as np
+import pandas as pd
 from arcgis.geometry import Geometry
 import os
 from arcgis.features import FeatureLayer
@@ -17,6 +18,11 @@ except:
     #import pyprt
 
 
+# initial shapes per generated SLPK and number of worker processes generating SLPKs side by side
+PRT_SHARD_SIZE = 50000
+PRT_WORKERS = 2
+
+
 # STREET SIGN SPECIFIC FUNCTIONS
 def get_value_from_dataframe(df, search_field_name, search_field_value, value_field):
     value_series = df.loc[df[search_field_name] == search_field_value, value_field]
@@ -60,6 +66,203 @@ def holes_conversion(holes_ind_list):
     return holes_list
 
 
+def get_initial_shape_buffers(table, z_list, unit_factor):
+    """get_initial_shape_buffers(table, z_list, unit_factor) -> list
+    Builds the PyPRT InitialShape vertex, index, face count and hole buffers of all polygons at once from the
+    flat coordinate arrays of a FeatureTable. Rings are written without their closing vertex, in reverse order,
+    with y negated and z as the second coordinate. Counter-clockwise rings (positive signed area) are holes.
+    Parameters:
+        table: A3D_common_lib.FeatureTable with polygon features
+        z_list: list of z values: only used for 2D points
+        unit_factor: elevation unit conversion factor
+    Returns:
+        list of (vert_coord_list, face_indices_list, face_count_list, holes_list) per feature, None for features
+        without geometry
+    """
+    num_features = len(table)
+    coords = table.coords
+    part_offsets = table.part_offsets
+    feature_offsets = table.feature_offsets
+    num_parts = len(part_offsets) - 1
+
+    if num_parts == 0:
+        return [None] * num_features
+
+    part_lengths = np.diff(part_offsets)
+    part_feature = np.repeat(np.arange(num_features), np.diff(feature_offsets))
+    vertex_part = np.repeat(np.arange(num_parts), part_lengths)
+    x = coords[:, 0]
+    y = coords[:, 1]
+
+    # signed ring area with the shoelace formula, the closing vertex ends each ring
+    same_ring = vertex_part[:-1] == vertex_part[1:]
+    cross = (x[:-1] * y[1:] - x[1:] * y[:-1]) * same_ring
+    ring_area = np.bincount(vertex_part[:-1], weights=cross, minlength=num_parts) / 2
+
+    # drop the closing vertex and reverse every ring: vertex i of ring p comes from start + length - 1 - i
+    kept_lengths = np.maximum(part_lengths - 1, 0)
+    kept_offsets = np.concatenate(([0], np.cumsum(kept_lengths)))
+    kept_part = np.repeat(np.arange(num_parts), kept_lengths)
+    position = np.arange(kept_offsets[-1]) - kept_offsets[kept_part]
+    source = part_offsets[kept_part] + kept_lengths[kept_part] - 1 - position
+
+    # column 2 is m when the table has m but no z
+    if table.has_z:
+        z = coords[source, 2]
+    else:
+        feature_z = np.zeros(num_features)
+        num_z = min(len(z_list), num_features)
+        feature_z[:num_z] = np.asarray(z_list[:num_z], dtype=np.float64) * unit_factor
+        z = feature_z[part_feature[kept_part]]
+
+    vertices = np.column_stack((x[source], z, -y[source]))
+
+    buffers = list()
+    for f in range(num_features):
+        first_part = feature_offsets[f]
+        last_part = feature_offsets[f + 1]
+
+        if first_part == last_part:
+            buffers.append(None)
+            continue
+
+        face_count_list = kept_lengths[first_part:last_part].tolist()
+        vert_coord_list = vertices[kept_offsets[first_part]:kept_offsets[last_part]].ravel().tolist()
+        face_indices_list = list(range(0, sum(face_count_list)))
+        holes_list = holes_conversion(np.flatnonzero(ring_area[first_part:last_part] > 0.0).tolist())
+
+        buffers.append((vert_coord_list, face_indices_list, face_count_list, holes_list))
+
+    return buffers
+
+
+def get_pole_height_index(sdf):
+    '''
+        hash index of the pole heights by asset id, the first pole wins like a lookup in the dataframe
+        :param sdf: associated pole spatial dataframe
+        :return: dictionary assetid: height
+    '''
+    if sdf is None or 'assetid' not in sdf.columns or 'height' not in sdf.columns:
+        return dict()
+
+    poles = sdf.drop_duplicates('assetid')
+    return dict(zip(poles['assetid'].tolist(), poles['height'].tolist()))
+
+
+def get_domain_lookup(domain):
+    '''
+        :return: dictionary code: name of the coded value domain
+    '''
+    lookup = dict()
+
+    if domain:
+        for nc in domain.codedValues:
+            if nc.code not in lookup:
+                lookup[nc.code] = nc.name
+
+    return lookup
+
+
+def get_sign_attributes(attributes_df, object_units, layer_info, pole_heights):
+    '''
+        sets the CGA rule attributes for all signs at once
+        :param attributes_df: attributes of the sign features
+        :param object_units: units of the object parameters (typical inches or centimeters)
+        :param layer_info: feature layer info
+        :param pole_heights: dictionary assetid: pole height
+        :return: list of attribute dictionaries
+    '''
+    df = attributes_df.astype(object)
+
+    # get rid of None values
+    empty = df.isna() | ~df.fillna(1).astype(bool)
+    df = df.mask(empty, 'None')
+
+    # get Height attribute from pole feature layer, 10 when there is no pole or it has no height
+    attach_ids = df['attachid']
+    has_pole = ~attach_ids.astype(str).str.contains('None', regex=False)
+    pole_height = pd.to_numeric(attach_ids[has_pole].map(pole_heights), errors='coerce')
+    df['Height'] = pole_height.reindex(df.index).fillna(10).astype(float)
+
+    # rename and type setting to fit with CGA rule attributes
+    df['DirectionMethod'] = 'Degree'
+
+    has_angle = ~df['angle'].astype(str).str.contains('None', regex=False)
+    df['DirectionDegrees'] = pd.to_numeric(df['angle'].where(has_angle, 0), errors='coerce').fillna(0).astype(float)
+
+    df['SIGNSTYLE'] = df['style'].astype(str)
+    df['SIGNTEXT'] = df['text'].astype(str)
+    df['signUnits'] = object_units
+    df['DISTTOTOP'] = df['disttotop'].astype(str)
+    df['SIGNHEIGHT'] = df['height'].astype(str)
+    df['SIGNWIDTH'] = df['width'].astype(str)
+    df['ASSETID'] = df['assetid'].astype(str)
+    if 'SHAPE' in df.columns:
+        df['SHAPE'] = df['SHAPE'].astype(str)
+
+    # the style atrribute has the domain code value, we need the domain name value,
+    # if not found leave default value
+    style_fields = get_field_from_fl_fields(layer_info.layer_properties.fields, 'style')
+
+    if len(style_fields) > 0:
+        style_field = style_fields[0]  # we just grab the first one
+        domain_names = df[style_field.name].map(get_domain_lookup(style_field.domain))
+        has_name = domain_names.notna() & domain_names.astype(bool)
+        df['SIGNSTYLE'] = df['SIGNSTYLE'].where(~has_name, domain_names)
+
+    return df.to_dict('records')
+
+
+def arcgis_to_pyprt_buffers(feature_set, z_list, unit_factor, object_units, layer_info, sdf):
+    """arcgis_to_pyprt_buffers(feature_set) -> List[tuple], list[attributes]
+    Converts an ArcGIS FeatureSet into plain InitialShape buffers and rule attributes. Unlike InitialShape
+    instances the buffers can be sent to worker processes.
+    Parameters:
+        feature_set: input polygon feature set
+        z_list: list of z values: only used for 2D points
+        unit_factor: elevation unit conversion factor
+        object_units: units of the object parameters (typical inches or centimeters)
+        layer_info: feature layer info
+        sdf: associated pole spatial dataframe
+    Returns:
+        List[(vert_coord_list, face_indices_list, face_count_list, holes_list)], list[attributes]
+    """
+    shape_buffers = []
+    attrs_list = []
+
+    fs_dict = feature_set.to_dict()
+    features = fs_dict.get('features', list())
+
+    # take the dimension from the rings, the feature set z flag is not always set; the third value is m without z
+    first_rings = next((f['geometry']['rings'] for f in features
+                        if (f.get('geometry') or dict()).get('rings')), None)
+    fs_dict['hasM'] = bool(fs_dict.get('hasM', False))
+    fs_dict['hasZ'] = bool(first_rings and len(first_rings[0][0]) > 2 + fs_dict['hasM'])
+    fs_dict['geometryType'] = 'esriGeometryPolygon'
+
+    table = A3D_common_lib.FeatureTable.from_featureset_dict(fs_dict)
+    all_buffers = get_initial_shape_buffers(table, z_list, unit_factor)
+
+    valid = np.array([buffers is not None for buffers in all_buffers], dtype=bool)
+    if not valid.all():
+        arcpy.AddMessage("Only polygon features are supported. Skipping " +
+                         str(int((~valid).sum())) + " features.")
+
+    if valid.any():
+        try:
+            # object dtype keeps integer codes and ids as they are, so str() matches the feature attributes
+            attributes_df = pd.DataFrame([f.get('attributes') or dict() for f in features], dtype=object)
+            attrs_list = get_sign_attributes(attributes_df[valid].reset_index(drop=True), object_units,
+                                             layer_info, get_pole_height_index(sdf))
+            shape_buffers = [buffers for buffers in all_buffers if buffers]
+        except Exception as e:
+            arcpy.AddMessage("Could not set sign attributes: " + str(e))
+            shape_buffers = []
+            attrs_list = []
+
+    return shape_buffers, attrs_list
+
+
 def arcgis_to_pyprtDevelop(feature_set, z_list, unit_factor, object_units, layer_info, sdf):
     """arcgis_to_pyprt(feature_set) -> List[InitialShape]
     This function allows converting an ArcGIS FeatureSet into a list of PyPRT InitialShape instances.
@@ -74,137 +277,89 @@ def arcgis_to_pyprtDevelop(feature_set, z_list, unit_factor, object_units, layer
     Returns:
         List[InitialShape], list[attributes]
     """
-    initial_geometries = []
-    attrs_list = []
+    shape_buffers, attrs_list = arcgis_to_pyprt_buffers(feature_set, z_list, unit_factor, object_units,
+                                                        layer_info, sdf)
+    initial_geometries = [pyprt.InitialShape(*buffers) for buffers in shape_buffers]
 
-    # get the domain for sign style
-    fl_fields = layer_info.layer_properties.fields
-    style_fields = get_field_from_fl_fields(fl_fields, 'style')
+    return initial_geometries, attrs_list
 
-    if len(style_fields) > 0:
-        name_domain_dict = dict()
 
-        style_field = style_fields[0]  # we just grab the first one
+def generate_slpk_shard(shard):
+    """generate_slpk_shard(shard) -> str
+    Generates one SLPK. The InitialShape instances only exist for the duration of the call, so memory is bounded
+    by the shard size. Runs in a worker process, hence the plain tuple argument.
+    Parameters:
+        shard: (shape_buffers, attrs_list, rpk_path, enc_options)
+    Returns:
+        slpk file path
+    """
+    shape_buffers, attrs_list, rpk_path, enc_options = shard
 
-        name_domain_dict['field_name'] = style_field.name
-        name_domain_dict['domain'] = style_field.domain
-    else:
-        name_domain_dict = None
+    import pyprt
 
-    num_features = len(feature_set.features)
-    f = 0
+    if not pyprt.is_prt_initialized():
+        pyprt.initialize_prt()
 
-    for feature in feature_set.features:
-        try:
-            geo = Geometry(feature.geometry)
-
-            if geo.type == 'Polygon' and (not geo.is_empty):
-                pts_cnt = 0
-                vert_coord_list = []
-                face_count_list = []
-                holes_ind_list = []
-                coord_list = geo.coordinates()
-
-                for face_idx, coord_part in enumerate(coord_list):
-                    if isinstance(coord_part, np.ndarray):
-                        in_geo = Geometry({"rings": [coord_part.tolist()]})
-                    else:
-                        in_geo = Geometry({"rings": [coord_part]})
-                    store_area = in_geo.area
-                    coord_remove_last = coord_part[:-1]
-                    coord_inverse = np.flip(coord_remove_last, axis=0)
-                    coord_inverse[:, 1] *= -1
-
-                    if len(coord_part[0]) == 2:
-                        if len(z_list) > f:
-                            z_value = z_list[f] * unit_factor
-                        else:
-                            z_value = 0
-
-                        coord_fin = add_dimension(coord_inverse, z_value)
-
-                    elif len(coord_part[0]) == 3:
-                        coord_fin = swap_yz_dimensions(coord_inverse)
-                    else:
-                        arcpy.AddMessage("Only 2D or 3D points are supported.")
-
-                    vert_coord_list.extend(coord_fin[0])
-                    nb_pts = len(coord_fin[0]) / 3
-                    pts_cnt += nb_pts
-                    face_count_list.append(int(nb_pts))
-                    if store_area > 0.0:  # interior ring / holes
-                        holes_ind_list.append(face_idx)
-
-                face_indices_list = list(range(0, sum(face_count_list)))
-                holes_list = holes_conversion(holes_ind_list)
-
-                # initial_geometry = pyprt.InitialShape(vert_coord_list, face_indices_list, face_count_list, holes_list)
-                # initial_geometries.append(initial_geometry)
-
-                feature_attrs = feature.attributes
-
-                # get rid of None values
-                for key, value in feature_attrs.items():
-                    if not value:
-                        feature_attrs[key] = 'None'
-
-                # get Height attribute from pole feature layer
-                if feature_attrs['attachid']:
-                    if not 'None' in str(feature_attrs['attachid']):
-                        pole_height = get_value_from_dataframe(sdf, 'assetid', feature_attrs['attachid'], 'height')
-
-                        if A3D_common_lib.is_number(pole_height):
-                            # rename and type setting to fit with CGA rule attributes
-                            feature_attrs['Height'] = float(pole_height)
-                        else:
-                            feature_attrs['Height'] = 10
-                    else:
-                        feature_attrs['Height'] = 10
-                else:
-                    feature_attrs['Height'] = 10
+    initial_shapes = [pyprt.InitialShape(*buffers) for buffers in shape_buffers]
+    model_generator = pyprt.ModelGenerator(initial_shapes)
+    model_generator.generate_model(attrs_list, rpk_path, 'com.esri.prt.codecs.I3SEncoder', enc_options)
 
-                # rename and type setting to fit with CGA rule attributes
-                feature_attrs['DirectionMethod'] = 'Degree'
+    return os.path.join(enc_options['outputPath'], enc_options['baseName'] + '.slpk')
 
-                if feature_attrs['angle']:
-                    if not 'None' in str(feature_attrs['angle']):
-                        feature_attrs['DirectionDegrees'] = float(feature_attrs['angle'])
-                    else:
-                        feature_attrs['DirectionDegrees'] = float(0)
-                else:
-                    feature_attrs['DirectionDegrees'] = float(0)
-
-                feature_attrs['SIGNSTYLE'] = str(feature_attrs['style'])
-                feature_attrs['SIGNTEXT'] = str(feature_attrs['text'])
-                feature_attrs['signUnits'] = object_units
-                feature_attrs['DISTTOTOP'] = str(feature_attrs['disttotop'])
-                feature_attrs['SIGNHEIGHT'] = str(feature_attrs['height'])
-                feature_attrs['SIGNWIDTH'] = str(feature_attrs['width'])
-                feature_attrs['ASSETID'] = str(feature_attrs['assetid'])
-                feature_attrs['SHAPE'] = str(feature_attrs['SHAPE'])
-
-                # the style atrribute has the domain code value, we need the domain name value,
-                # if not found leave default value
-                if name_domain_dict:
-                    domain_name = get_domain_name(feature_attrs[name_domain_dict['field_name']],
-                                                  name_domain_dict['domain'])
-
-                    if domain_name:
-                        feature_attrs['SIGNSTYLE'] = domain_name
-
-                attrs_list.append(feature_attrs)
-            else:
-                arcpy.AddMessage("Only polygon features are supported.")
 
-            f += 1
+def get_process_pool(max_workers):
+    import multiprocessing
+    import sys
+    from concurrent.futures import ProcessPoolExecutor
 
-        except:
-            arcpy.AddMessage("This feature is not valid: ")
+    # inside ArcGIS Pro sys.executable is the application, workers must start the python interpreter
+    if not os.path.basename(sys.executable).lower().startswith('python'):
+        python_exe = os.path.join(sys.exec_prefix, 'python.exe')
+        if os.path.exists(python_exe):
+            multiprocessing.set_executable(python_exe)
 
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
 
-            f += 1
 
-    return initial_geometries, attrs_list
+def generate_slpks(shape_buffers, attrs_list, rpk_path, enc_options, shard_size=None, max_workers=None):
+    """generate_slpks(shape_buffers, attrs_list, rpk_path, enc_options) -> List[str]
+    Splits the initial shapes into shards of shard_size and generates one SLPK per shard. Shards are generated
+    in parallel worker processes, each with its own PRT instance.
+    Parameters:
+        shape_buffers: list of InitialShape buffers
+        attrs_list: list of rule attributes, one per shape
+        rpk_path: path of the rule package
+        enc_options: I3S encoder options, baseName gets a _<n> postfix when there is more than one shard
+        shard_size: number of initial shapes per SLPK
+        max_workers: number of worker processes
+    Returns:
+        list of slpk file paths
+    """
+    shard_size = int(shard_size or PRT_SHARD_SIZE)
+    max_workers = int(max_workers or PRT_WORKERS)
+    num_shards = max(1, int(np.ceil(len(shape_buffers) / shard_size)))
+
+    shards = list()
+    for n in range(num_shards):
+        start = n * shard_size
+        options = dict(enc_options)
+        if num_shards > 1:
+            options['baseName'] = enc_options['baseName'] + "_" + str(n + 1)
+        shards.append((shape_buffers[start:start + shard_size], attrs_list[start:start + shard_size],
+                       rpk_path, options))
+
+    if num_shards == 1 or max_workers == 1:
+        slpk_filepaths = list()
+        for shard in shards:
+            slpk_filepaths.append(generate_slpk_shard(shard))
+            arcpy.AddMessage("Generated " + str(len(slpk_filepaths)) + " of " + str(num_shards) + " slpk files...")
+        return slpk_filepaths
+
+    arcpy.AddMessage("Generating " + str(num_shards) + " slpk files with " +
+                     str(min(max_workers, num_shards)) + " worker processes...")
+
+    with get_process_pool(min(max_workers, num_shards)) as executor:
+        return list(executor.map(generate_slpk_shard, shards))
 
 
 # end of functions for PyPRT
@@ -251,9 +406,9 @@ def get_pole_sdf(layer_info):
     return sdf
 
 
-# create scene layer package from input item
+# create scene layer packages from input item, one per shard of PRT_SHARD_SIZE signs
 def create_sign_slpk(global_info, layer_info, sign_attrs):
-    slpk_filepath = None
+    slpk_filepaths = list()
     z_list = list()
 
     spatial_info = A3D_common_lib.get_spatial_info_from_service_url(layer_info.url)
@@ -280,8 +435,10 @@ def create_sign_slpk(global_info, layer_info, sign_attrs):
                           "vices/WorldElevation/Terrain/ImageServer/getSamples"
                     elevation_unit = 'meter'
                     arcpy.AddMessage("Retrieving elevation for input points.")
-                    new_vertex_list, z_list = A3D_common_lib.z_values_from_elevation_service(global_info.token,
-                                                                                             url, geometry_dict)
+                    new_vertex_list, z_list = A3D_common_lib.z_values_from_elevation_service(
+                        global_info.token, url, geometry_dict, dtm_raster=global_info.dtm_raster)
+                    if z_list is None:
+                        raise Exception("Could not get elevations for the street signs.")
 
                     # buffer features
                     arcpy.AddMessage("Buffering features...")
@@ -314,12 +471,12 @@ def create_sign_slpk(global_info, layer_info, sign_attrs):
     if (not pyprt.is_prt_initialized()):
         raise Exception("PRT is not initialized")
 
-    initial_geometries_from_set, attrs_list_from_set = arcgis_to_pyprtDevelop(buffered_fs, z_list,
-                                                                              conv_factor,
-                                                                              global_info.object_units,
-                                                                              layer_info, pole_sdf)
+    shape_buffers, attrs_list_from_set = arcgis_to_pyprt_buffers(buffered_fs, z_list,
+                                                                 conv_factor,
+                                                                 global_info.object_units,
+                                                                 layer_info, pole_sdf)
 
-    arcpy.AddMessage("Created " + str(len(initial_geometries_from_set)) + " initial geometries...")
+    arcpy.AddMessage("Created " + str(len(shape_buffers)) + " initial geometries...")
     arcpy.AddMessage("Created " + str(len(attrs_list_from_set)) + " attributes dictionaries...")
 
     # generate model and slpk
@@ -342,9 +499,10 @@ def create_sign_slpk(global_info, layer_info, sign_attrs):
             'layerTextureMaxDimension': [2048],
             'layerFeatureGranularity': ['0'],
             'layerBackfaceCulling': [False],
-            'outputPath': os.path.join(os.getcwd(), 'home', 'PyPRT_output1')}
+            'outputPath': os.path.join(os.getcwd(), 'home', 'PyPRT_output1', export_file_name)}
 
-        # delete any existing output and create new directory to output
+        # delete any existing output and create new directory to output, one per layer so
+        # layers converted side by side don't remove each other's output
         import shutil
         if os.path.exists(enc_optionsSLPK['outputPath']):
             shutil.rmtree(enc_optionsSLPK['outputPath'])
@@ -352,16 +510,15 @@ def create_sign_slpk(global_info, layer_info, sign_attrs):
         os.makedirs(enc_optionsSLPK['outputPath'])
         arcpy.AddMessage("SLPK output location: " + enc_optionsSLPK['outputPath'])
 
-        mod_parcel = pyprt.ModelGenerator(initial_geometries_from_set)
-        generated_parks = mod_parcel.generate_model(
-            attrs_list_from_set, rpk.download(), 'com.esri.prt.codecs.I3SEncoder', enc_optionsSLPK)
+        # large layers are split over several slpk files generated in worker processes
+        slpk_filepaths = generate_slpks(shape_buffers, attrs_list_from_set, rpk.download(), enc_optionsSLPK)
 
-        slpk_filepath = os.path.join(enc_optionsSLPK['outputPath'], export_file_name + '.slpk')
-        arcpy.AddMessage("SLPK output: " + slpk_filepath)
+        for slpk_filepath in slpk_filepaths:
+            arcpy.AddMessage("SLPK output: " + slpk_filepath)
     else:
         arcpy.AddMessage("Could not find rpk: " + global_info.rpk_id + " No geometries created.")
 
-    return slpk_filepath
+    return slpk_filepaths
 
 
 # convert point feature layer into sign scene layer
@@ -375,10 +532,11 @@ def convert_point_layer_to_sign_layer(global_info, layer_info, sign_attrs):
     # success = delete_associated_scene_items(global_info, layer_info)
 
     arcpy.AddMessage("Creating street sign slpk...")
-    # slpk = create_sign_slpk(global_info, layer_info, sign_attrs)
+    # slpk_list = create_sign_slpk(global_info, layer_info, sign_attrs)
 
     arcpy.AddMessage("Publishing street sign slpk...")
-    # published_item = publish_slpk(global_info, slpk, global_info.input_item_info.item_folder)
+    # published_items = [publish_slpk(global_info, slpk, global_info.input_item_info.item_folder)
+    #                    for slpk in slpk_list]
 
     gis_org = global_info.gis
     global_info.input_item_id = '91295fdc7ce746c2b17a2fb9415ecf0f'
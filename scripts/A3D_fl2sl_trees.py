@@ -768,6 +768,7 @@ def set_tree_style_on_layer(token, url, item_id, folder, units, tree_attrs):
 
         json_response = urllib.request.urlopen(update_url, urllib.parse.urlencode(update_dict).encode("utf-8"))
         response = json.loads(json_response.read())
+        A3D_common_lib.metadata_cache.invalidate(item_id)
 
         if response:
             try:
@@ -789,6 +790,17 @@ def set_tree_style_on_layer(token, url, item_id, folder, units, tree_attrs):
 
 # convert point feature layer into tree scene layer
 def convert_point_layer_to_tree_layer(global_info, layer_info, tree_attrs):
+    return A3D_common_lib.run_job_steps([convert_point_layer_to_tree_layer_steps(global_info,
+                                                                                 layer_info,
+                                                                                 tree_attrs)])[0]
+
+
+def convert_point_layer_to_tree_layer_steps(global_info, layer_info, tree_attrs):
+    '''
+        converts the point layer to a tree scene layer, yielding the publish and cache rebuild jobs,
+        see A3D_common_lib.run_job_steps
+        :return: layer info list of the scene layer, None if failed
+    '''
     arcpy.AddMessage("Processing '" + layer_info.title + "' for 3D tree display.")
 
     global_info.unique_tag = "(web_style_trees)"
@@ -824,10 +836,11 @@ def convert_point_layer_to_tree_layer(global_info, layer_info, tree_attrs):
 
                     # create scene service
                     arcpy.AddMessage("Creating scene layer for " + layer_info.title + "...")
-                    related_item_id, related_item_url = A3D_fl2sl.publish_scene_layer(global_info,
-                                                                                      view_layer_id,
-                                                                                      layer_info.title,
-                                                                                      False)
+                    related_item_id, related_item_url = yield from A3D_fl2sl.publish_scene_layer_steps(
+                        global_info,
+                        view_layer_id,
+                        layer_info.title,
+                        False)
             else:
                 max_layers = 1
 
@@ -838,10 +851,11 @@ def convert_point_layer_to_tree_layer(global_info, layer_info, tree_attrs):
 
                     # create scene service
                     arcpy.AddMessage("Creating scene layer for " + layer_info.title + "...")
-                    related_item_id, related_item_url = A3D_fl2sl.publish_scene_layer(global_info,
-                                                                                      layer_info.item_id,
-                                                                                      layer_info.title,
-                                                                                      False)
+                    related_item_id, related_item_url = yield from A3D_fl2sl.publish_scene_layer_steps(
+                        global_info,
+                        layer_info.item_id,
+                        layer_info.title,
+                        False)
                 else:
                     related_item_id = None
                     arcpy.AddMessage("Layer: '" +
@@ -865,9 +879,14 @@ def convert_point_layer_to_tree_layer(global_info, layer_info, tree_attrs):
 
         # check job status
         if job_id:
-            status = A3D_common_lib.check_job_status(token=global_info.token,
-                                                     url=related_item_url,
-                                                     job_id=job_id)
+            arcpy.AddMessage("Status: starting cache rebuild.")
+            print("Status: starting cache rebuild.")
+
+            status = yield A3D_common_lib.server_job_status_job(global_info.token, related_item_url, job_id)
+
+            if status.lower() == 'failed':
+                raise Exception("Cache rebuild failed!")
+
             if status.lower() == 'completed':
                 # set tree style
                 arcpy.AddMessage("Updating rendering for scene layer of " + layer_info.title + "...")
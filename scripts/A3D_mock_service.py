@@ -0,0 +1,232 @@
+# Local stand-in for an ArcGIS feature service, used to exercise and benchmark the A3D REST helpers
+# without a portal. Start it with MockFeatureService(features, ...) and use .url as the feature layer url.
+import json
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_FIELDS = [
+    {"name": "OBJECTID", "type": "esriFieldTypeOID", "alias": "OBJECTID"},
+    {"name": "height", "type": "esriFieldTypeDouble", "alias": "height"},
+    {"name": "name", "type": "esriFieldTypeString", "alias": "name", "length": 256}
+]
+
+
+def make_point_features(count, has_z=False):
+    '''
+        creates count point features on a grid, with the DEFAULT_FIELDS attributes
+    '''
+    features = list()
+    for i in range(1, count + 1):
+        geometry = {"x": float(i % 1000), "y": float(i // 1000)}
+        if has_z:
+            geometry["z"] = float(i % 50)
+        features.append({"attributes": {"OBJECTID": i, "height": float(i % 30), "name": "feature " + str(i)},
+                         "geometry": geometry})
+    return features
+
+
+def make_polygon_features(count):
+    '''
+        creates count square polygon features on a grid, with the DEFAULT_FIELDS attributes
+    '''
+    features = list()
+    for i in range(1, count + 1):
+        x, y = float(i % 1000) * 10, float(i // 1000) * 10
+        ring = [[x, y], [x, y + 5], [x + 5, y + 5], [x + 5, y], [x, y]]
+        features.append({"attributes": {"OBJECTID": i, "height": float(i % 30), "name": "feature " + str(i)},
+                         "geometry": {"rings": [ring]}})
+    return features
+
+
+class MockFeatureService(object):
+    '''
+        serves a single feature layer at <url> with query and layer info endpoints
+        usage:
+            with MockFeatureService(make_point_features(10000)) as service:
+                table = A3D_common_lib.download_features_paged(service.url, token=None)
+    '''
+
+    def __init__(self, features, geometry_type='esriGeometryPoint', fields=None, max_record_count=2000,
+                 wkid=3857, has_z=False, job_polls=3):
+        self.features = features
+        self.geometry_type = geometry_type
+        self.fields = fields or DEFAULT_FIELDS
+        self.max_record_count = max_record_count
+        self.wkid = wkid
+        self.has_z = has_z
+        self.object_id_field_name = next(f["name"] for f in self.fields if f["type"] == "esriFieldTypeOID")
+        self.job_polls = job_polls
+        self.job_status = dict()
+        self.requests = list()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def elevation_url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/arcgis/rest/services/mock/ImageServer/getSamples".format(host, port)
+
+    @property
+    def content_url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/sharing/rest/content/users/mock".format(host, port)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/arcgis/rest/services/mock/FeatureServer/0".format(host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                parsed = urllib.parse.urlparse(self.path)
+                self.respond(parsed.path, dict(urllib.parse.parse_qsl(parsed.query)))
+
+            def do_POST(self):
+                parsed = urllib.parse.urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+                self.respond(parsed.path, params)
+
+            def respond(self, path, params):
+                with service._lock:
+                    service.requests.append((path, params))
+                body = json.dumps(service.handle(path, params)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def handle(self, path, params):
+        if path.endswith('/FeatureServer/0'):
+            return self.layer_info()
+        if path.endswith('/query'):
+            return self.query(params)
+        if path.endswith('/applyEdits'):
+            return self.apply_edits(params)
+        if path.endswith('/ImageServer'):
+            return {"name": "mock elevation", "maxRecordCount": self.max_record_count}
+        if path.endswith('/getSamples'):
+            return self.get_samples(params)
+        if path.endswith('/status') or '/jobs/' in path:
+            return self.poll_job(path, params)
+        return {"error": {"code": 400, "message": "Unsupported path " + path}}
+
+    def layer_info(self):
+        return {
+            "id": 0,
+            "name": "mock",
+            "type": "Feature Layer",
+            "geometryType": self.geometry_type,
+            "objectIdField": self.object_id_field_name,
+            "maxRecordCount": self.max_record_count,
+            "hasZ": self.has_z,
+            "fields": self.fields
+        }
+
+    def select(self, where):
+        if not where or where.strip() == '1=1':
+            return self.features
+
+        # only object id ranges are supported: OID >= a AND OID <= b
+        match = re.match(r'\s*(\w+)\s*>=\s*(-?\d+)\s+AND\s+\w+\s*<=\s*(-?\d+)\s*$', where, re.IGNORECASE)
+        if not match:
+            raise ValueError("Unsupported where clause " + where)
+        field, low, high = match.group(1), int(match.group(2)), int(match.group(3))
+        return [f for f in self.features if low <= f["attributes"][field] <= high]
+
+    def query(self, params):
+        try:
+            selected = self.select(params.get('where'))
+        except ValueError as e:
+            return {"error": {"code": 400, "message": str(e)}}
+
+        if params.get('returnIdsOnly') == 'true':
+            return {"objectIdFieldName": self.object_id_field_name,
+                    "objectIds": [f["attributes"][self.object_id_field_name] for f in selected]}
+
+        if params.get('returnCountOnly') == 'true':
+            return {"count": len(selected)}
+
+        page = selected[:self.max_record_count]
+        return {
+            "objectIdFieldName": self.object_id_field_name,
+            "geometryType": self.geometry_type,
+            "spatialReference": {"wkid": self.wkid, "latestWkid": self.wkid},
+            "hasZ": self.has_z and params.get('returnZ') == 'true',
+            "fields": self.fields,
+            "features": page,
+            "exceededTransferLimit": len(selected) > len(page)
+        }
+
+    def apply_edits(self, params):
+        '''
+            adds features, features without geometry are rejected
+        '''
+        adds = json.loads(params.get('adds') or '[]')
+        rollback = params.get('rollbackOnFailure', 'true') == 'true'
+        valid = [bool(f.get('geometry')) for f in adds]
+
+        if rollback and not all(valid):
+            return {"addResults": [{"success": False,
+                                    "error": {"code": 1000, "description": "Rolled back"}} for _ in adds]}
+
+        results = list()
+        with self._lock:
+            next_id = max([f["attributes"][self.object_id_field_name] for f in self.features] or [0]) + 1
+            for feature, is_valid in zip(adds, valid):
+                if not is_valid:
+                    results.append({"success": False, "error": {"code": 1000, "description": "Missing geometry"}})
+                    continue
+                feature.setdefault("attributes", dict())[self.object_id_field_name] = next_id
+                self.features.append(feature)
+                results.append({"objectId": next_id, "success": True})
+                next_id += 1
+        return {"addResults": results}
+
+    def poll_job(self, path, params):
+        '''
+            item status and server jobs complete after job_polls requests, jobs with 'fail' in the id fail
+        '''
+        job_id = params.get('jobId') or path.rsplit('/', 1)[-1]
+        with self._lock:
+            polls = self.job_status[job_id] = self.job_status.get(job_id, 0) + 1
+        if polls < self.job_polls:
+            return {"status": "processing", "jobId": job_id}
+        return {"status": "failed" if 'fail' in job_id else "completed", "jobId": job_id}
+
+    def get_samples(self, params):
+        '''
+            elevation of a point is x + y
+        '''
+        points = json.loads(params.get('geometry') or '{}').get('points') or list()
+        if len(points) > self.max_record_count:
+            return {"error": {"code": 400, "message": "Too many points"}}
+        return {"samples": [{"location": {"x": x, "y": y}, "locationId": i, "value": str(x + y)}
+                            for i, (x, y) in enumerate(p[:2] for p in points)]}
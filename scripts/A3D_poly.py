@@ -703,7 +703,7 @@ def get_item_3D(global_info, layer_info, layer_item_info, lyr_properties):
 
                         spatial_info = A3D_common_lib.get_spatial_info_from_service_url(layer_info.url)
                         spatial_info.service_url = layer_item_info.item.url
-                        source_fields = spatial_info.fs_dict.get('fields')
+                        source_fields = spatial_info.to_table().fields
                         remove_fields_list = list()
 
                         # check if we can make levels
@@ -827,6 +827,15 @@ def get_layer_info_from_webmap(webmap_item):
     web_map_obj = arcgis.mapping.WebMap(webmap_item)
     map_ops_layers = web_map_obj.layers
 
+    # load the layer properties of the whole map side by side before walking it
+    layer_urls = list()
+    for map_layer in map_ops_layers:
+        if map_layer.layerType == 'GroupLayer':
+            layer_urls.extend(getattr(sub_layer, 'url', None) for sub_layer in map_layer.layers)
+        else:
+            layer_urls.append(getattr(map_layer, 'url', None))
+    A3D_common_lib.prefetch_layer_properties(layer_urls)
+
     for map_layer in map_ops_layers:
         layer_info = A3D_common_lib.LayerInfo()
         layer_info.layer_id = map_layer.id
@@ -1,4 +1,5 @@
 import arcgis
+import scripts.A3D_common_lib as A3D_common_lib
 
 ERROR = "error"
 
@@ -49,18 +50,37 @@ def select_map_scene_by_title(web_objs, title):
         return None
 
 
+def search_portal_items(gis, item_type):
+    '''
+        searches the organization for all items of item_type, identical searches share one request
+        and the result is kept in the metadata cache for a short while
+    '''
+    key = ('search', A3D_common_lib.gis_fingerprint(gis), item_type)
+
+    return A3D_common_lib.metadata_cache.get(key, lambda: gis.content.search(query="*", item_type=item_type,
+                                                                              outside_org=False, max_items=-1))
+
+
 def get_mesh_layers_from_web_scene(gis, web_scene_obj):
 
     mesh_list = list()
 
     if web_scene_obj:
-        scene_item = gis.content.get(str(web_scene_obj.id))
+        key = ('mesh_layers', A3D_common_lib.gis_fingerprint(gis), str(web_scene_obj.id))
+        mesh_list = list(A3D_common_lib.metadata_cache.get(key, lambda: read_mesh_layers(gis, web_scene_obj)))
+
+    return mesh_list
 
-        # get layer resource entry
-        web_scene = arcgis.mapping.WebScene(scene_item)
-        for layer in web_scene['operationalLayers']:
-            if layer['layerType'] == 'IntegratedMeshLayer':
-                mesh_list.append(layer['title'])
+
+def read_mesh_layers(gis, web_scene_obj):
+    mesh_list = list()
+    scene_item = gis.content.get(str(web_scene_obj.id))
+
+    # get layer resource entry
+    web_scene = arcgis.mapping.WebScene(scene_item)
+    for layer in web_scene['operationalLayers']:
+        if layer['layerType'] == 'IntegratedMeshLayer':
+            mesh_list.append(layer['title'])
 
     return mesh_list
 
@@ -68,7 +88,7 @@ def get_mesh_layers_from_web_scene(gis, web_scene_obj):
 def get_mesh_web_scenes(gis, org_id, username, layer_type):
     web_scene_obj_list = list()
 
-    search_result = gis.content.search(query="*", item_type='Web Scene', outside_org=False, max_items=-1)
+    search_result = search_portal_items(gis, 'Web Scene')
 
     for web_scene_item in search_result:
         scene_prop = SceneProperties(web_scene_item.title,
@@ -82,7 +102,7 @@ def get_mesh_web_scenes(gis, org_id, username, layer_type):
 def get_web_maps(gis, org_id, username):
     web_map_obj_list = list()
 
-    search_result = gis.content.search(query="*", item_type='Web Map', outside_org=False, max_items=-1)
+    search_result = search_portal_items(gis, 'Web Map')
 
     for web_map_item in search_result:
         scene_prop = MapProperties(web_map_item.title,
@@ -96,7 +116,7 @@ def get_web_maps(gis, org_id, username):
 def get_web_scenes(gis, org_id, username):
     web_scene_obj_list = list()
 
-    search_result = gis.content.search(query="*", item_type='Web Scene', outside_org=False, max_items=-1)
+    search_result = search_portal_items(gis, 'Web Scene')
 
     for web_scene_item in search_result:
         scene_prop = SceneProperties(web_scene_item.title,
@@ -107,6 +127,12 @@ def get_web_scenes(gis, org_id, username):
     return web_scene_obj_list
 
 
+def get_web_maps_and_scenes(gis, org_id, username):
+    '''
+        runs the web map and web scene searches side by side
+        :return: list of MapProperties, list of SceneProperties
+    '''
+    web_map_obj_list, web_scene_obj_list = A3D_common_lib.run_concurrently([(get_web_maps, (gis, org_id, username)),
+                                                                            (get_web_scenes, (gis, org_id, username))])
 
-
-
+    return web_map_obj_list or list(), web_scene_obj_list or list()
@@ -314,6 +314,9 @@ def get_parameter_info_add_webmap_to_webscene(tool_label):
     previous_scene = parameter("Previous Scene", "PreviousScene", "GPString",
                                "Optional", "Input", False, None, False, None)
 
+    dtm_raster = parameter("Elevation Raster (optional)", "ElevationRaster", "GPRasterLayer",
+                           "Optional", "Input", False, None, True, None)
+
     offset.value = 0
 
     extrusion_unit.filter.list = ["Meters", "Feet", 'Centimeters', 'Inches']
@@ -325,8 +328,9 @@ def get_parameter_info_add_webmap_to_webscene(tool_label):
         gis = GIS("pro")
         map_list = list()
 
-        # get list of web maps
-        web_map_objs = bm_layer_lib.get_web_maps(gis, gis.properties.id, [gis.users.me.username])
+        # get list of web maps and web scenes
+        web_map_objs, web_scene_objs = bm_layer_lib.get_web_maps_and_scenes(gis, gis.properties.id,
+                                                                            [gis.users.me.username])
         for wm in web_map_objs:
             webmap_name = wm.title + " (id: " + wm.id + ")"
             map_list.append(webmap_name)
@@ -335,15 +339,13 @@ def get_parameter_info_add_webmap_to_webscene(tool_label):
 
         scene_list = list()
 
-        # get list of web maps
-        web_scene_objs = bm_layer_lib.get_web_scenes(gis, gis.properties.id, [gis.users.me.username])
         for ws in web_scene_objs:
             webscene_name = ws.title + " (id: " + ws.id + ")"
             scene_list.append(webscene_name)
 
         web_scenes.filter.list = sorted(scene_list)
 
-    params = [web_maps, web_scenes, extrusion_unit, offset, previous_map, previous_scene]
+    params = [web_maps, web_scenes, extrusion_unit, offset, previous_map, previous_scene, dtm_raster]
     return params
 
 
@@ -371,7 +373,7 @@ def execute_add_webmap_to_webscene(parameters, tool):
 
     try:
         """The source code of the tool."""
-        (web_maps, web_scenes, extrusion_unit, offset, previous_map, previous_scene) = \
+        (web_maps, web_scenes, extrusion_unit, offset, previous_map, previous_scene, dtm_raster) = \
             [p.valueAsText for p in parameters]
 
         pro_version = arcpy.GetInstallInfo()['Version']
@@ -412,7 +414,8 @@ def execute_add_webmap_to_webscene(parameters, tool):
                                         units=extrusion_unit,
                                         scene_service_item_id=input_scene_service_item_id,
                                         fixed_layer_id=fixed_layer_id,
-                                        offset=offset)
+                                        offset=offset,
+                                        dtm_raster=dtm_raster)
 
     except ProVersionRequired:
         print("This functionality requires ArcGIS Pro 2.7 or higher")
@@ -1,9 +1,23 @@
+import functools
+import hashlib
+import itertools
+import logging
 import os
-from typing import Tuple, List
+from typing import Dict, Iterable, Iterator, Tuple, List
 
 import arcpy
+import numpy as np
 import pandas as pd
 
+from scripts_ddd import settings
+
+logger = logging.getLogger(__name__)
+
+# Number of rows held in memory at once when streaming cursors.
+CHUNK_SIZE = 100000
+# Text fields can be declared up to ~1e9 characters, fixed width columns are sized from the data above this width.
+MAX_TEXT_WIDTH = 4096
+
 
 def count_cursor(cursor):
     counts = 0
@@ -173,36 +187,85 @@ def get_absolute_path_from_relative(item: str):
         path = os.path.join(arcpy.env.workspace, item)
 
     return os.path.abspath(path)
-def change_dtypes(record_array):
-    import numpy as np
-    dt = record_array.dtype
-    dt = dt.descr # this is now a modifiable list, can't modify numpy.dtype
-    for i,dtype in enumerate(dt):
-        if "O" in dtype[1]:
-
-            # get the len of the longest string in this column
-            # get the records
-            ar =  record_array[dtype[0]]
-            #Filter out none and nan
-            ix = np.isin(ar, [None,np.nan])
-            #set the None to empty string
-            ar[ix] = ''
-            max_len = 256
-            if len(ar) != 0:
-                max_len = len(max(ar,key=len))
-            new_type = f'<U{max_len}'
-            dt[i] = (dt[i][0], new_type)
-            record_array[dtype[0]] = ar
-    dt = np.dtype(dt)
-    # data = numpy.array(data, dtype=dt) # option 1
-    return record_array.astype(dt)
-
-def df_to_cursor(data_frame: pd.DataFrame, cursor):
+def _text_field_lengths(source_table: str) -> Tuple[Tuple[str, int], ...]:
+    """ The (lower case name, length) of every text field of a table, which is the part of the schema dtypes use """
+    return tuple(sorted((f.name.lower(), f.length) for f in arcpy.ListFields(source_table) if f.type == 'String'))
+
+
+@functools.lru_cache(maxsize=128)
+def _schema_widths(text_lengths: Tuple[Tuple[str, int], ...], dtype) -> Tuple[int, ...]:
+    """ Derives the text widths of the object columns of dtype from the text field lengths of its source table.
+
+        Cached per schema and input dtype, so a table whose fields change gets new widths. A width is ``None`` when the
+        column has no matching text field or the field is wider than ``MAX_TEXT_WIDTH``; those are measured instead.
+    """
+    lengths = dict(text_lengths)
+    widths = []
+    for name, *field_type in dtype.descr:
+        length = lengths.get(name.lower()) if 'O' in field_type[0] else None
+        widths.append(max(length, 1) if length is not None and length <= MAX_TEXT_WIDTH else None)
+    return tuple(widths)
+
+
+def _max_str_len(column) -> int:
+    """ Length of the longest string in an object column, ignoring None/nan """
+    if len(column) == 0:
+        return 256
+    lengths = pd.Series(column, copy=False).str.len()
+    return max(int(lengths.max()), 1) if lengths.notna().any() else 1
+
+
+def infer_dtype(record_array, source_table: str = None):
+    """Infers a dtype for record_array with every object column replaced by a fixed width unicode string.
+
+    Args:
+        record_array (numpy.ndarray): A structured array, eg from ``arcpy.da.FeatureClassToNumPyArray``.
+        source_table (str): The table the array was read from. When given, text widths come from the field
+            lengths instead of scanning the data, except for fields longer than ``MAX_TEXT_WIDTH``.
+            Defaults to ``None``.
+    """
+    widths = [None] * len(record_array.dtype.descr)
+    if source_table is not None:
+        widths = _schema_widths(_text_field_lengths(get_absolute_path_from_relative(source_table)),
+                               record_array.dtype)
+
+    descr = []
+    for (name, *field_type), width in zip(record_array.dtype.descr, widths):
+        if 'O' in field_type[0]:
+            field_type[0] = f'<U{width or _max_str_len(record_array[name])}'
+        descr.append((name, *field_type))
+    return np.dtype(descr)
+
+
+def change_dtypes(record_array, source_table: str = None):
+    """Converts object columns of a record array to unicode strings so it can be exported with NumPy tools.
+
+    None and nan values become empty strings. Columns are cast one at a time into the output, so only a single
+    column is copied on top of the output array. An array without object columns is returned as is.
+
+    Args:
+        record_array (numpy.ndarray): A structured array.
+        source_table (str): The table the array was read from, see :py:func:`infer_dtype`. Defaults to ``None``.
+    """
+    if not any(record_array.dtype[name] == object for name in record_array.dtype.names):
+        return record_array
+
+    dt = infer_dtype(record_array, source_table)
+    result = np.empty(record_array.shape, dtype=dt)
+    for name in dt.names:
+        column = record_array[name]
+        if column.dtype == object:
+            column = np.where(pd.isnull(column), '', column)
+        result[name] = column
+    return result
+
+def df_to_cursor(data_frame: pd.DataFrame, cursor, chunk_size: int = CHUNK_SIZE):
     """Inserts rows from data_frame to cursor
 
     Args:
         data_frame (pandas.DataFrame): A DataFrame. Only the subset of fields used by the cursor will be inserted.
         cursor (arcpy.da.InsertCursor): An opened insert cursor.
+        chunk_size (int): The number of rows converted to python values at a time. Defaults to ``CHUNK_SIZE``.
 
     """
 
@@ -217,8 +280,65 @@ def df_to_cursor(data_frame: pd.DataFrame, cursor):
     # Keep only those fields that are present in the cursor.
     data_frame = data_frame[cursor_fields]
 
-    for row in data_frame.itertuples(index=False, name=None):
-        cursor.insertRow(row)
+    # Converting whole columns with tolist() is much faster than itertuples and yields native python types.
+    for start in range(0, len(data_frame), chunk_size):
+        chunk = data_frame.iloc[start:start + chunk_size]
+        for row in zip(*(chunk[field].tolist() for field in cursor_fields)):
+            cursor.insertRow(row)
+
+
+def _shape_token(shape) -> str:
+    """ The insert cursor token for a geometry value, ``None`` for a null geometry """
+    if shape is None or isinstance(shape, float) and np.isnan(shape):
+        return None
+    return 'SHAPE@WKB' if isinstance(shape, (bytes, bytearray)) else 'SHAPE@'
+
+
+def df_chunks_to_table(chunks: Iterable[pd.DataFrame], table: str, fields: List[str] = None) -> int:
+    """Appends a stream of DataFrames to table, keeping one chunk in memory at a time.
+
+    Args:
+        chunks (iterable): DataFrames sharing the same columns, eg from :py:func:`read_table_chunks`.
+        table (str): The target.
+        fields (list): The fields to insert. Defaults to ``None`` which uses the columns of the first chunk.
+            A ``SHAPE@`` column may hold WKB bytes, which are written through the ``SHAPE@WKB`` token, and geometry
+            objects, eg to keep true curves, which are written through ``SHAPE@``. Column names are matched
+            case-insensitively and the chunks are not modified.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    fields = fields or first.columns.tolist()
+    shape_index = next((i for i, field in enumerate(fields) if field.upper() == 'SHAPE@'), None)
+
+    def column(chunk: pd.DataFrame, field: str) -> pd.Series:
+        return chunk[{c.lower(): c for c in chunk.columns}[field.lower()]]
+
+    def rows() -> Iterator[tuple]:
+        for chunk in itertools.chain([first], chunks):
+            yield from zip(*(column(chunk, field).tolist() for field in fields))
+
+    # Consecutive rows with the same kind of geometry share a cursor, null geometries go with the rows before them.
+    token = 'SHAPE@'
+
+    def row_token(row: tuple) -> str:
+        nonlocal token
+        if shape_index is not None:
+            token = _shape_token(row[shape_index]) or token
+        return token
+
+    count = 0
+    for run_token, run in itertools.groupby(rows(), key=row_token):
+        cursor_fields = [run_token if i == shape_index else field for i, field in enumerate(fields)]
+        with arcpy.da.InsertCursor(table, cursor_fields) as cursor:
+            for row in run:
+                cursor.insertRow(row)
+                count += 1
+    return count
 
 
 def df_to_table(data_frame: pd.DataFrame, table):
@@ -281,6 +401,78 @@ def cursor_to_df(cursor, header=None, has_blob=False):
     return pd.DataFrame.from_records(cursor, columns=header)
 
 
+def _to_bytes(value):
+    """ Converts geometries to WKB and blob memoryviews to bytes, so chunks do not hold arcpy objects """
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, arcpy.Geometry):
+        return bytes(value.WKB)
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return value
+
+
+def cursor_to_df_chunks(cursor, header=None, chunk_size: int = CHUNK_SIZE,
+                        dtypes: Dict[str, str] = None) -> Iterator[pd.DataFrame]:
+    """Reads a cursor in fixed-size batches of rows.
+
+        Args:
+            cursor (``arcpy.da.SearchCursor``): A cursor to iterate over.
+            header (list): The list of field names to use as header. Defaults to ``None`` which uses the field names as
+                reported by the cursor object.
+            chunk_size (int): The number of rows per DataFrame. Defaults to ``CHUNK_SIZE``.
+            dtypes (dict): Explicit dtypes per column name, so every chunk has the same schema regardless of the
+                values it happens to contain. Defaults to ``None``: let pandas infer them.
+        Yields:
+            pandas.DataFrame: At most chunk_size rows. Geometries and blobs are returned as bytes (WKB for geometry).
+        Raises:
+            ValueError: If the number of fields does not match the record length.
+        Examples:
+            >>> with arcpy.da.SearchCursor('data', ['OID@', 'SHAPE@WKB']) as cursor:
+            ...     for chunk in cursor_to_df_chunks(cursor, ['ID', 'SHAPE@'], dtypes={'ID': 'int32'}):
+            ...         process(chunk)
+    """
+    if header is None:
+        header = cursor.fields
+
+    if len(header) != len(cursor.fields):
+        raise ValueError('The length of header does not match the cursor.')
+
+    # Only convert the columns that can hold geometries or blobs, everything else is loaded directly.
+    convert = [i for i, field in enumerate(cursor.fields) if field.upper().startswith('SHAPE@')
+               and field.upper() not in ('SHAPE@X', 'SHAPE@Y', 'SHAPE@Z', 'SHAPE@M', 'SHAPE@XY', 'SHAPE@XYZ',
+                                         'SHAPE@LENGTH', 'SHAPE@AREA', 'SHAPE@JSON', 'SHAPE@TRUECENTROID')]
+
+    while True:
+        rows = list(itertools.islice(cursor, chunk_size))
+        if not rows:
+            break
+        df = pd.DataFrame.from_records(rows, columns=header)
+        del rows
+        for i in convert:
+            df[header[i]] = [_to_bytes(value) for value in df[header[i]]]
+        if dtypes:
+            df = df.astype(dtypes, copy=False)
+        yield df
+
+
+def read_table_chunks(table: str, field_names: List[str], where_clause: str = None,
+                      chunk_size: int = CHUNK_SIZE, dtypes: Dict[str, str] = None) -> Iterator[pd.DataFrame]:
+    """Streams a table or feature class as DataFrames of at most chunk_size rows.
+
+    ``SHAPE@`` is read with the ``SHAPE@WKB`` token so no geometry objects are created. The column keeps the
+    ``SHAPE@`` name and can be written back with :py:func:`df_chunks_to_table`.
+    """
+    cursor_fields = ['SHAPE@WKB' if f.upper() == 'SHAPE@' else f for f in field_names]
+    with arcpy.da.SearchCursor(table, cursor_fields, where_clause=where_clause) as cursor:
+        yield from cursor_to_df_chunks(cursor, header=field_names, chunk_size=chunk_size, dtypes=dtypes)
+
+
+def has_curves(shape_json: str) -> bool:
+    """ True when the esri JSON of a polyline or polygon has true curves """
+    return 'curvePaths' in shape_json or 'curveRings' in shape_json
+
+
 def densify_shape(shape: arcpy.Geometry, **kwargs) -> arcpy.Geometry:
     """
         Densifies the shape if it contains true curves. kwargs match shape.densify()
@@ -300,7 +492,7 @@ def densify_shape(shape: arcpy.Geometry, **kwargs) -> arcpy.Geometry:
                 deviation = 5
     """
 
-    if 'curvePaths' not in shape.JSON:
+    if not has_curves(shape.JSON):
         return shape
 
     is_projected = shape.spatialReference.type == 'Projected'
@@ -321,6 +513,167 @@ def densify_shape(shape: arcpy.Geometry, **kwargs) -> arcpy.Geometry:
     return shape.densify(method=method, distance=distance, deviation=deviation)
 
 
+class DensifyCache(object):
+    """
+    Persistent cache of densified true curve geometries.
+
+    Entries are keyed by OID, a hash of the source geometry JSON and the densify parameters, so an edited feature or
+    different parameters are densified again. The densified vertices are stored as flat X, Y, Z, M arrays with the
+    start index of each path or ring in a single ``.npz`` file which is loaded on creation and written by
+    :py:meth:`save`.
+
+    On save, entries of an OID that was densified again with another geometry or other parameters are dropped, and
+    the file is trimmed to max_shapes, dropping the shapes not used by this run first.
+
+    Examples:
+        >>> with DensifyCache(densify_cache_path(fc)) as cache:
+        ...     with arcpy.da.SearchCursor(fc, ['OID@', 'SHAPE@JSON']) as cursor:
+        ...         vertices = {oid: cache.vertices(oid, shape_json) for oid, shape_json in cursor}
+    """
+
+    def __init__(self, path: str = None, max_shapes: int = None):
+        self.path = path
+        self.max_shapes = settings.DENSIFY_CACHE_MAX_SHAPES if max_shapes is None else max_shapes
+        self.hits = 0
+        self.misses = 0
+        # key -> (vertices (n, 4) with nan Z and M when unknown, path or ring start indices)
+        self._entries = {}
+        # key -> OID of the shape, -1 when read from a cache written without OIDs
+        self._oids = {}
+        # keys read or added by this run
+        self._used = set()
+        self._dirty = False
+
+        if path and os.path.exists(path):
+            try:
+                data = np.load(path)
+                coords, offsets, parts = data['coords'], data['offsets'], data['parts']
+                if coords.shape[1:] != (4,):
+                    raise ValueError('cache written without M values')
+                keys = data['keys'].tolist()
+                oids = data['oids'].tolist() if 'oids' in data.files else [-1] * len(keys)
+                for i, key in enumerate(keys):
+                    start, end = offsets[i], offsets[i + 1]
+                    part_starts = parts[(parts >= start) & (parts < end)] - start
+                    self._entries[key] = (coords[start:end], part_starts)
+                    self._oids[key] = oids[i]
+            except (OSError, KeyError, ValueError):
+                logger.warning(f'Ignoring unreadable densify cache {path}')
+                self._entries = {}
+                self._oids = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.save()
+        self.report()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(oid: int, shape_json: str, **kwargs) -> str:
+        params = ','.join(f'{k}={kwargs[k]}' for k in sorted(kwargs))
+        return hashlib.sha1(f'{oid}|{params}|{shape_json}'.encode('utf-8')).hexdigest()
+
+    def vertices(self, oid: int, shape_json: str, **kwargs):
+        """Returns the densified X, Y, Z, M vertices and the start index of each path or ring.
+
+        Every ring of a polygon is a separate entry, inner rings included. kwargs match :py:func:`densify_shape`.
+        """
+        key = self.key(oid, shape_json, **kwargs)
+        self._used.add(key)
+        self._oids[key] = oid
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        shape = densify_shape(arcpy.AsShape(shape_json, True), **kwargs)
+        coords, ring_starts = [], []
+        for part in shape:
+            ring_starts.append(len(coords))
+            for p in part:
+                if p is None:
+                    # The inner rings of a polygon part follow a None separator.
+                    ring_starts.append(len(coords))
+                    continue
+                coords.append((p.X, p.Y, np.nan if p.Z is None else p.Z, np.nan if p.M is None else p.M))
+        entry = (np.array(coords, dtype=np.float64).reshape(-1, 4), np.array(ring_starts, dtype=np.int64))
+        self._entries[key] = entry
+        self._dirty = True
+        return entry
+
+    def densify(self, oid: int, shape: arcpy.Geometry, **kwargs) -> arcpy.Geometry:
+        """ Cached version of :py:func:`densify_shape` """
+        shape_json = shape.JSON
+        if not has_curves(shape_json):
+            return shape
+
+        coords, ring_starts = self.vertices(oid, shape_json, **kwargs)
+        has_z, has_m = shape.hasZ, shape.hasM
+        # Polygons are built from their rings, arcpy tells inner from outer rings by their orientation.
+        array = arcpy.Array()
+        for ring in np.split(coords, ring_starts[1:]):
+            array.add(arcpy.Array([arcpy.Point(x, y, z if has_z else None, m if has_m else None)
+                                   for x, y, z, m in ring.tolist()]))
+        geometry_type = arcpy.Polygon if shape.type == 'polygon' else arcpy.Polyline
+        return geometry_type(array, shape.spatialReference, has_z, has_m)
+
+    def evict(self):
+        """ Drops stale entries of re-densified OIDs, then the least recently used shapes above max_shapes """
+        used_oids = {self._oids[key] for key in self._used}
+        stale = [key for key in self._entries if key not in self._used and self._oids.get(key) in used_oids]
+
+        # Shapes used by this run move to the end, so trimming drops the ones unused for the most runs first.
+        used = [key for key in self._entries if key in self._used]
+        unused = [key for key in self._entries if key not in self._used and key not in stale]
+        keep = unused[max(len(unused) + len(used) - self.max_shapes, 0):] + used
+        if len(keep) == len(self._entries) and keep == list(self._entries):
+            return
+
+        self._entries = {key: self._entries[key] for key in keep}
+        self._oids = {key: self._oids[key] for key in keep}
+        self._dirty = True
+
+    def save(self):
+        """ Writes the cache to disk if anything was added or evicted """
+        if not self.path:
+            return
+        self.evict()
+        if not self._dirty:
+            return
+        keys = list(self._entries)
+        lengths = [len(self._entries[k][0]) for k in keys]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        coords = np.concatenate([self._entries[k][0] for k in keys]) if keys else np.empty((0, 4))
+        parts = (np.concatenate([self._entries[k][1] + offsets[i] for i, k in enumerate(keys)])
+                 if keys else np.empty(0, dtype=np.int64))
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # np.savez appends .npz when missing, so write through a file handle to keep the path as given.
+        with open(self.path, 'wb') as f:
+            np.savez(f, keys=np.array(keys, dtype='U40'), oids=np.array([self._oids[k] for k in keys], dtype=np.int64),
+                     offsets=offsets, coords=coords, parts=parts)
+        self._dirty = False
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            logger.info(f'Densify cache: {self.hits:,} hits, {self.misses:,} misses '
+                        f'({self.hits / total:.0%} reused, {len(self):,} cached shapes)')
+
+
+def densify_cache_path(dataset: str, folder: str = None) -> str:
+    """ Returns the densify cache file for a dataset. Defaults to settings.DENSIFY_CACHE_FOLDER or the scratch folder """
+    folder = folder or settings.DENSIFY_CACHE_FOLDER or arcpy.env.scratchFolder
+    catalog_path = arcpy_describe(dataset).catalogPath
+    return os.path.join(folder, f'densify_{hashlib.sha1(catalog_path.lower().encode("utf-8")).hexdigest()}.npz')
+
+
 def arcpy_describe(item):
     """ Returns item if already described, describes it if not """
     if isinstance(item, str):
@@ -1,8 +1,13 @@
 from scripts_ddd._common import *
+from scripts_ddd import settings
 import arcgisscripting
+import contextlib
+import datetime
 import functools
+import json
 import logging
 import sys
+import time
 import arcpy
 
 logger = logging.getLogger(__name__)
@@ -13,6 +18,129 @@ def log_version_info():
     logger.info(f'''ArcGIS Pro {".".join(get_pro_version())}''')
 
 
+def peak_rss() -> int:
+    """ Returns the peak resident memory of the process in bytes, or None if it can't be determined """
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        # peak_wset is only reported on Windows
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+class Span(object):
+    """ A named, timed stage of a tool. Spans nest to form the call tree of the tool run. """
+
+    def __init__(self, name: str, rows: int = None):
+        self.name = name
+        self.rows = rows
+        self.start = None
+        self.duration = None
+        self.peak_rss = None
+        self.children = []
+
+    def to_dict(self) -> dict:
+        return dict(name=self.name,
+                    start=self.start,
+                    duration=self.duration,
+                    rows=self.rows,
+                    peak_rss=self.peak_rss,
+                    children=[child.to_dict() for child in self.children])
+
+
+class Tracer(object):
+    """ Collects the spans of a single tool run and writes them as a JSON trace """
+
+    def __init__(self, name: str, cprofile: bool = False):
+        self.root = Span(name)
+        self.stack = [self.root]
+        self.created = datetime.datetime.now().isoformat(timespec='seconds')
+        self._origin = time.perf_counter()
+        self.profile = None
+        if cprofile:
+            import cProfile
+            self.profile = cProfile.Profile()
+
+    @contextlib.contextmanager
+    def span(self, name: str, rows: int = None):
+        item = Span(name, rows)
+        self.stack[-1].children.append(item)
+        self.stack.append(item)
+        item.start = time.perf_counter() - self._origin
+        try:
+            yield item
+        finally:
+            item.duration = time.perf_counter() - self._origin - item.start
+            item.peak_rss = peak_rss()
+            self.stack.pop()
+            logger.debug(f'{name}: {item.duration:.3f}s' + ('' if item.rows is None else f', {item.rows:,} rows'))
+
+    @contextlib.contextmanager
+    def run(self):
+        """ Times the root span (and optionally profiles) for the duration of the tool """
+        self._origin = time.perf_counter()
+        self.root.start = 0
+        if self.profile is not None:
+            self.profile.enable()
+        try:
+            yield self.root
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+            self.root.duration = time.perf_counter() - self._origin
+            self.root.peak_rss = peak_rss()
+
+    def write(self, folder: str) -> str:
+        """ Writes the trace (and cProfile stats) to folder, returns the path of the JSON trace """
+        os.makedirs(folder, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        path = os.path.join(folder, f'{self.root.name}_{stamp}.json')
+
+        trace = dict(tool=self.root.name, created=self.created, python=sys.version.split()[0])
+        try:
+            trace['pro_version'] = '.'.join(get_pro_version())
+        except Exception:
+            trace['pro_version'] = None
+
+        if self.profile is not None:
+            trace['cprofile'] = os.path.splitext(path)[0] + '.prof'
+            self.profile.dump_stats(trace['cprofile'])
+
+        trace['spans'] = self.root.to_dict()
+        with open(path, 'w') as f:
+            json.dump(trace, f, indent=2)
+        return path
+
+
+# The tracer of the tool currently running inside gp_wrapper.
+_tracer: Tracer = None
+
+
+@contextlib.contextmanager
+def span(name: str, rows: int = None):
+    """ Times a named stage of the running tool. Set ``rows`` on the yielded span to record the row count.
+
+        Examples:
+            >>> with span('Reading input features') as s:
+            ...     df = read()
+            ...     s.rows = len(df)
+    """
+    if _tracer is None:
+        # Outside of a traced tool the stage is only timed and logged.
+        tracer = Tracer(name)
+        with tracer.run(), tracer.span(name, rows) as item:
+            yield item
+    else:
+        with _tracer.span(name, rows) as item:
+            yield item
+
+
 def gp_wrapper(func):
     """Function decorator for geoprocessing tools"""
 
@@ -26,9 +154,18 @@ def gp_wrapper(func):
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        global _tracer
+        # Tools called from within another tool are recorded as a span of the outer trace.
+        outer = _tracer
+        tracer = Tracer(func.__qualname__, cprofile=settings.TRACE_CPROFILE) if outer is None else None
         try:
             write_call(func, kwargs)
-            return func(*args, **kwargs)
+            if outer is not None:
+                with outer.span(func.__qualname__):
+                    return func(*args, **kwargs)
+            _tracer = tracer
+            with tracer.run():
+                return func(*args, **kwargs)
 
         # TODO: can we hide the awful stack trace when a user cancels GP tool?
         except (arcgisscripting.ExecuteAbort, KeyboardInterrupt):
@@ -46,7 +183,12 @@ def gp_wrapper(func):
                 sys.exit(2)
 
         finally:
-            pass
+            _tracer = outer
+            if tracer is not None and settings.TRACE_FOLDER:
+                try:
+                    logger.info(f'Trace written to {tracer.write(settings.TRACE_FOLDER)}')
+                except OSError:
+                    logger.warning(f'Unable to write trace to {settings.TRACE_FOLDER}')
 
     return wrapper
 
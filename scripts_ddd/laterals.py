@@ -8,6 +8,8 @@ import numpy as np
 import pandas as pd
 
 from scripts_ddd._common import *
+from scripts_ddd import settings
+from scripts_ddd.helper import span
 from . import *
 
 
@@ -15,6 +17,12 @@ logger = logging.getLogger(__name__)
 
 
 class CalculateZBySlope(object):
+    """
+    Sets the Z of 2D laterals from the 3D line they connect to and a slope.
+
+    True curves are only densified when densify_curves is set. When a tool does not pass it, the DDD_DENSIFY_CURVES
+    environment variable (settings.DENSIFY_CURVES) turns it on.
+    """
     SCRATCH = 'in_memory'
     REMOVE_TEMP_DATASETS = True
 
@@ -31,7 +39,7 @@ class CalculateZBySlope(object):
                  lines_3d: str,
                  lines_2d: str,
                  slope_field: str = None, default_slope: float = None, slope_is_positive: bool = True,
-                 use_end_vertex: bool = True):
+                 use_end_vertex: bool = True, densify_curves: bool = None):
 
         self.lines_3d = lines_3d
         self.lines_2d = lines_2d
@@ -41,6 +49,7 @@ class CalculateZBySlope(object):
         self.use_end_vertex = use_end_vertex
         self.default_slope = default_slope or 0
         self.positive_slope = slope_is_positive
+        self.densify_curves = settings.DENSIFY_CURVES if densify_curves is None else densify_curves
 
         # Unique guid for each FC
         self.guid = f'_{uuid.uuid4().hex}'
@@ -59,64 +68,100 @@ class CalculateZBySlope(object):
         msg = 'Reading input features (1/6)'
         logger.debug(msg)
         arcpy.SetProgressorLabel(msg)
-
-        # Fields are optional, so initialize if not present
-        cursor_fields = [f for f in [self.slope_field]
-                         if f.lower() in
-                         {f.baseName.lower() for f in self.input_desc.fields}]
-
-        array = arcpy.da.FeatureClassToNumPyArray(in_table=self.lines_2d,
-                                                  field_names=['OID@', self.SHAPE_X, self.SHAPE_Y, *cursor_fields],
-                                                  where_clause=f'{self.input_desc.shapeFieldName} IS NOT null',
-                                                  explode_to_points=True)
-        df = pd.DataFrame(array)
-        if self.slope_field not in df:
-            df[self.slope_field] = self.default_slope
-
-        df.fillna({self.slope_field: self.default_slope}, inplace=True)
-        df.rename(columns={"OID@": self.ORIG_FID}, inplace=True)
-
-        # The vertices will always be grouped by the line they belong to.
+        with span(msg) as stage:
+            # Fields are optional, so initialize if not present
+            cursor_fields = [f for f in [self.slope_field]
+                             if f.lower() in
+                             {f.baseName.lower() for f in self.input_desc.fields}]
+
+            array = arcpy.da.FeatureClassToNumPyArray(in_table=self.lines_2d,
+                                                      field_names=['OID@', self.SHAPE_X, self.SHAPE_Y, *cursor_fields],
+                                                      where_clause=f'{self.input_desc.shapeFieldName} IS NOT null',
+                                                      explode_to_points=True)
+            df = pd.DataFrame(array)
+            if self.slope_field not in df:
+                df[self.slope_field] = self.default_slope
+
+            df.fillna({self.slope_field: self.default_slope}, inplace=True)
+            df.rename(columns={"OID@": self.ORIG_FID}, inplace=True)
+            if self.densify_curves:
+                df = self.densify_vertices(df)
+
+            # The vertices will always be grouped by the line they belong to.
+            shape_cols = [self.SHAPE_X, self.SHAPE_Y]
+            group = df.groupby(self.ORIG_FID)
+
+            # Flip line if endpoint is at the snapping line.
+            if self.use_end_vertex:
+                # Cumulative count gives us the vertex number, so it's efficient to "flip" the line this way.
+                df['rank'] = group.cumcount()
+                df.sort_values([self.ORIG_FID, 'rank'], ascending=[True, False], inplace=True)
+                df.reset_index(drop=True, inplace=True)
+
+            # To scale the Z position of each vertex, we need to calculate the distance between each vertex and then
+            # keep a running tally (cumulative sum) of distances back to the starting point.
+            # https://stackoverflow.com/q/1401712
+            # Z offset at each vertex is tan(slope) * distance
+            points = df[shape_cols]
+            shifted = group[shape_cols].shift(1)
+            df['dist'] = np.linalg.norm(points.values - shifted.values, axis=1)
+            slope = np.tan(np.deg2rad(np.absolute(df[self.slope_field])))
+            df[self.Z_OFFSET] = slope * group['dist'].cumsum().fillna(0)
+            if not self.positive_slope:
+                df[self.Z_OFFSET] *= -1
+
+            df.drop(columns=[self.slope_field, 'dist'], inplace=True)
+            self.df = df
+            stage.rows = len(df)
+
+    def densify_vertices(self, df: pd.DataFrame) -> pd.DataFrame:
+        """ Replaces the vertices of lines with true curves by their densified vertices.
+
+            Exploding to points only returns the curve end points, so the Z offsets would not follow the curve.
+            Densified vertices are read from a persistent cache keyed by OID and geometry.
+        """
         shape_cols = [self.SHAPE_X, self.SHAPE_Y]
-        group = df.groupby(self.ORIG_FID)
-
-        # Flip line if endpoint is at the snapping line.
-        if self.use_end_vertex:
-            # Cumulative count gives us the vertex number, so it's efficient to "flip" the line this way.
-            df['rank'] = group.cumcount()
-            df.sort_values([self.ORIG_FID, 'rank'], ascending=[True, False], inplace=True)
-            df.reset_index(drop=True, inplace=True)
-
-        # To scale the Z position of each vertex, we need to calculate the distance between each vertex and then
-        # keep a running tally (cumulative sum) of distances back to the starting point.
-        # https://stackoverflow.com/q/1401712
-        # Z offset at each vertex is tan(slope) * distance
-        points = df[shape_cols]
-        shifted = group[shape_cols].shift(1)
-        df['dist'] = np.linalg.norm(points.values - shifted.values, axis=1)
-        df[self.Z_OFFSET] = np.tan(np.deg2rad(np.absolute(df[self.slope_field]))) * group['dist'].cumsum().fillna(0)
-        if not self.positive_slope:
-            df[self.Z_OFFSET] *= -1
-
-        df.drop(columns=[self.slope_field, 'dist'], inplace=True)
-        self.df = df
+        densified = []
+        with DensifyCache(densify_cache_path(self.lines_2d)) as cache, \
+                arcpy.da.SearchCursor(self.lines_2d, ['OID@', 'SHAPE@JSON']) as cursor:
+            for oid, shape_json in cursor:
+                if shape_json and has_curves(shape_json):
+                    coords, _ = cache.vertices(oid, shape_json)
+                    densified.append(pd.DataFrame({self.ORIG_FID: oid,
+                                                   self.SHAPE_X: coords[:, 0],
+                                                   self.SHAPE_Y: coords[:, 1]}))
+        if not densified:
+            return df
+
+        densified = pd.concat(densified, ignore_index=True)
+        curved = df[self.ORIG_FID].isin(densified[self.ORIG_FID].unique())
+        attributes = df.loc[curved].drop(columns=shape_cols).drop_duplicates(self.ORIG_FID)
+        densified = densified.merge(attributes, on=self.ORIG_FID)[df.columns]
+
+        # A stable sort keeps the vertices of each line in digitized order.
+        return (pd.concat([df.loc[~curved], densified], ignore_index=True)
+                .sort_values(self.ORIG_FID, kind='mergesort')
+                .reset_index(drop=True))
 
     def snap(self, df) -> Iterator[float]:
         msg = 'Snapping line end to 3D features (5/6)'
         logger.debug(msg)
         arcpy.SetProgressorLabel(msg)
-        total = len(df)
-        step = max(total // 100, 10)
-        arcpy.SetProgressor(type='STEP', message=msg, min_range=0, max_range=total, step_value=step)
-
-        generator = df[[self.SHAPE_FIELD, self.SHAPE_X, self.SHAPE_Y]].itertuples(index=False, name=None)
-        for i, (line, x, y) in enumerate(generator, 1):
-            if not i % step:
-                logger.debug("...{:.0f}%".format(100 * i / total))
-                arcpy.SetProgressorPosition()
-            yield line.snapToLine(arcpy.Point(x, y)).firstPoint.Z
+        with span(msg, rows=len(df)):
+            total = len(df)
+            step = max(total // 100, 10)
+            arcpy.SetProgressor(type='STEP', message=msg, min_range=0, max_range=total, step_value=step)
+
+            spatial_reference = arcpy.Describe(self.lines_3d).spatialReference
+            generator = df[[self.SHAPE_FIELD, self.SHAPE_X, self.SHAPE_Y]].itertuples(index=False, name=None)
+            for i, (wkb, x, y) in enumerate(generator, 1):
+                line = arcpy.FromWKB(wkb, spatial_reference)
+                if not i % step:
+                    logger.debug("...{:.0f}%".format(100 * i / total))
+                    arcpy.SetProgressorPosition()
+                yield line.snapToLine(arcpy.Point(x, y)).firstPoint.Z
 
-        arcpy.ResetProgressor()
+            arcpy.ResetProgressor()
 
     def read_3d_lines(self):
 
@@ -124,61 +169,70 @@ class CalculateZBySlope(object):
         msg = 'Exporting end points (2/6)'
         logger.debug(msg)
         arcpy.SetProgressorLabel(msg)
-        shape_fields = [self.SHAPE_X, self.SHAPE_Y]
-        point_df: pd.DataFrame = self.df.groupby(self.ORIG_FID)[shape_fields].first()
-        point_fc = os.path.join(self.SCRATCH, f'{self.guid}_vertex')
-        arcpy.da.NumPyArrayToFeatureClass(in_array=point_df.to_records(index=False),
-                                          out_table=point_fc,
-                                          shape_fields=shape_fields,
-                                          spatial_reference=self.input_desc.spatialReference)
+        with span(msg) as stage:
+            shape_fields = [self.SHAPE_X, self.SHAPE_Y]
+            point_df: pd.DataFrame = self.df.groupby(self.ORIG_FID)[shape_fields].first()
+            point_fc = os.path.join(self.SCRATCH, f'{self.guid}_vertex')
+            arcpy.da.NumPyArrayToFeatureClass(in_array=point_df.to_records(index=False),
+                                              out_table=point_fc,
+                                              shape_fields=shape_fields,
+                                              spatial_reference=self.input_desc.spatialReference)
+            stage.rows = len(point_df)
 
         # Create near table linking starting points to nearest 3D line.
         msg = 'Generating near table (3/6)'
         logger.debug(msg)
         arcpy.SetProgressorLabel(msg)
-        near_table = arcpy.GenerateNearTable_analysis(in_features=point_fc,
-                                                      near_features=self.lines_3d,
-                                                      out_table=os.path.join(self.SCRATCH, f'{self.guid}_near'),
-                                                      search_radius=None,
-                                                      location=False,
-                                                      angle=False,
-                                                      closest=True)[0]
-        self.cleanup(point_fc)
-
-        # The vertex oid (IN_FID) is the wrong value when the point oid does not start at 1 (such as when the input
-        # has a selection). Instead of writing the FID to the point FC, and then joining to the near table, we can
-        # use the original values and index by position, offseting by 1 because objectID starts at 1.
-
-        # Points 17 and 5 are missing from the near table because they are outside of the tolerance.
-        # In order to link 2/4 back to 22/12, we need to slice by positions 1/3.
-        #
-        # | DF oid | FC oid | near table IN_FID |
-        # |--------|--------|-------------------|
-        # | 17     | 1      | 2                 |
-        # | 22     | 2      | 4                 |
-        # | 5      | 3      |                   |
-        # | 12     | 4      |                   |
-        near_df = pd.DataFrame(arcpy.da.TableToNumPyArray(near_table, ['IN_FID', 'NEAR_FID', 'NEAR_DIST']))
-        near_df['IN_FID'] = point_df.index.values[tuple([near_df['IN_FID'].values - 1])]
-        near_df.rename(columns=dict(NEAR_DIST=self.NEAR_DIST, NEAR_FID=self.NEAR_FID), inplace=True)
-
-        self.cleanup(near_table)
+        with span(msg) as stage:
+            near_table = arcpy.GenerateNearTable_analysis(in_features=point_fc,
+                                                          near_features=self.lines_3d,
+                                                          out_table=os.path.join(self.SCRATCH, f'{self.guid}_near'),
+                                                          search_radius=None,
+                                                          location=False,
+                                                          angle=False,
+                                                          closest=True)[0]
+            self.cleanup(point_fc)
+
+            # The vertex oid (IN_FID) is the wrong value when the point oid does not start at 1 (such as when the
+            # input has a selection). Instead of writing the FID to the point FC, and then joining to the near table,
+            # we can use the original values and index by position, offseting by 1 because objectID starts at 1.
+
+            # Points 17 and 5 are missing from the near table because they are outside of the tolerance.
+            # In order to link 2/4 back to 22/12, we need to slice by positions 1/3.
+            #
+            # | DF oid | FC oid | near table IN_FID |
+            # |--------|--------|-------------------|
+            # | 17     | 1      | 2                 |
+            # | 22     | 2      | 4                 |
+            # | 5      | 3      |                   |
+            # | 12     | 4      |                   |
+            near_df = pd.DataFrame(arcpy.da.TableToNumPyArray(near_table, ['IN_FID', 'NEAR_FID', 'NEAR_DIST']))
+            near_df['IN_FID'] = point_df.index.values[tuple([near_df['IN_FID'].values - 1])]
+            near_df.rename(columns=dict(NEAR_DIST=self.NEAR_DIST, NEAR_FID=self.NEAR_FID), inplace=True)
+
+            self.cleanup(near_table)
+            stage.rows = len(near_df)
 
         # Read line shapes and join with near table.
         msg = 'Reading input 3D features (4/6)'
         logger.debug(msg)
         arcpy.SetProgressorLabel(msg)
-        with arcpy.da.SearchCursor(self.lines_3d, ['OID@', self.SHAPE_FIELD]) as cursor:
-            line_df = cursor_to_df(cursor)
-            line_df = remove_null_rows(line_df, self.SHAPE_FIELD)
+        with span(msg) as stage:
+            # Lines are streamed as WKB and only those nearest to a lateral are kept.
+            near_fids = set(near_df[self.NEAR_FID].tolist())
+            fields = ['OID@', self.SHAPE_FIELD]
+            chunks = [remove_null_rows(chunk[chunk['OID@'].isin(near_fids)], self.SHAPE_FIELD)
+                      for chunk in read_table_chunks(self.lines_3d, fields)]
+            line_df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=fields)
             line_df = (line_df
                        .set_index('OID@')
                        .merge(near_df, left_index=True, right_on=self.NEAR_FID)
                        .set_index('IN_FID'))
 
-        # Join line geometry to first points
-        # Snap point to line and extract Z value
-        df = point_df.merge(line_df, left_index=True, right_index=True)
+            # Join line geometry to first points
+            # Snap point to line and extract Z value
+            df = point_df.merge(line_df, left_index=True, right_index=True)
+            stage.rows = len(line_df)
         df[self.SHAPE_Z] = list(self.snap(df))
 
         columns = [self.SHAPE_Z, self.NEAR_DIST, self.NEAR_FID]
@@ -233,18 +287,19 @@ class CalculateZBySlope(object):
         msg = 'Saving lines (6/6)'
         logger.debug(msg)
         arcpy.SetProgressorLabel(msg)
-        total = len(data)
-        step = max(total // 100, 10)
-        arcpy.SetProgressor(type='STEP', message=msg, min_range=0, max_range=total, step_value=step)
-
-        line_fc = self.create_output_fc(result)
-        fields = [self.SHAPE_FIELD, *attribute_cols]
-        generator = data[fields].itertuples(index=False, name=None)
-
-        with arcpy.da.InsertCursor(line_fc, fields) as cursor:
-            for i, row in enumerate(generator, 1):
-                if not i % step:
-                    logger.debug("...{:.0f}%".format(100 * i / total))
-                    arcpy.SetProgressorPosition()
-                cursor.insertRow(row)
+        with span(msg, rows=len(data)):
+            total = len(data)
+            step = max(total // 100, 10)
+            arcpy.SetProgressor(type='STEP', message=msg, min_range=0, max_range=total, step_value=step)
+
+            line_fc = self.create_output_fc(result)
+            fields = [self.SHAPE_FIELD, *attribute_cols]
+            generator = data[fields].itertuples(index=False, name=None)
+
+            with arcpy.da.InsertCursor(line_fc, fields) as cursor:
+                for i, row in enumerate(generator, 1):
+                    if not i % step:
+                        logger.debug("...{:.0f}%".format(100 * i / total))
+                        arcpy.SetProgressorPosition()
+                    cursor.insertRow(row)
         self.post_process(line_fc)
@@ -1,4 +1,6 @@
 from scripts_ddd._common import *
+from scripts_ddd import settings
+from scripts_ddd.helper import span
 import collections
 import logging
 import os
@@ -35,6 +37,9 @@ class CreateZFeatures(object):
         Error - missing data that was unable to be interpolated
         Interpolated - missing data that was replaced
         Good - all good :)
+
+    True curves are only densified when densify_curves is set. When a tool does not pass it, the DDD_DENSIFY_CURVES
+    environment variable (settings.DENSIFY_CURVES) turns it on. Otherwise the curves are kept in the output.
     """
     SCRATCH = 'in_memory'
 
@@ -52,7 +57,8 @@ class CreateZFeatures(object):
     def __init__(self,
                  input_lines: str, start_elevation: str = None, end_elevation: str = None,
                  z_factor: float = 1,
-                 default_elevation: float = -99, elevation_mask: float = None):
+                 default_elevation: float = -99, elevation_mask: float = None,
+                 densify_curves: bool = None):
 
         self.input = input_lines
         self.input_desc = arcpy.Describe(input_lines)
@@ -74,6 +80,9 @@ class CreateZFeatures(object):
 
         self.elevation_scale = z_factor or 1
 
+        # True curves are densified through a persistent cache, so repeat runs reuse the previous densification.
+        self.densify_curves = settings.DENSIFY_CURVES if densify_curves is None else densify_curves
+
     def read_source_and_convert(self) -> pd.DataFrame:
         """ Replace missing elevations with default
             Convert elevations based on units
@@ -84,22 +93,20 @@ class CreateZFeatures(object):
                          if f.lower() in
                          {f.name.lower() for f in self.input_desc.fields}]
 
-        with arcpy.da.SearchCursor(in_table=self.input,
-                                   field_names=['OID@', self.shape_token, *cursor_fields]) as cursor:
-            df = cursor_to_df(cursor)
-            df = remove_null_rows(df, self.shape_token)
-            df.rename(columns={"OID@": self.ORIG_FID}, inplace=True)
-            for field in self.fields:
-                if field not in df.columns:
-                    df[field] = None
-
-        # Add X/Y fields for the point attributes, which are used during interpolation
+        # Lines are read as WKB in chunks, so no geometry objects are held for the whole table. The JSON is read
+        # along, since WKB does not keep true curves.
+        field_names = ['OID@', self.shape_token, *cursor_fields]
         if self.IS_LINE:
-            extract = df[self.shape_token].apply(lambda f: (f.firstPoint.X, f.firstPoint.Y,
-                                                            f.lastPoint.X, f.lastPoint.Y))
-            df[self.start_shape.x], df[self.start_shape.y], df[self.end_shape.x], df[self.end_shape.y] = zip(*extract)
-        else:
-            df[self.start_shape.x], df[self.start_shape.y] = zip(*df[self.shape_token])
+            field_names.append('SHAPE@JSON')
+
+        with DensifyCache(densify_cache_path(self.input) if self.IS_LINE and self.densify_curves else None) as cache:
+            chunks = [self._convert_chunk(chunk, cache) for chunk in read_table_chunks(self.input, field_names)]
+        df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=field_names)
+        del chunks
+        df.rename(columns={"OID@": self.ORIG_FID}, inplace=True)
+        for field in self.fields:
+            if field not in df.columns:
+                df[field] = None
 
         # Find all null elevations and mark these lines as errors. During interpolation, this will be overwritten.
         if self.elevation_mask is not None:
@@ -128,6 +135,35 @@ class CreateZFeatures(object):
 
         return df
 
+    def _convert_chunk(self, chunk: pd.DataFrame, cache: DensifyCache) -> pd.DataFrame:
+        """ Drops null shapes, densifies true curves and adds the start/end X/Y used during interpolation """
+        chunk = remove_null_rows(chunk, self.shape_token).copy()
+        if not self.IS_LINE:
+            xy = np.array(chunk[self.shape_token].tolist(), dtype=np.float64).reshape(-1, 2)
+            chunk[self.start_shape.x], chunk[self.start_shape.y] = xy[:, 0], xy[:, 1]
+            return chunk
+
+        # Curved lines are densified, or kept as geometries for the whole chunk so they are written with SHAPE@.
+        curved = [has_curves(shape_json) for shape_json in chunk['SHAPE@JSON']]
+        if self.densify_curves:
+            chunk[self.shape_token] = [
+                bytes(cache.densify(oid, arcpy.AsShape(shape_json, True)).WKB) if curve else wkb
+                for oid, wkb, shape_json, curve in zip(chunk['OID@'], chunk[self.shape_token], chunk['SHAPE@JSON'],
+                                                       curved)]
+        elif any(curved):
+            chunk[self.shape_token] = [arcpy.AsShape(shape_json, True) for shape_json in chunk['SHAPE@JSON']]
+        chunk.drop(columns='SHAPE@JSON', inplace=True)
+
+        # The geometries only live while their end points are read.
+        spatial_reference = self.input_desc.spatialReference
+        lines = (arcpy.FromWKB(shape, spatial_reference) if isinstance(shape, (bytes, bytearray)) else shape
+                 for shape in chunk[self.shape_token])
+        ends = np.array([(line.firstPoint.X, line.firstPoint.Y, line.lastPoint.X, line.lastPoint.Y)
+                         for line in lines], dtype=np.float64).reshape(-1, 4)
+        chunk[self.start_shape.x], chunk[self.start_shape.y] = ends[:, 0], ends[:, 1]
+        chunk[self.end_shape.x], chunk[self.end_shape.y] = ends[:, 2], ends[:, 3]
+        return chunk
+
     def _extract_vertices(self, df: pd.DataFrame, use_start: bool, export_null: bool) -> np.ndarray:
         """ Creates numpy array of the vertices """
         from numpy.lib import recfunctions
@@ -152,7 +188,10 @@ class CreateZFeatures(object):
         # An additional field will store 1 if the point is the starting vertex and 0 for end.
         # With FID, this can be used to uniquely identify what elevation to update.
         # Rename shape fields so that both start/end vertices can be combined.
-        array = df.loc[mask, [self.ORIG_FID, *shape_fields]].to_records(index=False)
+        # NumPyArrayToFeatureClass cannot export object columns, arrays without any are passed through as is.
+        # Text widths come from the field lengths of the input instead of scanning the values.
+        array = change_dtypes(df.loc[mask, [self.ORIG_FID, *shape_fields]].to_records(index=False),
+                              source_table=self.input)
         array = recfunctions.rec_append_fields(base=array,
                                                names=self.STARTING_FIELD,
                                                data=[use_start] * array.size,
@@ -196,10 +235,10 @@ class CreateZFeatures(object):
                                        out_property='Z')
 
         # Some points may not be located (eg out of raster extent)
-        with arcpy.da.SearchCursor(fc, [self.ORIG_FID, self.STARTING_FIELD, 'Z'],
-                                   where_clause='Z IS NOT NULL') as cursor:
-            interpolated = cursor_to_df(cursor)
-            interpolated['Z'] += offset
+        fields = [self.ORIG_FID, self.STARTING_FIELD, 'Z']
+        chunks = list(read_table_chunks(fc, fields, where_clause='Z IS NOT NULL'))
+        interpolated = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=fields)
+        interpolated['Z'] += offset
 
         # Changing the boolean starting values to the names of the fields allows for easy updating.
         # GroupBy -> Unstack creates a column for each the starting/end elevation. Depending on which
@@ -266,9 +305,9 @@ class CreateZFeatures(object):
 
         source_fields = [self.ORIG_FID, *self.fields, self.ERROR_FIELD, self.shape_token]
         target_fields = [self.ORIG_FID, *target_fields, self.ERROR_FIELD, self.shape_token]
-        with arcpy.da.InsertCursor(fc, target_fields) as cursor:
-            for row in df[source_fields].itertuples(index=False, name=None):
-                cursor.insertRow(row)
+        data = df[source_fields].set_axis(target_fields, axis=1)
+        df_chunks_to_table((data.iloc[start:start + CHUNK_SIZE] for start in range(0, len(data), CHUNK_SIZE)),
+                           fc, target_fields)
 
         logger.debug(f'Converting lines to 3D {output_lines}')
         arcpy.FeatureTo3DByAttribute_3d(in_features=fc,
@@ -296,19 +335,24 @@ class CreateZFeatures(object):
              surface_raster: str = None,
              raster_offset: float = 0):
 
-        df = self.read_source_and_convert()
+        with span('read_source_and_convert') as stage:
+            df = self.read_source_and_convert()
+            stage.rows = len(df)
 
         if surface_raster is not None:
-            self.interpolate_invalid_elevations(df, raster=surface_raster, offset=raster_offset or 0)
+            with span('interpolate_invalid_elevations (raster)', rows=len(df)):
+                self.interpolate_invalid_elevations(df, raster=surface_raster, offset=raster_offset or 0)
 
         if interpolate_invalid:
             # the TIN does not need to be offset because the elevations are derived from surrounding points
-            tin = self.create_tin(df)
-            self.interpolate_invalid_elevations(df, raster=tin, offset=0)
+            with span('create_tin', rows=len(df)):
+                tin = self.create_tin(df)
+            with span('interpolate_invalid_elevations (tin)', rows=len(df)):
+                self.interpolate_invalid_elevations(df, raster=tin, offset=0)
 
             arcpy.Delete_management(tin)
 
-        self.create_3d_lines(df, output_lines)
-        self.post_process(output_lines)
-
-
+        with span('create_3d_lines', rows=len(df)):
+            self.create_3d_lines(df, output_lines)
+        with span('post_process'):
+            self.post_process(output_lines)
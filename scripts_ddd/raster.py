@@ -1,8 +1,11 @@
 import logging
 import math
+import os
+import uuid
 from typing import Tuple, Iterable
 
 import arcpy
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -17,13 +20,8 @@ class Trenching(object):
         # Running list of the widest features which will be used for draping
         self.widest = []
 
-    def vectorize(self, layer: str, depth: float, width: float) -> Iterable[Tuple[float, arcpy.Polygon]]:
-
-        logger.debug(getattr(layer, 'name', layer))
-        # Use the spatial reference of the first layer
-        if self.spatial_reference is None:
-            self.spatial_reference = arcpy.Describe(layer).spatialReference
-
+    def _iterations(self, width: float) -> Tuple[float, int]:
+        """ Clamps the width to the pixel size and returns it with the number of depth steps """
         if width < self.pixel_size:
             logger.warning(f'Increasing width to {self.pixel_size} to match pixel size')
             width = self.pixel_size
@@ -33,6 +31,16 @@ class Trenching(object):
         # The number of iterations is based on the pixel diagonal.
         # We always want at least 1 iteration.
         iterations = max(int(math.floor(width / math.sqrt(pow(self.pixel_size, 2) * 2))), 1)
+        return width, iterations
+
+    def vectorize(self, layer: str, depth: float, width: float) -> Iterable[Tuple[float, arcpy.Polygon]]:
+
+        logger.debug(getattr(layer, 'name', layer))
+        # Use the spatial reference of the first layer
+        if self.spatial_reference is None:
+            self.spatial_reference = arcpy.Describe(layer).spatialReference
+
+        width, iterations = self._iterations(width)
         depth_factor = depth / iterations
 
         # Dissolving here means we only need a single call to buffer for the features instead of 1 per feature.
@@ -73,3 +81,155 @@ class Trenching(object):
                                          out_rasterdataset=output_raster,
                                          priority_field='value',
                                          cellsize=self.pixel_size)
+
+
+class RasterTrenching(Trenching):
+    """
+    Raster-native version of Trenching.
+
+    Each layer is rasterized once onto a shared grid. The stepped depth profile is derived from the euclidean distance
+    of every cell to the rasterized asset, which gives the same surface as buffering once per depth iteration.
+    Layers are combined with a cell-wise reduction (maximum by default) so only a single output raster is written,
+    regardless of the number of layers.
+    """
+    SCRATCH = 'in_memory'
+
+    def __init__(self, pixel_size: float, reduction=np.fmax):
+
+        super().__init__(pixel_size)
+
+        # np.fmax / np.fmin ignore NoData (nan) cells, so layers only compete where they overlap.
+        self.reduction = reduction
+
+    def _grid(self, layers: Iterable[Tuple[str, float, float]]) -> Tuple[arcpy.Point, int, int]:
+        """ Returns the lower left corner and size of the grid covering all layers and their trench widths """
+        xmin = ymin = math.inf
+        xmax = ymax = -math.inf
+        for layer, depth, width in layers:
+            width, iterations = self._iterations(width)
+            extent = arcpy.Describe(layer).extent.projectAs(self.spatial_reference)
+            pad = (iterations + 1) * self.pixel_size
+            xmin, ymin = min(xmin, extent.XMin - pad), min(ymin, extent.YMin - pad)
+            xmax, ymax = max(xmax, extent.XMax + pad), max(ymax, extent.YMax + pad)
+
+        # Align the grid to the pixel size so that every layer shares the same cell boundaries.
+        xmin = math.floor(xmin / self.pixel_size) * self.pixel_size
+        ymin = math.floor(ymin / self.pixel_size) * self.pixel_size
+        ncols = int(math.ceil((xmax - xmin) / self.pixel_size))
+        nrows = int(math.ceil((ymax - ymin) / self.pixel_size))
+        return arcpy.Point(xmin, ymin), ncols, nrows
+
+    def _window(self, layer: str, pad: float, corner: arcpy.Point, ncols: int, nrows: int) -> Tuple[int, int, int, int]:
+        """ Returns the (row, col, nrows, ncols) window of the grid covered by the layer plus padding """
+        extent = arcpy.Describe(layer).extent.projectAs(self.spatial_reference)
+        col0 = max(int(math.floor((extent.XMin - pad - corner.X) / self.pixel_size)), 0)
+        col1 = min(int(math.ceil((extent.XMax + pad - corner.X) / self.pixel_size)), ncols)
+        # Rows are counted from the top of the grid.
+        row0 = max(nrows - int(math.ceil((extent.YMax + pad - corner.Y) / self.pixel_size)), 0)
+        row1 = min(nrows - int(math.floor((extent.YMin - pad - corner.Y) / self.pixel_size)), nrows)
+        return row0, col0, row1 - row0, col1 - col0
+
+    def _rasterize_layer(self, layer: str, corner: arcpy.Point, ncols: int, nrows: int) -> np.ndarray:
+        """ Burns the layer into the grid window. Cells touched by a feature are True. """
+        scratch = os.path.join(self.SCRATCH, f'trench_{uuid.uuid4().hex}')
+        arcpy.FeatureToRaster_conversion(in_features=layer,
+                                         field=arcpy.Describe(layer).OIDFieldName,
+                                         out_raster=scratch,
+                                         cell_size=self.pixel_size)
+        try:
+            array = arcpy.RasterToNumPyArray(in_raster=scratch,
+                                             lower_left_corner=corner,
+                                             ncols=ncols,
+                                             nrows=nrows,
+                                             nodata_to_value=-1)
+        finally:
+            arcpy.Delete_management(scratch)
+        return array != -1
+
+    def depth_profile(self, mask: np.ndarray, depth: float, width: float) -> np.ndarray:
+        """ Converts a rasterized asset mask to the stepped trench depth (nan outside the trench) """
+        from scipy import ndimage
+
+        width, iterations = self._iterations(width)
+        depth_factor = depth / iterations
+
+        # Distance from each cell to the nearest asset cell, in map units.
+        distance = ndimage.distance_transform_edt(~mask, sampling=self.pixel_size)
+
+        # A cell inside buffer j (but not j - 1) gets the depth of iteration i = iterations + 1 - j, which matches the
+        # priority of the overlapping buffers in Trenching.main. Cells on the asset belong to the first buffer.
+        step = np.maximum(np.ceil(distance / self.pixel_size), 1)
+        profile = ((iterations + 1 - step) * depth_factor).astype(np.float32)
+        profile[step > iterations] = np.nan
+        return profile
+
+    def main(self, layers: Iterable[Tuple[str, float, float]], output_vector: str, output_raster: str):
+        """ Rasterizes each (layer, depth, width) once and writes the combined trench raster and footprint """
+        layers = list(layers)
+        if not layers:
+            raise ValueError('No layers to trench')
+
+        if self.spatial_reference is None:
+            self.spatial_reference = arcpy.Describe(layers[0][0]).spatialReference
+
+        corner, ncols, nrows = self._grid(layers)
+        logger.debug(f'Trench grid {ncols:,} x {nrows:,} cells')
+
+        # Every per-layer raster snaps to the cells of the shared grid, whatever extent it is clipped to.
+        snap = os.path.join(self.SCRATCH, f'trench_snap_{uuid.uuid4().hex}')
+        arcpy.NumPyArrayToRaster(in_array=np.zeros((1, 1), dtype=np.int8),
+                                 lower_left_corner=corner,
+                                 x_cell_size=self.pixel_size,
+                                 y_cell_size=self.pixel_size).save(snap)
+
+        env = {name: getattr(arcpy.env, name) for name in ('outputCoordinateSystem', 'extent', 'snapRaster')}
+        arcpy.env.outputCoordinateSystem = self.spatial_reference
+        arcpy.env.snapRaster = snap
+        surface = np.full((nrows, ncols), np.nan, dtype=np.float32)
+
+        try:
+            for i, (layer, depth, width) in enumerate(layers, 1):
+                logger.debug(f'{getattr(layer, "name", layer)} ({i}/{len(layers)})')
+                width, iterations = self._iterations(width)
+                row, col, height, length = self._window(layer, (iterations + 1) * self.pixel_size,
+                                                        corner, ncols, nrows)
+                if height <= 0 or length <= 0:
+                    continue
+
+                # Only the window around the layer is rasterized, so many small layers stay cheap.
+                window_corner = arcpy.Point(corner.X + col * self.pixel_size,
+                                            corner.Y + (nrows - row - height) * self.pixel_size)
+                arcpy.env.extent = arcpy.Extent(window_corner.X, window_corner.Y,
+                                                window_corner.X + length * self.pixel_size,
+                                                window_corner.Y + height * self.pixel_size)
+                mask = self._rasterize_layer(layer, window_corner, length, height)
+                if not mask.any():
+                    continue
+
+                view = surface[row:row + height, col:col + length]
+                self.reduction(view, self.depth_profile(mask, depth, width), out=view)
+        finally:
+            for name, value in env.items():
+                setattr(arcpy.env, name, value)
+            arcpy.Delete_management(snap)
+
+        logger.debug('Creating raster')
+        raster = arcpy.NumPyArrayToRaster(in_array=surface,
+                                          lower_left_corner=corner,
+                                          x_cell_size=self.pixel_size,
+                                          y_cell_size=self.pixel_size)
+        raster.save(output_raster)
+        arcpy.DefineProjection_management(output_raster, self.spatial_reference)
+
+        # The trench footprint is the outline of all cells that were lowered.
+        footprint = arcpy.NumPyArrayToRaster(in_array=(~np.isnan(surface)).astype(np.int8),
+                                             lower_left_corner=corner,
+                                             x_cell_size=self.pixel_size,
+                                             y_cell_size=self.pixel_size,
+                                             value_to_nodata=0)
+        polygons = arcpy.RasterToPolygon_conversion(in_raster=footprint,
+                                                    out_polygon_features=arcpy.Geometry(),
+                                                    simplify='SIMPLIFY')
+        arcpy.Dissolve_management(in_features=polygons, out_feature_class=output_vector)
+        # The footprint raster is built outside the environment block, so like the raster it has no spatial reference.
+        arcpy.DefineProjection_management(output_vector, self.spatial_reference)
@@ -6,6 +6,19 @@ import os as _os
 ERROR = "error"
 WARNING = "warning"
 
+# profiling
+# When set, each geoprocessing tool writes a JSON trace of its timed stages to this folder.
+TRACE_FOLDER = _os.environ.get('DDD_TRACE_FOLDER')
+# Also capture a cProfile of the tool next to the trace (slower).
+TRACE_CPROFILE = _os.environ.get('DDD_TRACE_CPROFILE', '').lower() in ('1', 'true', 'yes')
+
+# Folder for the persistent densified geometry cache. Defaults to the scratch folder when not set.
+DENSIFY_CACHE_FOLDER = _os.environ.get('DDD_DENSIFY_CACHE_FOLDER')
+# Densify true curves in CreateZFeatures and CalculateZBySlope when the tool does not pass densify_curves.
+DENSIFY_CURVES = _os.environ.get('DDD_DENSIFY_CURVES', '').lower() in ('1', 'true', 'yes')
+# Most shapes kept per densify cache file. Shapes not used by the latest run are dropped first.
+DENSIFY_CACHE_MAX_SHAPES = int(_os.environ.get('DDD_DENSIFY_CACHE_MAX_SHAPES', 1000000))
+
 # global fields
 UNDEFINED = "Undefined"
 DIAMETER_FIELD = "util_diameter"
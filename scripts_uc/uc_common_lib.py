@@ -9,11 +9,20 @@ import time
 import datetime as dt
 import os
 import json
+import hashlib
 import logging
 import math
 import requests
+import random
+import asyncio
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 from itertools import islice
 import scripts_uc.uc_settings as uc_settings
+import scripts.A3D_common_lib as A3D_common_lib
 from arcgis.geometry import Geometry
 import importlib
 from scripts_uc.uc_settings import *
@@ -25,6 +34,39 @@ ERROR = "error"
 WARNING = "warning"
 in_memory_switch = True
 
+# urban api list queries return at most QUERY_PAGE_SIZE records, QUERY_WORKERS pages are requested at the same time
+QUERY_PAGE_SIZE = 100
+QUERY_WORKERS = 4
+QUERY_RETRIES = 3
+QUERY_BACKOFF = 0.5
+QUERY_TIMEOUT = (10, 120)  # seconds to connect, seconds to wait for the response
+QUERY_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# bulk mutations are split in batches of at most MUTATION_BYTE_BUDGET bytes of serialized features
+MUTATION_BYTE_BUDGET = 1024 * 1024
+MUTATION_WORKERS = 4
+MUTATION_RETRIES = 2
+
+# small queries and mutations are sent together as one aliased document of at most BATCH_MAX_OPERATIONS operations
+BATCH_MAX_OPERATIONS = 50
+
+# urban attribute schemas are kept on disk per api, model and version for SCHEMA_CACHE_TTL seconds
+SCHEMA_CACHE_TTL = 24 * 3600
+SCHEMA_CACHE_FILE = "urban_schema_cache.json"
+
+# portal searches run PORTAL_SEARCH_WORKERS at a time, results are kept in the A3D metadata cache
+PORTAL_SEARCH_WORKERS = 4
+
+# features are validated VALIDATION_CHUNK_SIZE rows at a time, the report lists VALIDATION_SAMPLE_SIZE ids per error
+VALIDATION_CHUNK_SIZE = 100000
+VALIDATION_SAMPLE_SIZE = 5
+
+# lists indexed by the urban catalog at the same time
+URBAN_CATALOG_SIZE = 16
+
+# last pushed edge info hash per parcel, one file per urban database in the scratch folder
+EDGEINFO_SNAPSHOT_FILE = "urban_edgeinfo_{}.json"
+
 
 # item_data class
 class QueryFailed(Exception):
@@ -111,10 +153,172 @@ class ZoneType(object):
         self.color = color
 
 
-class UrbanFeature(object):
-    def __init__(self, geometry, attributes):
-        self.geometry = geometry
-        self.attributes = attributes
+class UrbanCatalog(object):
+    '''
+    indexes lists of urban models, events, designs, scenarios and portal search results the first time they are
+    searched, later selections on the same list are dict lookups. The index is kept with the list, so a list that
+    is changed in place must be dropped with invalidate; only a changed length is noticed. At most max_lists lists
+    are kept, the least recently used index is dropped first. The first object in the list wins when keys are
+    shared, like the scans it replaces.
+    '''
+    def __init__(self, max_lists=URBAN_CATALOG_SIZE):
+        from collections import OrderedDict
+
+        self.max_lists = max_lists
+        self._indexes = OrderedDict()
+
+    def clear(self):
+        self._indexes.clear()
+
+    def invalidate(self, items):
+        for key in [key for key, entry in self._indexes.items() if entry[0] is items]:
+            del self._indexes[key]
+
+    def index(self, kind, items, build):
+        key = (kind, id(items))
+        entry = self._indexes.get(key)
+
+        # the entry holds the list, so its id is not reused while it is kept
+        if entry is None or entry[0] is not items or entry[1] != len(items):
+            entry = (items, len(items), build(items))
+            self._indexes[key] = entry
+
+        self._indexes.move_to_end(key)
+        while len(self._indexes) > self.max_lists:
+            self._indexes.popitem(last=False)
+
+        return entry[2]
+
+    def models(self, model_list):
+        def build(items):
+            index = {'title': dict(), 'title_owner': dict(), 'title_date': dict(), 'title_owner_date': dict()}
+            for m in items:
+                index['title'].setdefault(m.model_title, m)
+                index['title_owner'].setdefault((m.model_title, m.owner), m)
+                if m.creation_date:
+                    m_date = get_model_date_string(m)
+                    index['title_date'].setdefault((m.model_title, m_date), m)
+                    index['title_owner_date'].setdefault((m.model_title, m.owner, m_date), m)
+            return index
+
+        return self.index('models', model_list, build)
+
+    def events(self, event_list):
+        def build(items):
+            index = {'title': dict(), 'master_name': dict()}
+            for e in items:
+                index['title'].setdefault(get_event_ui_name(e), e)
+                index['master_name'].setdefault((e.urban_model.master_id, e.event_name), e)
+            return index
+
+        return self.index('events', event_list, build)
+
+    def designs(self, design_list):
+        def build(items):
+            index = {'title': dict(), 'owner': dict(), 'model': dict()}
+            for d in items:
+                index['title'].setdefault(d.title, d)
+                index['owner'].setdefault(d.owner, list()).append(d)
+                index['model'].setdefault(d.urban_model_id, list()).append(d)
+            return index
+
+        return self.index('designs', design_list, build)
+
+    def scenarios(self, scenario_list):
+        def build(items):
+            index = {'title': dict()}
+            for s in items:
+                index['title'].setdefault(s.branch_name, s)
+            return index
+
+        return self.index('scenarios', scenario_list, build)
+
+    def search_results(self, search_result):
+        def build(items):
+            index = dict()
+            for i in items:
+                for attribute in ('url', 'sourceUrl'):
+                    try:
+                        item_url = getattr(i, attribute)
+                    except:
+                        item_url = None
+                    if item_url:
+                        index.setdefault(item_url, list()).append(i)
+            return index
+
+        return self.index('search_results', search_result, build)
+
+
+# one catalog per session, shared by the select and find functions
+urban_catalog = UrbanCatalog()
+
+
+class PortalSearch(object):
+    '''
+    runs gis.content searches on a thread pool so several searches can be awaited at once. Results are kept in
+    the metadata cache shared with the A3D scripts, keyed by the sign-in of gis: an identical search that is
+    still running is joined instead of sent again, and results expire with the cache ttl.
+    usage:
+        results = portal_search.search_all(gis, [{'query': 'title: a'}, {'query': 'title: b', 'outside_org': True}])
+    '''
+    def __init__(self, cache=None, max_workers=PORTAL_SEARCH_WORKERS):
+        self.cache = cache or A3D_common_lib.metadata_cache
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @staticmethod
+    def get_key(gis, method, kwargs):
+        return 'portal_search', A3D_common_lib.gis_fingerprint(gis), method, \
+            tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+    def submit(self, gis, method, kwargs, fresh=False):
+        '''
+        :param fresh: don't use a kept result, for searches that check if an item exists
+        :return: concurrent future with the search result
+        '''
+        key = self.get_key(gis, method, kwargs)
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        return self._executor.submit(self.cache.get, key, lambda: getattr(gis.content, method)(**kwargs), fresh)
+
+    async def search_async(self, gis, method='search', fresh=False, **kwargs):
+        return await asyncio.wrap_future(self.submit(gis, method, kwargs, fresh))
+
+    def search(self, gis, method='search', fresh=False, **kwargs):
+        return self.submit(gis, method, kwargs, fresh).result()
+
+    def search_all(self, gis, searches, method='search', fresh=False):
+        '''
+        :param searches: list of keyword argument dicts for gis.content.<method>
+        :return: list of results in the order of searches
+        '''
+        async def gather():
+            return await asyncio.gather(*[self.search_async(gis, method, fresh, **kwargs) for kwargs in searches])
+
+        return run_async(gather())
+
+    def invalidate(self):
+        self.cache.invalidate('portal_search')
+
+
+def run_async(coroutine):
+    '''
+    runs a coroutine to completion, also when called from code that already runs an event loop
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+portal_search = PortalSearch()
 
 
 class FunctionError(Exception):
@@ -271,6 +475,33 @@ def chunks(data, size):
         yield {k:data[k] for k in islice(it, size)}
 
 
+def chunks_by_size(items, max_bytes, size=len):
+    '''
+    splits items in consecutive batches whose summed size stays within max_bytes.
+    An item larger than max_bytes goes in a batch of its own.
+    :param items: iterable of items
+    :param max_bytes: byte budget per batch
+    :param size: function that returns the size of an item
+    :return: generator of lists
+    '''
+    batch = list()
+    batch_bytes = 0
+
+    for item in items:
+        item_bytes = size(item)
+
+        if batch and batch_bytes + item_bytes > max_bytes:
+            yield batch
+            batch = list()
+            batch_bytes = 0
+
+        batch.append(item)
+        batch_bytes += item_bytes
+
+    if batch:
+        yield batch
+
+
 def now_dt():
     return int(dt.datetime.now().timestamp()*1000)
 
@@ -302,25 +533,53 @@ def create_gdb(path, name):
         arcpy.AddError(e.args[0])
 
 
-def get_urban_api_url():
-    scripts_dir = os.path.dirname(os.path.abspath(__file__))
-    home_directory = os.path.dirname(scripts_dir)
+_settings_cache = dict()
+
+
+def get_settings_file(path=None):
+    if path:
+        home_directory = path
+    else:
+        scripts_dir = os.path.dirname(os.path.abspath(__file__))
+        home_directory = os.path.dirname(scripts_dir)
 
     if os.path.exists(os.path.join(home_directory, "p20")):  # it is a package
         home_directory = os.path.join(home_directory, "p20")
 
     settings_directory = home_directory + "\\settings"
 
-    json_file = os.path.join(settings_directory, "settings_urban.json")
+    return os.path.join(settings_directory, "settings_urban.json")
 
-    urban_api_url = None
 
-    if arcpy.Exists(json_file):
+def read_urban_settings(path=None):
+    '''
+    reads settings_urban.json, the file is only read again when it changed on disk
+    :return: settings dict or None
+    '''
+    json_file = get_settings_file(path)
+
+    if not arcpy.Exists(json_file):
+        return None
+
+    modified = os.path.getmtime(json_file)
+    cached = _settings_cache.get(json_file)
+
+    if cached is None or cached[0] != modified:
         with open(json_file, "r") as content:
-            settings_json = json.load(content)
-            connection_dict = settings_json.get("connection")
-            if connection_dict:
-                urban_api_url = connection_dict.get("urban_api_url")
+            cached = (modified, json.load(content))
+        _settings_cache[json_file] = cached
+
+    return cached[1]
+
+
+def get_urban_api_url():
+    urban_api_url = None
+    settings_json = read_urban_settings()
+
+    if settings_json:
+        connection_dict = settings_json.get("connection")
+        if connection_dict:
+            urban_api_url = connection_dict.get("urban_api_url")
 
     return urban_api_url
 
@@ -339,73 +598,37 @@ def check_min_version(version, min_version):
 
 
 def get_supported_versions():
-    scripts_dir = os.path.dirname(os.path.abspath(__file__))
-    home_directory = os.path.dirname(scripts_dir)
-
-    if os.path.exists(os.path.join(home_directory, "p20")):  # it is a package
-        home_directory = os.path.join(home_directory, "p20")
-
-    settings_directory = home_directory + "\\settings"
-
-    json_file = os.path.join(settings_directory, "settings_urban.json")
-
     version_list = None
+    settings_json = read_urban_settings()
 
-    if arcpy.Exists(json_file):
-        with open(json_file, "r") as content:
-            settings_json = json.load(content)
-            schema_dict = settings_json.get("schema")
-            if schema_dict:
-                version_list = schema_dict.get("supported_versions")
+    if settings_json:
+        schema_dict = settings_json.get("schema")
+        if schema_dict:
+            version_list = schema_dict.get("supported_versions")
 
     return version_list
 
 
 def get_min_supported_version():
-    scripts_dir = os.path.dirname(os.path.abspath(__file__))
-    home_directory = os.path.dirname(scripts_dir)
-
-    if os.path.exists(os.path.join(home_directory, "p20")):  # it is a package
-        home_directory = os.path.join(home_directory, "p20")
-
-    settings_directory = home_directory + "\\settings"
-
-    json_file = os.path.join(settings_directory, "settings_urban.json")
-
     min_version = None
+    settings_json = read_urban_settings()
 
-    if arcpy.Exists(json_file):
-        with open(json_file, "r") as content:
-            settings_json = json.load(content)
-            schema_dict = settings_json.get("schema")
-            if schema_dict:
-                min_version = schema_dict.get("min_supported_version")
+    if settings_json:
+        schema_dict = settings_json.get("schema")
+        if schema_dict:
+            min_version = schema_dict.get("min_supported_version")
 
     return min_version
 
 
 def get_schema_info(path):
-    if path:
-        home_directory = path
-    else:
-        scripts_dir = os.path.dirname(os.path.abspath(__file__))
-        home_directory = os.path.dirname(scripts_dir)
-
     schema = None
+    settings_json = read_urban_settings(path)
 
-    if os.path.exists(os.path.join(home_directory, "p20")):  # it is a package
-        home_directory = os.path.join(home_directory, "p20")
-
-    settings_directory = home_directory + "\\settings"
-
-    json_file = os.path.join(settings_directory, "settings_urban.json")
-
-    if arcpy.Exists(json_file):
-        with open(json_file, "r") as content:
-            settings_json = json.load(content)
-            schema_dict_dict = settings_json.get("schema")
-            if schema_dict_dict:
-                schema = schema_dict_dict
+    if settings_json:
+        schema_dict_dict = settings_json.get("schema")
+        if schema_dict_dict:
+            schema = schema_dict_dict
 
     return schema
 
@@ -447,10 +670,8 @@ def get_urban_model_name_item_list(my_list):
 
 
 def get_group_urban_models(gis, grps, query):
-    search_result = gis.content.search(query=query, item_type="Urban Model", max_items=-1)
-    name_item_list = get_urban_model_name_item_list(search_result)
-
-    # TODO deal with empty list
+    search = portal_search.submit(gis, 'search', {'query': query, 'item_type': "Urban Model", 'max_items': -1})
+    group_searches = list()
 
     if grps:
         lu = {grp.id: grp.title for grp in grps}
@@ -458,7 +679,18 @@ def get_group_urban_models(gis, grps, query):
             q = "orgid:%s" % gis.properties.id
             q += ' type:("Urban Model")'
             q += ' group: %s' % grpid
-            group_result = gis.content.advanced_search(query=q, max_items=-1)
+            group_searches.append({'query': q, 'max_items': -1})
+
+    # the group searches run while the urban models search is handled
+    group_results = portal_search.search_all(gis, group_searches, method='advanced_search')
+
+    search_result = search.result()
+    name_item_list = get_urban_model_name_item_list(search_result)
+
+    # TODO deal with empty list
+
+    if grps:
+        for group_result in group_results:
             total = group_result['total']
             results = group_result['results']
             if total > 0:
@@ -576,7 +808,11 @@ def SOAP2REST(string):
 
 
 def find_item_in_search_results_by_url(search_result, s_type, name, url):
-    s = 0
+    # items with this url or source url first, then check the layers of all items
+    candidates = urban_catalog.search_results(search_result).get(url)
+    if candidates:
+        return candidates[0]
+
     item = None
     for i in search_result:
         # check that layer url is in item
@@ -587,32 +823,28 @@ def find_item_in_search_results_by_url(search_result, s_type, name, url):
     return item
 
 
-def find_item_in_search_results(search_result, s_type, name, url):
-    s = 0
-    item = None
-    for i in search_result:
-        if s_type == "Scene Layer" or s_type == "Feature Layer":
-            if name in str(i) and s_type in str(i):
+def is_search_result_match(i, s_type, name):
+    if s_type == "Scene Layer" or s_type == "Feature Layer":
+        return name in str(i) and s_type in str(i)
+    elif s_type == "Raster Layer":
+        return name in str(i) and (s_type in str(i) or "Imagery Layer" in str(i))
+    else:
+        return name in str(i)
 
-                # check that layer url is in item
-                if is_layer_url_in_item(i, url):
-                    item = i
-                    break
 
-        elif s_type == "Raster Layer":
-            if name in str(i) and (s_type in str(i) or "Imagery Layer" in str(i)):
+def find_item_in_search_results(search_result, s_type, name, url):
+    # items with this url or source url first, then check the layers of all items
+    for i in urban_catalog.search_results(search_result).get(url) or list():
+        if is_search_result_match(i, s_type, name):
+            return i
 
-                # check that layer url is in item
-                if is_layer_url_in_item(i, url):
-                    item = i
-                    break
-        else:
-            if name in str(i):
-                # check that layer url is in item
-                if is_layer_url_in_item(i, url):
-                    item = i
-                    break
-        s += 1
+    item = None
+    for i in search_result:
+        if is_search_result_match(i, s_type, name):
+            # check that layer url is in item
+            if is_layer_url_in_item(i, url):
+                item = i
+                break
 
     return item
 
@@ -646,60 +878,42 @@ def strip_url_to_server(url):
 
 
 def search_item_by_url(gis, s_type, name, url):
-    # owner search
-    result = gis.content.search('url: ' + url, max_items=-1)
-
-    if len(result) > 0:
-        the_item = find_item_in_search_results_by_url(result, s_type, name, url)
+    #  also search without layers/n in the url, both searches at once. Searches check if the item exists now,
+    #  so they don't use kept results
+    strip_url = strip_url_to_server(url)
+    searches = [{'query': 'url: ' + url, 'max_items': -1},
+                {'query': 'url: ' + strip_url, 'max_items': -1}]
+    results = portal_search.search_all(gis, searches, fresh=True)
+
+    if len(results[0]) == 0 and len(results[1]) == 0:
+        # search outside org only when the organization has no match
+        arcpy.AddMessage("Searching outside your organization...")
+        results = portal_search.search_all(gis, [dict(search, outside_org=True) for search in searches], fresh=True)
+
+    # owner search first
+    if len(results[0]) > 0:
+        the_item = find_item_in_search_results_by_url(results[0], s_type, name, url)
+    elif len(results[1]) > 0:
+        the_item = find_item_in_search_results_by_url(results[1], s_type, name, strip_url)
     else:
-        #  remove layers/n from url and try again
-        strip_url = strip_url_to_server(url)
-        result = gis.content.search('url: ' + strip_url, max_items=-1)
-        if len(result) > 0:
-            the_item = find_item_in_search_results_by_url(result, s_type, name, strip_url)
-        else:
-            arcpy.AddMessage("Searching outside your organization...")
-            result = gis.content.search('url: ' + url, outside_org=True, max_items=-1)
-            if len(result) > 0:
-                the_item = find_item_in_search_results_by_url(result, s_type, name, url)
-            else:
-                #  remove layers/n from url and try again
-                result = gis.content.search('url: ' + strip_url, outside_org=True, max_items=-1)
-
-                if len(result) > 0:
-                    the_item = find_item_in_search_results_by_url(result, s_type, name, strip_url)
-                else:
-                    the_item = None
+        the_item = None
 
     return the_item
 
 
 def search_item_by_name(gis, s_type, name, url):
-    # owner search
-    result = gis.content.search('title: ' + name, max_items=-1)
+    search = {'query': 'title: ' + name, 'max_items': -1}
+    result = portal_search.search(gis, fresh=True, **search)
+
+    if len(result) == 0:
+        # search outside org
+        arcpy.AddMessage("Searching outside your organization...")
+        result = portal_search.search(gis, fresh=True, outside_org=True, **search)
 
     if len(result) > 0:
         the_item = find_item_in_search_results(result, s_type, name, url)
     else:
-        #  remove layers/n from url and try again
-        strip_url = strip_url_to_server(url)
-        result = gis.content.search('title: ' + name, max_items=-1)
-        if len(result) > 0:
-            the_item = find_item_in_search_results(result, s_type, name, strip_url)
-        else:
-            # search outside org
-            arcpy.AddMessage("Searching outside your organization...")
-            result = gis.content.search('title: ' + name, outside_org=True, max_items=-1)
-            if len(result) > 0:
-                the_item = find_item_in_search_results(result, s_type, name, url)
-            else:
-                #  remove layers/n from url and try again
-                result = gis.content.search('title: ' + name, outside_org=True, max_items=-1)
-
-                if len(result) > 0:
-                    the_item = find_item_in_search_results_by_url(result, s_type, name, strip_url)
-                else:
-                    the_item = None
+        the_item = None
 
     return the_item
 
@@ -792,13 +1006,18 @@ def get_datasource_lists(lyr_obj_list):
 def get_unique_web_scene_name(gis, name):
     try:
         ext = 0
-        ws_name = name + "_" + str(ext)
 
-        while len(gis.content.search(query='title: ' + ws_name, item_type="Web Scene")) > 0:
-            ext += 1
-            ws_name = name + "_" + str(ext)
+        # check PORTAL_SEARCH_WORKERS names at a time, the first name without search results is free
+        while True:
+            ws_names = [name + "_" + str(ext + i) for i in range(PORTAL_SEARCH_WORKERS)]
+            results = portal_search.search_all(gis, [{'query': 'title: ' + ws_name, 'item_type': "Web Scene"}
+                                                     for ws_name in ws_names], fresh=True)
+
+            for ws_name, result in zip(ws_names, results):
+                if len(result) == 0:
+                    return ws_name
 
-        return ws_name
+            ext += PORTAL_SEARCH_WORKERS
 
     except:
         raise FunctionError(
@@ -861,15 +1080,86 @@ def get_z_unit(local_lyr):
             msg(msg_body, ERROR)
 
 
-def run_query(url, query_or_mutation, variables):
+_session = None
+
+
+def get_session():
+    '''
+    returns the requests session shared by all urban api calls. The connection pool fits QUERY_WORKERS
+    concurrent requests. The session only retries connections that could not be made, run_query decides
+    which requests are sent again after that.
+    :return: requests.Session
+    '''
+    global _session
+
+    if _session is None:
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=QUERY_RETRIES, connect=QUERY_RETRIES, read=0, status=0, other=0,
+                      backoff_factor=QUERY_BACKOFF)
+        adapter = HTTPAdapter(pool_connections=QUERY_WORKERS, pool_maxsize=QUERY_WORKERS * 2, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+
+    return _session
+
+
+def is_mutation(query_or_mutation):
+    return query_or_mutation.lstrip().startswith('mutation')
+
+
+def is_unsent_request_error(error):
+    '''
+    True when a request failed before it reached the server (no connection could be made), so sending it again
+    cannot apply it twice
+    '''
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # requests wraps the urllib3 MaxRetryError, whose reason is the error of the last connection attempt
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+    return False
+
+
+def run_query(url, query_or_mutation, variables, timeout=QUERY_TIMEOUT):
     '''
     A simple function to use requests.post to make the API call. Note the json= section.
+    Queries are sent again after connection errors, timeouts and throttled or unavailable responses.
+    A mutation is never sent again: a mutation that reached the server may have been applied.
     :param url:
     :param query:
     :param variables:
+    :param timeout: (connect, read) timeout in seconds
     :return:
     '''
-    request = requests.post(url, json={'query': query_or_mutation})
+    request = None
+    retries = 0 if is_mutation(query_or_mutation) else QUERY_RETRIES
+
+    if variables:
+        payload = {'query': query_or_mutation, 'variables': variables}
+    else:
+        payload = {'query': query_or_mutation}
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(QUERY_BACKOFF * (2 ** (attempt - 1)) * (1 + random.random()))
+
+        try:
+            request = get_session().post(url, json=payload, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == retries:
+                raise
+            continue
+
+        if request.status_code not in QUERY_RETRY_STATUS:
+            break
+
     if request.status_code == 200:
         return request.json()
     else:
@@ -878,6 +1168,266 @@ def run_query(url, query_or_mutation, variables):
         return None
 
 
+def is_rejected(result):
+    '''
+    True when the api rejected the document before running it, for instance for an unknown field or a wrong type:
+    validation errors have no path, errors raised while running an operation do
+    '''
+    errors = result.get('errors') if result else None
+    return bool(errors) and not result.get('data') and all(not e.get('path') for e in errors)
+
+
+ARGUMENT_TYPES_QUERY = """query{
+    __schema{
+        queryType{ ...argumentTypes }
+        mutationType{ ...argumentTypes }
+    }
+}
+fragment argumentTypes on __Type{
+    fields{ name args{ name type{ kind name ofType{ kind name ofType{ kind name ofType{ kind name } } } } } }
+}"""
+
+_argument_types = dict()
+_argument_types_lock = threading.Lock()
+
+
+def graphql_type_name(type_ref):
+    if type_ref['kind'] == 'NON_NULL':
+        return graphql_type_name(type_ref['ofType']) + '!'
+    elif type_ref['kind'] == 'LIST':
+        return '[' + graphql_type_name(type_ref['ofType']) + ']'
+    else:
+        return type_ref['name']
+
+
+def get_argument_types(url):
+    '''
+    reads the argument types of the query and mutation fields of the urban api with one introspection query per url
+    :return: dict (operation type, field): {argument: graphql type}, empty when the schema can't be read
+    '''
+    with _argument_types_lock:
+        if url in _argument_types:
+            return _argument_types[url]
+
+        argument_types = dict()
+        try:
+            result = run_query(url, ARGUMENT_TYPES_QUERY, None)
+            schema = result['data']['__schema'] if result and result.get('data') else None
+        except requests.exceptions.RequestException:
+            schema = None
+
+        if isinstance(schema, dict):
+            for operation_type in ['query', 'mutation']:
+                for field in (schema.get(operation_type + 'Type') or dict()).get('fields') or list():
+                    argument_types[(operation_type, field['name'])] = {a['name']: graphql_type_name(a['type'])
+                                                                       for a in field['args']}
+        else:
+            arcpy.AddWarning("Can't read the argument types of the urban api, using the default types.")
+
+        _argument_types[url] = argument_types
+        return argument_types
+
+
+def declare_arguments(url, operation_type, field, arguments):
+    '''
+    declares one variable per argument of field, with the argument type of the urban api schema. The given type
+    is only used when the schema can't be read.
+    :param arguments: argument name: (variable name, graphql type)
+    :return: variable definitions, field arguments
+    '''
+    declared = get_argument_types(url).get((operation_type, field), dict())
+
+    definitions = ["${}: {}".format(variable, declared.get(name, graphql_type))
+                   for name, (variable, graphql_type) in arguments.items()]
+    argument_list = ["{}: ${}".format(name, variable) for name, (variable, graphql_type) in arguments.items()]
+
+    return ", ".join(definitions), ", ".join(argument_list)
+
+
+def build_mutation(url, field, arguments, selection):
+    '''
+    builds a mutation document of field with variables declared as in the urban api schema
+    :param arguments: argument name: (variable name, graphql type)
+    :param selection: selection set without the outer braces
+    '''
+    definitions, argument_list = declare_arguments(url, 'mutation', field, arguments)
+    return "mutation({}){{\n    {}({}){{ {} }}\n}}".format(definitions, field, argument_list, selection)
+
+
+def fetch_pages(url, build_query, result_key, page_size=QUERY_PAGE_SIZE, max_workers=QUERY_WORKERS):
+    '''
+    Runs an offset paged list query and yields its records in page order while the next pages download.
+    The page count is unknown up front: the first request asks for one page, every next round asks for twice
+    as many pages side by side, up to max_workers, until a page comes back short or empty.
+    :param url: urban api url
+    :param build_query: function(offset_nr, limit) that returns the query for that page
+    :param result_key: key of the record list in result['data']
+    :param page_size: records per page
+    :param max_workers: maximum number of pages requested at the same time
+    :return: generator of records
+    :raises QueryFailed: when a page could not be read, so a failed page is not taken for the last one
+    '''
+    def fetch(offset_nr):
+        result = run_query(url, build_query(offset_nr, page_size), None)  # Execute the query
+
+        if result and result.get('data'):
+            return result['data'].get(result_key) or list()
+        else:
+            raise QueryFailed("Failed to read " + result_key + " at offset " + str(offset_nr) + ".")
+
+    offset_nr = 0
+    round_size = 1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            offsets = [offset_nr + i * page_size for i in range(round_size)]
+
+            for page in executor.map(fetch, offsets):
+                for record in page:
+                    yield record
+
+                if len(page) < page_size:  # last page
+                    return
+
+            offset_nr += round_size * page_size
+            round_size = min(round_size * 2, max_workers)
+
+
+def run_mutation_batches(url, build_mutation, batches, result_key, max_workers=MUTATION_WORKERS,
+                         retries=MUTATION_RETRIES, idempotent=False, on_rejected=None):
+    '''
+    Sends one mutation per batch, max_workers at the same time. A batch whose request could not be sent is sent
+    again up to retries times, with backoff. A batch that reached the server and failed, timed out or returned
+    errors may have been applied, so it is only sent again when the mutation is idempotent, as updates are.
+    :param url: urban api url
+    :param build_mutation: function(batch) that returns the mutation and its variables for that batch
+    :param batches: list of batches
+    :param result_key: key of the returned record list in result['data']
+    :param max_workers: maximum number of mutations sent at the same time
+    :param retries: number of times a failed batch is sent again
+    :param idempotent: sending the mutation twice has the same effect as sending it once
+    :param on_rejected: function(result) called when the api rejects a batch without running it
+    :return: list with per batch the returned records, or None if the batch failed
+    '''
+    def send(batch):
+        mutation, variables = build_mutation(batch)
+
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(QUERY_BACKOFF * (2 ** (attempt - 1)) * (1 + random.random()))
+
+            try:
+                result = run_query(url, mutation, variables)  # Execute the mutation
+            except requests.exceptions.RequestException as e:
+                arcpy.AddWarning("Batch of {} failed: {}".format(len(batch), str(e)))
+                if idempotent or is_unsent_request_error(e):
+                    continue
+                return None
+
+            if result and not result.get('errors') and result.get('data'):
+                query_result = result['data'].get(result_key)
+                if query_result:
+                    return query_result
+
+            if on_rejected and is_rejected(result):
+                on_rejected(result)
+
+            if not idempotent:
+                return None
+
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(send, batches))
+
+
+def report_throughput(operation, done, total, nr_bytes, nr_batches, failed_batches, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    arcpy.AddMessage("{}: {} of {} features in {} batches ({:.1f} MB), {:.0f} features/s, {:.2f} MB/s.".format(
+        operation, done, total, nr_batches, nr_bytes / 1e6, done / elapsed, nr_bytes / 1e6 / elapsed))
+
+    if failed_batches:
+        arcpy.AddWarning("{}: {} batches failed after retries.".format(operation, failed_batches))
+
+
+class OperationBatch(object):
+    '''
+    collects small queries or mutations and sends them as aliased operations in one document per
+    BATCH_MAX_OPERATIONS, documents are sent side by side. When a document fails as a whole, its operations
+    are sent again one by one; for mutations only when the api rejected the document without running it.
+    usage:
+        batch = OperationBatch(urban_api_url, 'mutation')
+        index = batch.add('updateBranches', {'urbanDatabaseId': ('PortalItemId!', udb_id),
+                                             'branches': ('[UpdateBranchInput!]!', branches)}, 'attributes{GlobalID}')
+        results = batch.run()   # results[index] is the data of that operation or None
+    '''
+
+    def __init__(self, url, operation_type='query', max_operations=BATCH_MAX_OPERATIONS, max_workers=QUERY_WORKERS):
+        self.url = url
+        self.operation_type = operation_type
+        self.max_operations = max_operations
+        self.max_workers = max_workers
+        self.operations = list()
+
+    def add(self, field, arguments, selection):
+        '''
+        :param field: query or mutation field
+        :param arguments: argument name: (graphql type, value)
+        :param selection: selection set without the outer braces
+        :return: index of the operation in the results
+        '''
+        self.operations.append((field, arguments, selection))
+        return len(self.operations) - 1
+
+    def build_document(self, operations):
+        definitions = list()
+        fields = list()
+        variables = dict()
+
+        for i, (index, (field, arguments, selection)) in enumerate(operations):
+            typed_variables = dict()
+            for name, (graphql_type, value) in arguments.items():
+                variable = "v{}_{}".format(i, name)
+                typed_variables[name] = (variable, graphql_type)
+                variables[variable] = value
+
+            field_definitions, argument_list = declare_arguments(self.url, self.operation_type, field,
+                                                                 typed_variables)
+            definitions.append(field_definitions)
+            fields.append("op{}: {}({}){{ {} }}".format(i, field, argument_list, selection))
+
+        document = "{}({}){{\n{}\n}}".format(self.operation_type, ", ".join(definitions), "\n".join(fields))
+        return document, variables
+
+    def send(self, operations):
+        document, variables = self.build_document(operations)
+        result = run_query(self.url, document, variables)
+
+        if result and result.get('data'):
+            data = result['data']
+            return [data.get("op{}".format(i)) for i in range(len(operations))]
+        elif len(operations) > 1 and (self.operation_type != 'mutation' or is_rejected(result)):
+            # aliasing failed, send the operations separately. Mutations only when none of them ran.
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return [r[0] for r in executor.map(self.send, [[operation] for operation in operations])]
+        else:
+            return [None] * len(operations)
+
+    def run(self):
+        indexed = list(enumerate(self.operations))
+        documents = [indexed[i:i + self.max_operations] for i in range(0, len(indexed), self.max_operations)]
+        results = [None] * len(self.operations)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for operations, document_results in zip(documents, executor.map(self.send, documents)):
+                for (index, operation), result in zip(operations, document_results):
+                    results[index] = result
+
+        self.operations = list()
+        return results
+
+
 def get_indicators(urban_model, id_list):
     indicator_list = list()
 
@@ -938,94 +1488,34 @@ def get_indicators(urban_model, id_list):
 
 
 def update_indicator_context_scene(urban_api_url, udb_id, scene_id, global_id):
-    mutation_template = Template("""mutation{
-             updateIndicators(urbanDatabaseId: "$udb_id", 
-                              indicators: [
-                                 {
-                                     attributes:
-                                     {
-                                         GlobalID: "$global_id"
-                                         WebsceneItemId: "$webscene_id"
-                         }                
-                     }
-                  ] 
-               )  
-             {  
-                attributes{
-                    WebsceneItemId
-                }              
-             }               
-          }""")
-
-    query = mutation_template.substitute(udb_id=udb_id,
-                                         webscene_id=scene_id,
-                                         global_id=global_id)
+    return update_context_scenes(urban_api_url, [("indicator", udb_id, scene_id, global_id)])[0]
 
-    if query:
-        result = run_query(urban_api_url, query, None)  # Execute the mutation
 
-        if result:
-            if result['data']:
-                return True
-            else:
-                return False
-        else:
-            return False
-    else:
-        return False
+# argument name: (variable name, graphql type used when the urban api schema can't be read)
+CREATE_INDICATORS_ARGUMENTS = {'urbanDatabaseId': ('udb_id', 'PortalItemId!'),
+                               'indicators': ('indicators', '[CreateIndicatorInput!]!')}
+CREATE_INDICATORS_SELECTION = "attributes{ EndDate IndicatorName IndicatorType OwnerName StartDate Description " \
+                              "WebsceneItemId }"
 
 
 def add_indicator(urban_api_url, db_id, attr_list):
+    indicator = {'attributes': {'EndDate': attr_list[0],
+                                'IndicatorName': attr_list[1],
+                                'IndicatorType': attr_list[2],
+                                'OwnerName': attr_list[3],
+                                'StartDate': attr_list[4],
+                                'CustomID': attr_list[1],
+                                'Description': attr_list[5],
+                                'WebsceneItemId': attr_list[6]}}
+
+    mutation = build_mutation(urban_api_url, 'createIndicators', CREATE_INDICATORS_ARGUMENTS,
+                              CREATE_INDICATORS_SELECTION)
+    result = run_query(urban_api_url, mutation,
+                       {'udb_id': db_id, 'indicators': [indicator]})  # Execute the mutation
 
-    mutation_template = Template("""mutation{
-         createIndicators(urbanDatabaseId: "$udb_id", 
-                          indicators: [
-                             {
-                                 attributes:
-                                 {
-                                      EndDate: $start_date
-                                      IndicatorName: "$name"
-                                      IndicatorType: $type
-                                      OwnerName: "$owner"
-                                      StartDate: $end_date
-                                      CustomID: "$name"
-                                      Description: "$description"
-                                      WebsceneItemId: "$webscene_id"
-                     }                
-                 }
-              ] 
-           )  
-         {  
-            attributes{
-                EndDate
-                IndicatorName
-                IndicatorType
-                OwnerName
-                StartDate
-                Description
-                WebsceneItemId 
-          }              
-        }               
-      }""")
-
-    query = mutation_template.substitute(udb_id=db_id,
-                                         start_date=attr_list[0],
-                                         name=attr_list[1],
-                                         type=attr_list[2],
-                                         owner=attr_list[3],
-                                         end_date=attr_list[4],
-                                         description=attr_list[5],
-                                         webscene_id=attr_list[6]
-                                         )
-
-    if query:
-        result = run_query(urban_api_url, query, None)  # Execute the mutation
-
-        if result:
-            if result['data']:
-                return True
-            else:
-                return False
+    if result:
+        if result.get('data'):
+            return True
         else:
             return False
     else:
@@ -1035,108 +1525,81 @@ def add_indicator(urban_api_url, db_id, attr_list):
 def get_urban_models(urban_api_url, org_id, users):
     urban_model_list = list()
 
-    offset_nr = 0
-    do_continue = True
+    if users:
+        query_template = Template("""query{
+            urbanModels(organization: "$org_id", owners: [$users], limit: $limit, offset: $offset_nr)
+            {
+                id
+                owner
+                created
+                title
+                version
+                urbanDatabaseId
+                folderId
+            }
+        }""")
 
-    while do_continue:
-        nr_returns = 0
+        clean_list = '[%s]' % ', '.join(map(str, users))
+        clean_list = ','.join(['"' + x + '"' for x in clean_list[1:-1].split(',')])
 
-        if users:
-            query_template = Template("""query{
-                urbanModels(organization: "$org_id", owners: [$users], limit: 100, offset: $offset_nr)
-                {
-                    id
-                    owner
-                    created
-                    title
-                    version
-                    urbanDatabaseId
-                    folderId
-                }
-            }""")
+        def build_query(offset_nr, limit):
+            return query_template.substitute(org_id=org_id, users=clean_list, limit=limit, offset_nr=offset_nr)
+    else:
+        query_template = Template("""query{
+                    urbanModels(organization: "$org_id", limit: $limit, offset: $offset_nr)
+                    {
+                        id
+                        owner
+                        created
+                        title
+                        version
+                        urbanDatabaseId
+                        folderId
+                    }
+                }""")
 
-            clean_list = '[%s]' % ', '.join(map(str, users))
-            clean_list = ','.join(['"' + x + '"' for x in clean_list[1:-1].split(',')])
+        def build_query(offset_nr, limit):
+            return query_template.substitute(org_id=org_id, limit=limit, offset_nr=offset_nr)
 
-            query = query_template.substitute(org_id=org_id, users=clean_list, offset_nr=offset_nr)
-        else:
-            query_template = Template("""query{
-                        urbanModels(organization: "$org_id", limit: 100, offset: $offset_nr)
-                        {
-                            id
-                            owner
-                            created
-                            title
-                            version
-                            urbanDatabaseId
-                            folderId
-                        }
-                    }""")
-
-            query = query_template.substitute(org_id=org_id, offset_nr=offset_nr)
-
-        if query:
-            result = run_query(urban_api_url, query, None)  # Execute the query
-
-            if result:
-                if result['data']:
-                    query_result = result['data']['urbanModels']
-                    if query_result:
-                        if len(query_result) > 0:
-                            for m in query_result:
-                                # we need these
-                                try:
-                                    owner = m['owner']
-                                    name = m['title']
-                                    id = m['id']
-                                    version = m['version']
-                                    title = m['title']
-                                    master_id = m['urbanDatabaseId']
-                                    creation_date = m['created']
-                                    folder_id = m['folderId']
-
-                                    if owner and name and id and version and title \
-                                            and master_id and creation_date:  # and folder_id:
-                                        if users:
-                                            if folder_id:
-                                                add_model = True
-                                            else:
-                                                add_model = True  # False (switched for now)
-                                        else:
-                                            add_model = True
-                                    else:
-                                        add_model = False
-                                except:
-                                    add_model = False
-
-                                if add_model:
-                                    if check_min_version(version, get_min_supported_version()):
-                                        urban_model = UrbanModel(owner,
-                                                                 name,
-                                                                 id,
-                                                                 version,
-                                                                 folder_id,
-                                                                 title,
-                                                                 master_id,
-                                                                 urban_api_url,
-                                                                 creation_date)
-
-                                        urban_model_list.append(urban_model)
-
-                                nr_returns += 1
-                        else:
-                            do_continue = False
+    for m in fetch_pages(urban_api_url, build_query, 'urbanModels'):
+        # we need these
+        try:
+            owner = m['owner']
+            name = m['title']
+            id = m['id']
+            version = m['version']
+            title = m['title']
+            master_id = m['urbanDatabaseId']
+            creation_date = m['created']
+            folder_id = m['folderId']
+
+            if owner and name and id and version and title \
+                    and master_id and creation_date:  # and folder_id:
+                if users:
+                    if folder_id:
+                        add_model = True
                     else:
-                        do_continue = False
+                        add_model = True  # False (switched for now)
                 else:
-                    do_continue = False
+                    add_model = True
             else:
-                do_continue = False
-
-        if nr_returns < 100:  # search limit = 100
-            do_continue = False
-        else:
-            offset_nr += 100
+                add_model = False
+        except:
+            add_model = False
+
+        if add_model:
+            if check_min_version(version, get_min_supported_version()):
+                urban_model = UrbanModel(owner,
+                                         name,
+                                         id,
+                                         version,
+                                         folder_id,
+                                         title,
+                                         master_id,
+                                         urban_api_url,
+                                         creation_date)
+
+                urban_model_list.append(urban_model)
 
     return urban_model_list
 
@@ -1186,24 +1649,24 @@ def get_urban_models_names_date(model_list):
         )
 
 
+def get_model_date_string(model):
+    date_stamp = dt.datetime.fromtimestamp(model.creation_date / 1000)
+    return date_stamp.strftime("%d-%b-%Y")
+
+
+def get_event_ui_name(event):
+    return str(event.event_name + " (" + event.access + " " + event.event_type.lower() + ")")
+
+
 def select_model_by_title_owner_date(model_list, title):
     try:
-        model = None
-
         string_list = title.split("{")
         title_string = string_list[0].strip()
         string_list = string_list[1].split(":")
         owner = string_list[0].replace("}", "")
         date = string_list[1].strip().replace("}", "")
 
-        for m in model_list:
-            date_stamp = dt.datetime.fromtimestamp(m.creation_date / 1000)
-            m_date = date_stamp.strftime("%d-%b-%Y")
-
-            if m.model_title == title_string and m.owner == owner and date == m_date:
-                model = m
-                break
-        return model
+        return urban_catalog.models(model_list)['title_owner_date'].get((title_string, owner, date))
 
     except:
         raise FunctionError(
@@ -1215,17 +1678,11 @@ def select_model_by_title_owner_date(model_list, title):
 
 def select_model_by_title_owner(model_list, title):
     try:
-        model = None
-
         string_list = title.split("{")
         title_string = string_list[0].strip()
         owner = string_list[1].replace("}", "")
 
-        for m in model_list:
-            if m.model_title == title_string and m.owner == owner:
-                model = m
-                break
-        return model
+        return urban_catalog.models(model_list)['title_owner'].get((title_string, owner))
 
     except:
         raise FunctionError(
@@ -1237,20 +1694,11 @@ def select_model_by_title_owner(model_list, title):
 
 def select_model_by_title_date(model_list, title):
     try:
-        model = None
-
         string_list = title.split("{")
         title_string = string_list[0].strip()
         date = string_list[1].replace("}", "")
 
-        for m in model_list:
-            date_stamp = dt.datetime.fromtimestamp(m.creation_date / 1000)
-            m_date = date_stamp.strftime("%d-%b-%Y")
-
-            if m.model_title == title_string and date == m_date:
-                model = m
-                break
-        return model
+        return urban_catalog.models(model_list)['title_date'].get((title_string, date))
 
     except:
         raise FunctionError(
@@ -1262,16 +1710,10 @@ def select_model_by_title_date(model_list, title):
 
 def select_model_by_title(model_list, title):
     try:
-        model = None
-
         string_list = title.split("{")
         title_string = string_list[0].strip()
 
-        for m in model_list:
-            if m.model_title == title_string:
-                model = m
-                break
-        return model
+        return urban_catalog.models(model_list)['title'].get(title_string)
 
     except:
         raise FunctionError(
@@ -1283,14 +1725,7 @@ def select_model_by_title(model_list, title):
 
 def select_event_by_title(event_list, title):
     try:
-        event = None
-        for e in event_list:
-            ui_event_name = str(e.event_name +
-                                " (" + e.access + " " + e.event_type.lower() + ")")
-            if ui_event_name == title:
-                event = e
-                break
-        return event
+        return urban_catalog.events(event_list)['title'].get(title)
 
     except:
         raise FunctionError(
@@ -1302,12 +1737,7 @@ def select_event_by_title(event_list, title):
 
 def select_scenario_by_title(scenario_list, title):
     try:
-        scenario = None
-        for s in scenario_list:
-            if s.branch_name == title:
-                scenario = s
-                break
-        return scenario
+        return urban_catalog.scenarios(scenario_list)['title'].get(title)
 
     except:
         raise FunctionError(
@@ -1317,6 +1747,18 @@ def select_scenario_by_title(scenario_list, title):
         )
 
 
+def select_designs_by_owner(design_list, owner):
+    try:
+        return urban_catalog.designs(design_list)['owner'].get(owner, list())
+
+    except:
+        raise FunctionError(
+            {
+                "function": "select_designs_by_owner"
+            }
+        )
+
+
 def get_scenarios(urban_model, event):
     scenario_list = list()
 
@@ -1422,11 +1864,7 @@ def get_urban_event_geometry(urban_model, event, get_z, output_ws, output_featur
         return None
 
 
-def get_urban_events20(urban_model, design_id, search_type, access, users):
-    urban_event_list = list()
-    query_template = Template("""query{
-         $query_type(urbanDatabaseId: "$udb_id", limit: 100, offset: $offset_nr){
-             attributes{
+URBAN_EVENTS20_SELECTION = """attributes{
                  GlobalID
                  EventName
                  ContextWebsceneItemId
@@ -1437,77 +1875,88 @@ def get_urban_events20(urban_model, design_id, search_type, access, users):
                      spatialReference{
                         wkid
                     } 
-                }
-       }
-     }""")
+                }"""
 
-    offset_nr = 0
-    do_continue = True
 
+def get_urban_events20_query_type(search_type):
     if search_type.lower() == "plan":
-        query_type = "plans"
+        return "plans"
     else:
-        query_type = "projects"
+        return "projects"
 
-    while do_continue:
-        nr_returns = 0
 
-        query = query_template.substitute(query_type=query_type, udb_id=design_id, offset_nr=offset_nr)
+def make_urban_events20(urban_model, design_id, search_type, access, users, records):
+    urban_event_list = list()
 
-        if query:
-            result = run_query(urban_model.urban_api_url, query, None)  # Execute the query
+    for e in records:
+        geom_json = json.dumps(e['geometry'])
 
-            if result:
-                if result['data']:
-                    if search_type.lower() == "plan":
-                        query_result = result['data']['plans']
-                    else:
-                        query_result = result['data']['projects']
-
-                    if query_result:
-                        if len(query_result) > 0:
-                            for e in query_result:
-                                geom_json = json.dumps(e['geometry'])
-
-                                urban_event = UrbanEvent20(urban_model,
-                                                           design_id,
-                                                           e['attributes']['GlobalID'],
-                                                           e['attributes']['EventName'],
-                                                           e['attributes']['ContextWebsceneItemId'],
-                                                           e['attributes']['OwnerName'],
-                                                           search_type,
-                                                           geom_json,
-                                                           access)
-
-                                # filter on users
-                                if users:
-                                    if e['attributes']['OwnerName'] in users:
-                                        urban_event_list.append(urban_event)
-                                else:
-                                    urban_event_list.append(urban_event)
-
-                                nr_returns += 1
-                        else:
-                            do_continue = False
-                    else:
-                        do_continue = False
-                else:
-                    do_continue = False
-            else:
-                do_continue = False
+        urban_event = UrbanEvent20(urban_model,
+                                   design_id,
+                                   e['attributes']['GlobalID'],
+                                   e['attributes']['EventName'],
+                                   e['attributes']['ContextWebsceneItemId'],
+                                   e['attributes']['OwnerName'],
+                                   search_type,
+                                   geom_json,
+                                   access)
 
-        if nr_returns < 100:  # search limit = 100
-            do_continue = False
+        # filter on users
+        if users:
+            if e['attributes']['OwnerName'] in users:
+                urban_event_list.append(urban_event)
         else:
-            offset_nr += 100
+            urban_event_list.append(urban_event)
 
     return urban_event_list
 
 
+def get_urban_events20(urban_model, design_id, search_type, access, users):
+    query_template = Template("""query{
+         $query_type(urbanDatabaseId: "$udb_id", limit: $limit, offset: $offset_nr){
+             $selection
+       }
+     }""")
+
+    query_type = get_urban_events20_query_type(search_type)
+
+    def build_query(offset_nr, limit):
+        return query_template.substitute(query_type=query_type, udb_id=design_id, limit=limit, offset_nr=offset_nr,
+                                         selection=URBAN_EVENTS20_SELECTION)
+
+    return make_urban_events20(urban_model, design_id, search_type, access, users,
+                               fetch_pages(urban_model.urban_api_url, build_query, query_type))
+
+
+def get_urban_events20_for_designs(urban_model, design_ids, search_type, access, users):
+    '''
+    gets the first page of events of all designs in one aliased query, only designs with more events than
+    that are paged separately
+    :return: dict design_id: list of UrbanEvent20
+    '''
+    query_type = get_urban_events20_query_type(search_type)
+    batch = OperationBatch(urban_model.urban_api_url, 'query')
+
+    for design_id in design_ids:
+        batch.add(query_type, {'urbanDatabaseId': ('PortalItemId!', design_id),
+                               'limit': ('Int', QUERY_PAGE_SIZE), 'offset': ('Int', 0)},
+                  URBAN_EVENTS20_SELECTION)
+
+    design_events = dict()
+    for design_id, records in zip(design_ids, batch.run()):
+        if records is None or len(records) >= QUERY_PAGE_SIZE:
+            design_events[design_id] = get_urban_events20(urban_model, design_id, search_type, access, users)
+        else:
+            design_events[design_id] = make_urban_events20(urban_model, design_id, search_type, access, users,
+                                                           records)
+
+    return design_events
+
+
 def get_urban_events(urban_model, design_id, search_type):
     urban_event_list = list()
     query_template = Template("""query{
-         urbanEvents(urbanDatabaseId: "$udb_id", limit: 100, offset: $offset_nr){
+         urbanEvents(urbanDatabaseId: "$udb_id", limit: $limit, offset: $offset_nr){
              attributes{
                  GlobalID
                  EventName
@@ -1518,46 +1967,19 @@ def get_urban_events(urban_model, design_id, search_type):
      }""")
 
 #    type_string = "EventType='" + search_type.lower() + "'"
-    offset_nr = 0
-    do_continue = True
-
-    while do_continue:
-        nr_returns = 0
-
-        query = query_template.substitute(udb_id=design_id, offset_nr=offset_nr)
-
-        if query:
-            result = run_query(urban_model.urban_api_url, query, None)  # Execute the query
-
-            if result:
-                if result['data']:
-                    query_result = result['data']['urbanEvents']
-                    if query_result:
-                        if len(query_result) > 0:
-                            for e in query_result:
-                                if e['attributes']['EventType'].lower() == search_type.lower():
-                                    urban_event = UrbanEvent(urban_model,
-                                                             design_id,
-                                                             e['attributes']['GlobalID'],
-                                                             e['attributes']['EventName'],
-                                                             e['attributes']['EventType'],
-                                                             e['attributes']['ContextWebsceneItemId'])
-                                    urban_event_list.append(urban_event)
-
-                                nr_returns += 1
-                        else:
-                            do_continue = False
-                    else:
-                        do_continue = False
-                else:
-                    do_continue = False
-            else:
-                do_continue = False
 
-        if nr_returns < 100:  # search limit = 100
-            do_continue = False
-        else:
-            offset_nr += 100
+    def build_query(offset_nr, limit):
+        return query_template.substitute(udb_id=design_id, limit=limit, offset_nr=offset_nr)
+
+    for e in fetch_pages(urban_model.urban_api_url, build_query, 'urbanEvents'):
+        if e['attributes']['EventType'].lower() == search_type.lower():
+            urban_event = UrbanEvent(urban_model,
+                                     design_id,
+                                     e['attributes']['GlobalID'],
+                                     e['attributes']['EventName'],
+                                     e['attributes']['EventType'],
+                                     e['attributes']['ContextWebsceneItemId'])
+            urban_event_list.append(urban_event)
 
     return urban_event_list
 
@@ -1565,19 +1987,19 @@ def get_urban_events(urban_model, design_id, search_type):
 def get_urban_events_for_designs(gis, urban_model, urban_designs, search_name):
     try:
         urban_event_list = list()
-        fail = False
+        design_ids = [design.design_id for design in
+                      urban_catalog.designs(urban_designs)['model'].get(urban_model.model_id, list())]
 
-        for design in urban_designs:
-            try:
-                if urban_model.model_id == design.urban_model_id:
-                    # use featureServiceID of item to make UrbanEvent via URBAN API
-                    # TODO -> confirm there can only be 1 event per plan or project: see[0]
-                    all_urban_events = get_urban_events20(urban_model, design.design_id, search_name,
-                                                          "private", [gis.users.me.username])
-                    if len(all_urban_events) > 0:
-                        urban_event_list.append(all_urban_events[0])
-            except:
-                fail = True
+        if design_ids:
+            # use featureServiceID of item to make UrbanEvent via URBAN API
+            design_events = get_urban_events20_for_designs(urban_model, design_ids, search_name,
+                                                           "private", [gis.users.me.username])
+
+            for design_id in design_ids:
+                # TODO -> confirm there can only be 1 event per plan or project: see[0]
+                all_urban_events = design_events.get(design_id)
+                if all_urban_events:
+                    urban_event_list.append(all_urban_events[0])
 
         return urban_event_list
     except:
@@ -1593,91 +2015,62 @@ def get_private_urban_events(urban_events_design, urban_events_master):
     private_urban_event_list = list()
 
     if len(urban_events_design) > 0 and len(urban_events_master) > 0:
+        master_events = urban_catalog.events(urban_events_master)['master_name']
+
         for d_event in urban_events_design:
-            add = True
-            for m_event in urban_events_master:
-                # check if in master events on name and urban model id
-                if d_event.urban_model.master_id == m_event.urban_model.master_id \
-                        and d_event.event_name == m_event.event_name:
-                    add = False
-            if add:
+            # check if in master events on name and urban model id
+            if (d_event.urban_model.master_id, d_event.event_name) not in master_events:
                 private_urban_event_list.append(d_event)
     return private_urban_event_list
 
 
 def get_urban_designs(urban_model, users, search_type):
     urban_design_list = list()
-    offset_nr = 0
-    do_continue = True
-
-    while do_continue:
-        nr_returns = 0
 
-        if users:
-            query_template = Template("""query{
-                     urbanDesigns(owners: [$users], limit: 100, offset: $offset_nr){
-                         id
-                         urbanModelId
-                         type
-                         title
-                         owner
-                         url
-                         access
-                   }
-                 }""")
-
-            clean_list = '[%s]' % ', '.join(map(str, users))
-            clean_list = ','.join(['"' + x + '"' for x in clean_list[1:-1].split(',')])
-
-            query = query_template.substitute(users=clean_list, offset_nr=offset_nr)
-        else:
-            query_template = Template("""query{
-                                 urbanDesigns(limit: 100, offset: $offset_nr){
-                                     id
-                                     urbanModelId
-                                     type
-                                     title
-                                     owner
-                                     url
-                               }
-                             }""")
-
-            query = query_template.substitute(offset_nr=offset_nr)
-
-        if query:
-            result = run_query(urban_model.urban_api_url, query, None)  # Execute the query
-
-            if result:
-                if result['data']:
-                    query_result = result['data']['urbanDesigns']
-                    if query_result:
-                        if len(query_result) > 0:
-                            for e in query_result:
-                                if e['type'].lower() == search_type.lower():
-                                    urban_design = UrbanDesign(urban_model,
-                                                               e['id'],
-                                                               e['urbanModelId'],
-                                                               e['type'],
-                                                               e['title'],
-                                                               e['owner'],
-                                                               e['url'])
-
-                                    urban_design_list.append(urban_design)
-
-                                nr_returns += 1
-                        else:
-                            do_continue = False
-                    else:
-                        do_continue = False
-                else:
-                    do_continue = False
-            else:
-                do_continue = False
-
-        if nr_returns < 100:  # search limit = 100
-            do_continue = False
-        else:
-            offset_nr += 100
+    if users:
+        query_template = Template("""query{
+                 urbanDesigns(owners: [$users], limit: $limit, offset: $offset_nr){
+                     id
+                     urbanModelId
+                     type
+                     title
+                     owner
+                     url
+                     access
+               }
+             }""")
+
+        clean_list = '[%s]' % ', '.join(map(str, users))
+        clean_list = ','.join(['"' + x + '"' for x in clean_list[1:-1].split(',')])
+
+        def build_query(offset_nr, limit):
+            return query_template.substitute(users=clean_list, limit=limit, offset_nr=offset_nr)
+    else:
+        query_template = Template("""query{
+                             urbanDesigns(limit: $limit, offset: $offset_nr){
+                                 id
+                                 urbanModelId
+                                 type
+                                 title
+                                 owner
+                                 url
+                           }
+                         }""")
+
+        def build_query(offset_nr, limit):
+            return query_template.substitute(limit=limit, offset_nr=offset_nr)
+
+    for e in fetch_pages(urban_model.urban_api_url, build_query, 'urbanDesigns'):
+        if e['type'].lower() == search_type.lower():
+            urban_design = UrbanDesign(urban_model,
+                                       e['id'],
+                                       e['urbanModelId'],
+                                       e['type'],
+                                       e['title'],
+                                       e['owner'],
+                                       e['url'])
+
+            urban_design_list.append(urban_design)
 
     return urban_design_list
 
@@ -1744,37 +2137,10 @@ def get_base_context_scene(urban_api_url, model_id):
 
 
 def add_base_context_scene(urban_api_url, model_id, scene_id):
+    return update_urban_model_configs(urban_api_url, [(model_id, "customBaselayersItemId", scene_id)])[0]
 
-    mutation_template = Template("""mutation{
-        updateUrbanModelConfig(urbanModelId: "$model_id", 
-            urbanModelConfig: 
-            {
-                customBaselayersItemId: "$scene_id"
-            }
-        )  
-        {
-            customBaselayersItemId
-        }
-      }""")
-
-    query = mutation_template.substitute(model_id=model_id, scene_id=scene_id)
-
-    if query:
-        result = run_query(urban_api_url, query, None)  # Execute the mutation
-
-        if result:
-            if result['data']:
-                return True
-            else:
-                return False
-        else:
-            return False
-    else:
-        return False
-
-
-def add_base_layer(urban_api_url, model_id, base_layer_type, layer_id):
 
+def get_base_layer_param(base_layer_type):
     if base_layer_type == "Existing buildings for schematic visualization":
         base_layer_param = "existingBuildingsLayerItemId"
     elif base_layer_type == "Existing buildings for satellite visualization":
@@ -1784,117 +2150,97 @@ def add_base_layer(urban_api_url, model_id, base_layer_type, layer_id):
     else:
         base_layer_param = None
 
-    if base_layer_param:
-        mutation_template = Template("""mutation{
-            updateUrbanModelConfig(urbanModelId: "$model_id", 
-                urbanModelConfig: 
-                {
-                    $base_layer_param: "$layer_id"
-                }
-            )  
-            {
-                $base_layer_param
-            }
-          }""")
+    return base_layer_param
 
-        query = mutation_template.substitute(model_id=model_id, base_layer_param=base_layer_param, layer_id=layer_id)
 
-        if query:
-            result = run_query(urban_api_url, query, None)  # Execute the mutation
+def add_base_layer(urban_api_url, model_id, base_layer_type, layer_id):
+    return add_base_layers(urban_api_url, model_id, [(base_layer_type, layer_id)])[0]
 
-            if result:
-                if result['data']:
-                    return True
-                else:
-                    return False
-            else:
-                return False
-        else:
-            return False
-    else:
-        return False
+
+def add_base_layers(urban_api_url, model_id, base_layers):
+    '''
+    :param base_layers: list of (base layer type, layer item id)
+    :return: list with per base layer True if it was set
+    '''
+    updates = [(model_id, get_base_layer_param(base_layer_type), layer_id)
+               for base_layer_type, layer_id in base_layers]
+    results = update_urban_model_configs(urban_api_url, [u for u in updates if u[1]])
+    results = iter(results)
+
+    return [next(results) if u[1] else False for u in updates]
+
+
+def update_urban_model_configs(urban_api_url, updates):
+    '''
+    sets urban model config items, all items of one model go in one mutation, all models in one aliased document
+    :param updates: list of (model_id, config parameter, value)
+    :return: list with per update True if it succeeded
+    '''
+    configs = dict()
+    for model_id, param, value in updates:
+        configs.setdefault(model_id, dict())[param] = value
+
+    batch = OperationBatch(urban_api_url, 'mutation')
+    model_index = dict()
+
+    for model_id, config in configs.items():
+        model_index[model_id] = batch.add('updateUrbanModelConfig',
+                                          {'urbanModelId': ('PortalItemId!', model_id),
+                                           'urbanModelConfig': ('UpdateUrbanModelConfigInput!', config)},
+                                          " ".join(config.keys()))
+
+    results = batch.run()
+
+    return [bool(results[model_index[model_id]]) for model_id, param, value in updates]
 
 
 def update_event_context_scene(urban_api_url, udb_id, scene_id, global_id):
-        mutation_template = Template("""mutation{
-             updateUrbanEvents(urbanDatabaseId: "$udb_id", 
-                              urbanEvents: [
-                                 {
-                                     attributes:
-                                     {
-                                         GlobalID: "$global_id"
-                                         ContextWebsceneItemId: "$webscene_id"
-                         }                
-                     }
-                  ] 
-               )  
-             {  
-                attributes{
-                    ContextWebsceneItemId
-                }              
-             }               
-          }""")
+    return update_context_scenes(urban_api_url, [("event", udb_id, scene_id, global_id)])[0]
 
-        query = mutation_template.substitute(udb_id=udb_id,
-                                             webscene_id=scene_id,
-                                             global_id=global_id)
 
-        if query:
-            result = run_query(urban_api_url, query, None)  # Execute the mutation
+# context scene attribute, mutation, list argument, list type per kind of urban object
+CONTEXT_SCENE_MUTATIONS = {
+    "event": ("ContextWebsceneItemId", "updateUrbanEvents", "urbanEvents", "[UpdateUrbanEventInput!]!"),
+    "scenario": ("ContextWebsceneItemId", "updateBranches", "branches", "[UpdateBranchInput!]!"),
+    "indicator": ("WebsceneItemId", "updateIndicators", "indicators", "[UpdateIndicatorInput!]!")
+}
 
-            if result:
-                if result['data']:
-                    return True
-                else:
-                    return False
-            else:
-                return False
-        else:
-            return False
 
+def update_context_scenes(urban_api_url, updates):
+    '''
+    sets the context scene of many urban events, scenarios and indicators. Updates of the same kind in the same
+    urban database go in one mutation, all mutations go in one aliased document.
+    :param urban_api_url: urban api url
+    :param updates: list of (kind, udb_id, scene_id, global_id), kind is event, scenario or indicator
+    :return: list with per update True if it succeeded
+    '''
+    groups = dict()
+    for kind, udb_id, scene_id, global_id in updates:
+        groups.setdefault((kind, udb_id), list()).append((global_id, scene_id))
 
-def update_scenario_context_scene(urban_api_url, udb_id, scene_id, global_id):
-    mutation_template = Template("""mutation{
-             updateBranches(urbanDatabaseId: "$udb_id", 
-                              branches: [
-                                 {
-                                     attributes:
-                                     {
-                                         GlobalID: "$global_id"
-                                         ContextWebsceneItemId: "$webscene_id"
-                         }                
-                     }
-                  ] 
-               )  
-             {  
-                attributes{
-                    ContextWebsceneItemId
-                }              
-             }               
-          }""")
+    batch = OperationBatch(urban_api_url, 'mutation')
+    group_index = dict()
 
-    query = mutation_template.substitute(udb_id=udb_id,
-                                         webscene_id=scene_id,
-                                         global_id=global_id)
+    for (kind, udb_id), items in groups.items():
+        scene_attribute, field, list_argument, list_type = CONTEXT_SCENE_MUTATIONS[kind]
+        objects = [{'attributes': {'GlobalID': global_id, scene_attribute: scene_id}} for global_id, scene_id in items]
+        group_index[(kind, udb_id)] = batch.add(field, {'urbanDatabaseId': ('PortalItemId!', udb_id),
+                                                        list_argument: (list_type, objects)},
+                                                "attributes{ GlobalID " + scene_attribute + " }")
 
-    if query:
-        result = run_query(urban_api_url, query, None)  # Execute the mutation
+    results = batch.run()
 
-        if result:
-            if result['data']:
-                return True
-            else:
-                return False
-        else:
-            return False
-    else:
-        return False
+    return [bool(results[group_index[(kind, udb_id)]]) for kind, udb_id, scene_id, global_id in updates]
+
+
+def update_scenario_context_scene(urban_api_url, udb_id, scene_id, global_id):
+    return update_context_scenes(urban_api_url, [("scenario", udb_id, scene_id, global_id)])[0]
 
 
 def get_parcel_globalids(urban_api_url, udb_id, scenario_id):
     parcel_list = list()
     query_template = Template("""query{
-         parcels(urbanDatabaseId: "$udb_id", branchID: "$scenario_id", limit: 100, offset: $offset_nr){
+         parcels(urbanDatabaseId: "$udb_id", branchID: "$scenario_id", limit: $limit, offset: $offset_nr){
              attributes{
                  GlobalID
                 }
@@ -1906,152 +2252,380 @@ def get_parcel_globalids(urban_api_url, udb_id, scenario_id):
        }
      }""")
 
-    offset_nr = 0
-    do_continue = True
-    wkid = None
-
-    while do_continue:
-        nr_returns = 0
-
-        query = query_template.substitute(udb_id=udb_id, scenario_id=scenario_id, offset_nr=offset_nr)
-
-        if query:
-            result = run_query(urban_api_url, query, None)  # Execute the query
-
-            if result:
-                if result['data']:
-                    query_result = result['data']['parcels']
-                    if query_result:
-                        if len(query_result) > 0:
-                            for e in query_result:
-                                parcel_list.append(e['attributes']['GlobalID'])
-                                nr_returns += 1
-                                wkid = e['geometry']['spatialReference']['wkid']
-                        else:
-                            do_continue = False
-                    else:
-                        do_continue = False
-                else:
-                    do_continue = False
-            else:
-                do_continue = False
+    def build_query(offset_nr, limit):
+        return query_template.substitute(udb_id=udb_id, scenario_id=scenario_id, limit=limit, offset_nr=offset_nr)
 
-        # arcpy.AddMessage("Retrieved: " + str(len(parcel_list)) + " parcels...")
+    for e in fetch_pages(urban_api_url, build_query, 'parcels'):
+        parcel_list.append(e['attributes']['GlobalID'])
 
-        if nr_returns < 100:  # search limit = 100
-            do_continue = False
-        else:
-            offset_nr += 100
+    # arcpy.AddMessage("Retrieved: " + str(len(parcel_list)) + " parcels...")
 
     return parcel_list
 
 
-def delete_parcels(urban_api_url, udb_id, global_ids):
-    mutation_template = Template("""mutation{
-                            deleteParcels(urbanDatabaseId: "$udb_id",
-                            globalIDs: $global_ids
-                        )
-                    {  
-                        attributes{
-                            GlobalID
-                            }
-                    }               
-    }""")
+DELETE_PARCELS_ARGUMENTS = {'urbanDatabaseId': ('udb_id', 'PortalItemId!'),
+                            'globalIDs': ('global_ids', '[GlobalID!]!')}
 
-    global_ids_as_string = json.dumps(global_ids)
+UPDATE_PARCELS_ARGUMENTS = {'urbanDatabaseId': ('udb_id', 'PortalItemId!'),
+                            'parcels': ('parcels', '[UpdateParcelInput!]!')}
 
-    query = mutation_template.substitute(udb_id=udb_id, global_ids=global_ids_as_string)
 
-    if query:
-        result = run_query(urban_api_url, query, None)  # Execute the mutation
+def delete_parcels(urban_api_url, udb_id, global_ids):
+    mutation = build_mutation(urban_api_url, 'deleteParcels', DELETE_PARCELS_ARGUMENTS, "attributes{ GlobalID }")
+    result = run_query(urban_api_url, mutation,
+                       {'udb_id': udb_id, 'global_ids': list(global_ids)})  # Execute the mutation
 
-        if result:
-            if result['data']:
-                return True
-            else:
-                return False
+    if result:
+        if result.get('data'):
+            # deleted parcels are pushed again when they come back
+            EdgeInfoSnapshot(urban_api_url, udb_id).remove(global_ids)
+            return True
         else:
             return False
     else:
         return False
 
 
-def update_parcels_edgeinfo(urban_api_url, udb_id, global_id_edgeinfo_dict):
-    attribute_template_list = list()
-    global_ids = global_id_edgeinfo_dict.keys()
-
-    # TODO deal with dynamic edge infos
-    edge_info = """
-            EdgeInfos: [
-                            {
-                                adjacencies: [
-                                        {
-                                            category:"cat_testhnhn4"
-                                            type: "street"
-                                            width: 0
-                                        }
-                                ]
-                                orientation: "front"
-                        },
-                        {
-                                adjacencies: [
-                                        {
-                                            category:"cat_testnhnh3"
-                                            type: "street"
-                                            width: 0
-                                        }
-                                ]
-                                orientation: "side"
-                        }
-            ]
-        """
-
-    # create attributes for global_ids
-
-    for global_id in global_ids:
-        attribute_template = Template("""{   
-                                            attributes:
-                                            {
-                                                GlobalID: "$global_id"
-                                                $edge_info
-                                                
-                                            }
-                                        }""")
-
-        attribute_sub = attribute_template.substitute(global_id=global_id, edge_info=edge_info)
-        attribute_template_list.append(attribute_sub)
-
-    clean_list = '[%s]' % ', '.join(map(str, attribute_template_list))
-
-    mutation_template = Template("""mutation{
-        updateParcels(urbanDatabaseId: "$udb_id",
-                            parcels: 
-                                $attribute_template_list                            
-                        )
+# edge info sent for parcels without edge info of their own. Before edge infos could be passed per parcel,
+# every parcel got this one.
+DEFAULT_EDGE_INFO = [
+    {
+        'adjacencies': [
             {
-                attributes{
-                    GlobalID
-                }
+                'category': "cat_testhnhn4",
+                'type': "Street",
+                'width': 0
             }
-        }""")
+        ],
+        'orientation': "Front"
+    },
+    {
+        'adjacencies': [
+            {
+                'category': "cat_testnhnh3",
+                'type': "Street",
+                'width': 0
+            }
+        ],
+        'orientation': "Side"
+    }
+]
 
-    query = mutation_template.substitute(udb_id=udb_id, attribute_template_list=clean_list)
 
-    if query:
-        result = run_query(urban_api_url, query, None)  # Execute the mutation
+class EdgeInfoSnapshot(object):
+    '''
+    content hash of the edge info last pushed per branch and parcel GlobalID of one urban database, kept in a json
+    file in the scratch folder so the next sync only pushes what changed. The snapshot only knows what this tool
+    pushed, update_parcels_edgeinfo(verify=True) checks the parcels it marks unchanged against the server.
+    '''
+    def __init__(self, urban_api_url, udb_id):
+        key = hashlib.sha1((str(urban_api_url) + "|" + str(udb_id)).encode('utf-8')).hexdigest()[:16]
+        self.file_name = EDGEINFO_SNAPSHOT_FILE.format(key)
+        self.branches = None
+
+    @property
+    def path(self):
+        import tempfile
+        folder = getattr(arcpy.env, 'scratchFolder', None) or tempfile.gettempdir()
+        return os.path.join(folder, self.file_name)
+
+    def read(self):
+        '''
+        :return: dict branch id: dict GlobalID: content hash
+        '''
+        if self.branches is None:
+            self.branches = dict()
+            try:
+                with open(self.path, "r") as content:
+                    branches = json.load(content)
+                # files without branches are dropped
+                if all(isinstance(hashes, dict) for hashes in branches.values()):
+                    self.branches = branches
+            except (OSError, ValueError, AttributeError):
+                pass
+        return self.branches
+
+    def load(self, branch_id):
+        '''
+        :return: dict GlobalID: content hash of the parcels of branch_id
+        '''
+        return self.read().setdefault(str(branch_id), dict())
+
+    def save(self):
+        try:
+            temp_file = self.path + "." + str(os.getpid())
+            with open(temp_file, "w") as content:
+                json.dump(self.branches, content)
+            os.replace(temp_file, self.path)
+        except OSError as e:
+            arcpy.AddWarning("Can't write edge info snapshot: " + str(e))
+
+    def update(self, branch_id, hashes):
+        self.load(branch_id).update(hashes)
+        self.save()
+
+    def remove(self, global_ids):
+        for hashes in self.read().values():
+            for global_id in global_ids:
+                hashes.pop(global_id, None)
+        self.save()
+
+
+PARCEL_EDGE_INFOS_QUERY = Template("""query{
+     parcels(urbanDatabaseId: "$udb_id", branchID: "$branch_id", limit: $limit, offset: $offset_nr){
+         attributes{
+             GlobalID
+             EdgeInfos{
+                 adjacencies{
+                     category
+                     type
+                     width
+                 }
+                 orientation
+             }
+         }
+     }
+}""")
 
-        if result:
-            if result['data']:
-                return True
-            else:
-                return False
-        else:
-            return False
+
+def get_server_edge_info_hashes(urban_api_url, udb_id, branch_id):
+    '''
+    content hashes of the edge info the parcels of a branch have on the server, hashed like get_edge_info_hashes
+    :return: Series GlobalID: content hash
+    '''
+    def build_query(offset_nr, limit):
+        return PARCEL_EDGE_INFOS_QUERY.substitute(udb_id=udb_id, branch_id=branch_id, limit=limit,
+                                                  offset_nr=offset_nr)
+
+    # a parcel without edge info on the server has none, not the default edge info
+    edge_infos = {p['attributes']['GlobalID']: p['attributes'].get('EdgeInfos') or list()
+                  for p in fetch_pages(urban_api_url, build_query, 'parcels')}
+    hashes, edge_info_by_hash = get_edge_info_hashes(edge_infos)
+
+    return hashes
+
+
+def get_edge_info_hashes(global_id_edgeinfo_dict):
+    '''
+    :return: Series GlobalID: content hash, dict content hash: edge info to send
+    '''
+    edge_infos = pd.Series(list(global_id_edgeinfo_dict.values()), index=list(global_id_edgeinfo_dict.keys()),
+                           dtype=object)
+
+    # parcels mostly share a few edge infos, each distinct one is converted and hashed once
+    def to_text(value):
+        if value is None or (isinstance(value, str) and not value.strip()):
+            value = DEFAULT_EDGE_INFO
+        elif isinstance(value, str):
+            value = valid_json(value)
+            if value is False:
+                return None
+        value = set_enum_values(value, URBAN_ENUM_VALUES['EdgeInfos'], URBAN_ENUM_KEYS['EdgeInfos'])
+        return json.dumps(value, sort_keys=True)
+
+    texts = edge_infos.map(lambda v: v if isinstance(v, str) else json.dumps(v, sort_keys=True))
+    first = ~texts.duplicated()
+    converted = {text: to_text(value) for text, value in zip(texts[first], edge_infos[first])}
+
+    converted_texts = texts.map(converted)
+    digests = {text: hashlib.sha1(text.encode('utf-8')).hexdigest()
+               for text in converted_texts.dropna().unique()}
+
+    hashes = converted_texts.map(digests)
+    edge_info_by_hash = {digests[text]: json.loads(text) for text in digests}
+
+    return hashes, edge_info_by_hash
+
+
+def update_parcels_edgeinfo(urban_api_url, udb_id, global_id_edgeinfo_dict, force=False, branch_id=None,
+                            verify=False, max_bytes=MUTATION_BYTE_BUDGET, max_workers=MUTATION_WORKERS):
+    '''
+    pushes the edge info of the parcels that changed since the last sync of this branch. Without branch_id all
+    parcels are pushed. With verify, parcels the snapshot marks unchanged are checked against the server, so
+    parcels edited elsewhere or recreated under the same GlobalID are pushed again; this reads all parcels of
+    the branch.
+    The edge info in global_id_edgeinfo_dict is sent per parcel; only parcels with None get DEFAULT_EDGE_INFO,
+    which used to be sent to every parcel.
+    :param global_id_edgeinfo_dict: GlobalID: edge info list or json string, None for the default edge info
+    :param force: push all parcels
+    :param branch_id: GlobalID of the branch (scenario) of the parcels
+    :param verify: check the parcels the snapshot marks unchanged against the server
+    :return: True if all changed parcels were updated
+    '''
+    start_time = time.time()
+    snapshot = EdgeInfoSnapshot(urban_api_url, udb_id)
+
+    hashes, edge_info_by_hash = get_edge_info_hashes(global_id_edgeinfo_dict)
+
+    invalid = hashes.isna()
+    if invalid.any():
+        arcpy.AddWarning("Skipping " + str(int(invalid.sum())) + " parcels with edge info that is not valid json.")
+        hashes = hashes[~invalid]
+
+    # changed subset: hashes that differ from the snapshot, or from the server with verify
+    if force or branch_id is None:
+        changed = hashes
     else:
-        return False
+        previous = pd.Series(snapshot.load(branch_id), dtype=object).reindex(hashes.index)
+        unchanged = hashes.eq(previous)
+
+        if verify and unchanged.any():
+            server = get_server_edge_info_hashes(urban_api_url, udb_id, branch_id).reindex(hashes.index)
+            unchanged &= hashes.eq(server)
+
+        changed = hashes[~unchanged]
+
+    arcpy.AddMessage(str(len(changed)) + " of " + str(len(hashes)) + " parcels have changed edge info.")
+
+    if len(changed) == 0:
+        return True
+
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    hash_size = {h: len(encoder.encode(e)) for h, e in edge_info_by_hash.items()}
+    records = list(zip(changed.index, changed.tolist()))
+
+    mutation = build_mutation(urban_api_url, 'updateParcels', UPDATE_PARCELS_ARGUMENTS, "attributes{ GlobalID }")
+
+    def build_batch(batch):
+        parcels = [{'attributes': {'GlobalID': global_id, 'EdgeInfos': edge_info_by_hash[edge_hash]}}
+                   for global_id, edge_hash in batch]
+        return mutation, {'udb_id': udb_id, 'parcels': parcels}
+
+    # 40 bytes for the attributes, GlobalID and EdgeInfos keys around each parcel
+    batches = list(chunks_by_size(records, max_bytes, size=lambda item: len(item[0]) + hash_size[item[1]] + 40))
+    results = run_mutation_batches(urban_api_url, build_batch, batches, 'updateParcels',
+                                   max_workers=max_workers, idempotent=True)
+
+    # only the parcels that were updated go in the snapshot
+    pushed = dict()
+    for batch, query_result in zip(batches, results):
+        if query_result is not None:
+            pushed.update(batch)
+    if branch_id is not None:
+        snapshot.update(branch_id, pushed)
+
+    report_throughput("updateParcels", len(pushed), len(changed),
+                      sum(len(global_id) + hash_size[edge_hash] + 40 for global_id, edge_hash in records),
+                      len(batches), results.count(None), start_time)
+
+    return len(pushed) == len(changed)
+
+
+class SchemaCache(object):
+    '''
+    attribute type schemas per urban api, model, version and attribute type, in memory and in a json file in the
+    scratch folder so later sessions skip the schema queries. Entries expire after ttl seconds, and are dropped
+    with invalidate_urban_schema when the api rejects a mutation built from them.
+    '''
+    def __init__(self, ttl=SCHEMA_CACHE_TTL, file_name=SCHEMA_CACHE_FILE):
+        self.ttl = ttl
+        self.file_name = file_name
+        self.entries = None
+
+    @property
+    def path(self):
+        import tempfile
+        folder = getattr(arcpy.env, 'scratchFolder', None) or tempfile.gettempdir()
+        return os.path.join(folder, self.file_name)
+
+    @staticmethod
+    def get_key(urban_model, attribute_type):
+        return "|".join([str(urban_model.urban_api_url), str(getattr(urban_model, 'model_id', None)),
+                         str(getattr(urban_model, 'version', None)), attribute_type])
+
+    def load(self):
+        if self.entries is None:
+            self.entries = dict()
+            try:
+                with open(self.path, "r") as content:
+                    self.entries = json.load(content)
+            except (OSError, ValueError):
+                pass
+        return self.entries
+
+    def save(self):
+        try:
+            temp_file = self.path + "." + str(os.getpid())
+            with open(temp_file, "w") as content:
+                json.dump(self.entries, content)
+            os.replace(temp_file, self.path)
+        except OSError as e:
+            arcpy.AddWarning("Can't write urban schema cache: " + str(e))
+
+    def get(self, urban_model, attribute_type, fetch):
+        entries = self.load()
+        key = self.get_key(urban_model, attribute_type)
+        entry = entries.get(key)
+
+        if entry and time.time() - entry[0] < self.ttl:
+            return entry[1]
+
+        value = fetch()
+        if value is not None:
+            entries[key] = (time.time(), value)
+            self.save()
+
+        return value
+
+    def invalidate(self, urban_model=None):
+        entries = self.load()
+        if urban_model is None:
+            entries.clear()
+        else:
+            prefix = self.get_key(urban_model, "")
+            for key in [k for k in entries if k.startswith(prefix)]:
+                del entries[key]
+        self.save()
+
+
+schema_cache = SchemaCache()
 
 
 def get_attribute_type_info(urban_model, attribute_type):
+    return schema_cache.get(urban_model, attribute_type,
+                            lambda: query_attribute_type_info(urban_model, attribute_type))
+
+
+def invalidate_urban_schema(urban_model):
+    '''
+    drops the cached attribute schemas of urban_model and the argument types of its api, the next call reads the
+    current schema
+    '''
+    schema_cache.invalidate(urban_model)
+
+    with _argument_types_lock:
+        _argument_types.pop(urban_model.urban_api_url, None)
+
+
+def get_required_attribute_fields(urban_model, attribute_type):
+    return schema_cache.get(urban_model, attribute_type + "/required",
+                            lambda: query_required_attribute_fields(urban_model, attribute_type))
+
+
+def query_required_attribute_fields(urban_model, attribute_type):
+    type_template = Template("""{
+         __type(name: "$attr_type"){
+                fields
+                {
+                    name
+                    type
+                    {
+                        kind
+                    }
+                }
+        }
+    }""")
+
+    query = type_template.substitute(attr_type=attribute_type)
+    result = run_query(urban_model.urban_api_url, query, None)  # Execute the query
+
+    if result and result.get('data') and result['data'].get('__type'):
+        return [f['name'] for f in result['data']['__type']['fields'] or list() if f['type']['kind'] == 'NON_NULL']
+    else:
+        return None
+
+
+def query_attribute_type_info(urban_model, attribute_type):
     field_info_dict = {}
 
     type_template = Template("""{
@@ -2118,78 +2692,58 @@ def get_attribute_type_info(urban_model, attribute_type):
         return None
 
 
-def get_lod1_buildings(urban_model, scenario):
-    lod1_buildings_list = list()
-
-    attribute_type_info = get_attribute_type_info(urban_model, "LOD1BuildingAttributes")
-
-    if attribute_type_info:
-        query_template = Template("""query{
-             lod1Buildings(urbanDatabaseId: "$udb_id", branchID: "$branch_id", limit: 100, offset: $offset_nr){
-                 attributes{
-                     GlobalID
-                     BranchID
-                     CustomID
-                     Height
-                }
-                 geometry{
-                     rings
-                     spatialReference{
-                        wkid
-                    } 
-                }
-           }
-        }""")
+LOD1_BUILDINGS_QUERY = Template("""query{
+     lod1Buildings(urbanDatabaseId: "$udb_id", branchID: "$branch_id", limit: $limit, offset: $offset_nr){
+         attributes{
+             GlobalID
+             BranchID
+             CustomID
+             Height
+        }
+         geometry{
+             rings
+             spatialReference{
+                wkid
+            } 
+        }
+   }
+}""")
 
-        offset_nr = 0
-        do_continue = True
 
-        while do_continue:
-            nr_returns = 0
+def iter_lod1_buildings(urban_model, scenario):
+    '''
+    streams the lod1 building records of a scenario as they are fetched
+    :return: generator of dicts with attributes and geometry
+    '''
+    def build_query(offset_nr, limit):
+        return LOD1_BUILDINGS_QUERY.substitute(udb_id=scenario.event.master_id, branch_id=scenario.global_id,
+                                               limit=limit, offset_nr=offset_nr)
 
-            query = query_template.substitute(udb_id=scenario.event.master_id, branch_id=scenario.global_id,
-                                              offset_nr=offset_nr)
+    return fetch_pages(urban_model.urban_api_url, build_query, 'lod1Buildings')
 
-            if query:
-                result = run_query(urban_model.urban_api_url, query, None)  # Execute the query
 
-                if result:
-                    if result['data']:
-                        query_result = result['data']['lod1Buildings']
-                        if query_result:
-                            if len(query_result) > 0:
-                                for e in query_result:
-                                    geom_json = json.dumps(e['geometry'])
-                                    attributes = json.dumps(e['attributes'])
+def export_lod1_buildings(urban_model, scenario, output_features):
+    '''
+    writes the lod1 buildings of a scenario to output_features while the pages are fetched, only the pages
+    in flight are held in memory
+    :return: output_features, or None if no buildings were written
+    '''
+    attribute_type_info = get_attribute_type_info(urban_model, "LOD1BuildingAttributes")
 
-                                    urban_feature = UrbanFeature(geometry=geom_json,
-                                                                 attributes=attributes)
+    if not attribute_type_info:
+        arcpy.AddWarning("Can't read attributes for " + "Lod1BuildingAttributes" + ". Exiting...")
+        return None
 
-                                    lod1_buildings_list.append(urban_feature)
-                            else:
-                                do_continue = False
-                        else:
-                            do_continue = False
-                    else:
-                        do_continue = False
-                else:
-                    do_continue = False
+    records = iter_lod1_buildings(urban_model, scenario)
+    first = next(records, None)
 
-            if nr_returns < 100:  # search limit = 100
-                do_continue = False
-            else:
-                offset_nr += 100
+    if first is None:
+        arcpy.AddWarning("No LOD1 buildings found in scenario. Exiting...")
+        return None
 
-        if len(lod1_buildings_list) > 0:
-            return lod1_buildings_list, attribute_type_info
-        else:
-            return lod1_buildings_list, attribute_type_info
-    else:
-        arcpy.AddWarning("Can't read attributes for " + "Lod1BuildingAttributes" + ". Exiting...")
-        return lod1_buildings_list, attribute_type_info
+    return insert_polygon_records(itertools.chain([first], records), attribute_type_info, output_features)
 
 
-# Field Exists
 def field_exist(feature_class, field_name):
     field_list = arcpy.ListFields(feature_class, field_name)
     field_count = len(field_list)
@@ -2253,17 +2807,11 @@ def create_polygon_from_rings(feature_geometry, sr):
     return arcpy.Polygon(array, sr, has_z), geom_type
 
 
-def create_polygon_featureclass(lod1_features, attribute_type_info, output_features):
+def create_lod1_featureclass(output_features, sr, attribute_type_info, queried_fields):
     geometry_type = "POLYGON"
     has_m = "DISABLED"
     has_z = "ENABLED"
 
-    # get spatial reference
-    json_geometry = valid_json(lod1_features[0].geometry)
-    sr_dict = json_geometry.get("spatialReference")
-    wkid = sr_dict.get("wkid")
-    sr = arcpy.SpatialReference(wkid)
-
     # Execute CreateFeatureclass
     if arcpy.Exists(output_features):
         arcpy.Delete_management(output_features)
@@ -2275,9 +2823,7 @@ def create_polygon_featureclass(lod1_features, attribute_type_info, output_featu
 
     # add known attribute fields
     schema_fields = attribute_type_info.keys()
-    json_attributes = valid_json(lod1_features[0].attributes)
-    queried_fields = json_attributes.keys()
-    cursor_fields = ["SHAPE@"]
+    attribute_fields = list()
 
     for f in schema_fields:
         if f in queried_fields:
@@ -2298,239 +2844,299 @@ def create_polygon_featureclass(lod1_features, attribute_type_info, output_featu
 
             add_field(output_features, f, field_type, field_length)
 
-            cursor_fields.append(f)
+            attribute_fields.append(f)
+
+    return attribute_fields
+
+
+def insert_polygon_records(records, attribute_type_info, output_features):
+    '''
+    creates output_features from the first record and inserts all records with one cursor as they come in
+    :param records: iterable of dicts with esri json geometry and attributes
+    :return: output_features, or None if no features were created
+    '''
+    records = iter(records)
+    first = next(records, None)
+
+    if first is None:
+        arcpy.AddWarning("No features created in " + output_features + ". Exiting...")
+        return None
+
+    # get spatial reference
+    sr_dict = first['geometry'].get("spatialReference")
+    wkid = sr_dict.get("wkid")
+    sr = arcpy.SpatialReference(wkid)
+
+    attribute_fields = create_lod1_featureclass(output_features, sr, attribute_type_info,
+                                                first['attributes'].keys())
+    cursor_fields = ["SHAPE@"] + attribute_fields
+    num_features = 0
 
     # add geometries and attribute values
     with arcpy.da.InsertCursor(output_features, cursor_fields) as curs:
-        for feature in lod1_features:
-            tuple_list = []
-
+        for record in itertools.chain([first], records):
             # create polygonZ object
-            polygon, geom_type = create_polygon_from_rings(valid_json(feature.geometry), sr)
-            tuple_list.append(polygon)
-
-            json_attributes = valid_json(feature.attributes)
-            for f in queried_fields:
-                f_value = json_attributes.get(f)
-                tuple_list.append(f_value)
+            polygon, geom_type = create_polygon_from_rings(record['geometry'], sr)
 
-            curs_tuple = tuple(tuple_list)
-            curs.insertRow(curs_tuple)
+            attributes = record['attributes']
+            curs.insertRow([polygon] + [attributes.get(f) for f in attribute_fields])
+            num_features += 1
     del curs
 
-    num_features = arcpy.GetCount_management(output_features).getOutput(0)
-    if int(num_features) > 0:
+    if num_features > 0:
         return output_features
     else:
         arcpy.AddWarning("No features created in " + output_features + ". Exiting...")
         return None
 
 
-def get_attribute_list_as_string(local_attribute_dict, urban_model, branch_id, urban_type_dict):
-    attr_list_as_string = None
-    field_value_str_list = list ()
+# enum values the urban api expects capitalized, per json attribute
+URBAN_ENUM_VALUES = {
+    'EdgeInfos': {'street': 'Street', 'front': 'Front', 'side': 'Side', 'rear': 'Rear'},
+    'Skyplanes': {'street': 'Street', 'interior': 'Interior', 'side': 'Side', 'rear': 'Rear', 'front': 'Front'},
+    'Tiers': {}
+}
+
+# keys of the json attributes that hold an enum, values of other keys (category, ...) are free text
+URBAN_ENUM_KEYS = {
+    'EdgeInfos': ('type', 'orientation'),
+    'Skyplanes': ('adjacency', 'orientation'),
+    'Tiers': ()
+}
+
+
+def set_enum_values(value, enum_values, enum_keys, key=None):
+    if isinstance(value, dict):
+        return {k: set_enum_values(v, enum_values, enum_keys, k) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [set_enum_values(v, enum_values, enum_keys, key) for v in value]
+    elif isinstance(value, str) and key in enum_keys:
+        return enum_values.get(value, value)
+    else:
+        return value
 
-    urban_fields_list = list(urban_type_dict.keys())
 
-    # check against Urban schema
-    for field in local_attribute_dict:
-        if field in urban_fields_list:
-            if field not in ["GlobalID", "BranchID"]:
-                local_value = local_attribute_dict.get(field)
-                if local_value is None:
-                    pass
-                else:
-                    # check data_type in Urban
-                    urban_data_type = urban_type_dict.get(field)
-                    if urban_data_type.lower() in ['float', 'long', 'short', 'double', 'int']:
-                        try:
-                            val = int(local_attribute_dict.get(field))
-                            skip = False
-                        except ValueError:
-                            try:
-                                val = float(local_attribute_dict.get(field))
-                                skip = False
-                            except ValueError:
-                                skip = True
-
-                        if not skip:
-                            field_value_str = field + ": " + str(local_attribute_dict.get(field))
-                            field_value_str_list.append(field_value_str)
-                    elif urban_data_type.lower() == 'boolean':
-                        val = int(local_attribute_dict.get(field))
-                        if val == 0:
-                            field_value_str = field + ": false"
-                        else:
-                            field_value_str = field + ": true"
-                        field_value_str_list.append(field_value_str)
-                    elif field == "EdgeInfos":
-                        # pass
-                        # replace quotes, comma's and set EdgeInfo Enum
-                        edge_info_json = valid_json(local_attribute_dict.get(field))
-                        field_value_str = field + ": " + str(local_attribute_dict.get(field))
-                        remove_str = field_value_str.replace("\"adjacencies\"", "adjacencies")
-                        remove_str = remove_str.replace("\"orientation\"", "orientation")
-                        remove_str = remove_str.replace("\"category\"", "category")
-                        remove_str = remove_str.replace("\"type\"", "type")
-                        remove_str = remove_str.replace("\"width\"", "width")
-                        replace_str = remove_str.replace("\",", "\"\n")
-                        replace_str = replace_str.replace("\"street\"", "Street")
-                        replace_str = replace_str.replace("\"front\"", "Front")
-                        replace_str = replace_str.replace("\"side\"", "Side")
-                        replace_str = replace_str.replace("\"rear\"", "Rear")
-                        field_value_str_list.append(replace_str)
-                    elif field == "Skyplanes":
-                        # pass
-                        # replace quotes, comma's and set EdgeInfo Enum
-                        edge_info_json = valid_json(local_attribute_dict.get(field))
-                        field_value_str = field + ": " + str(local_attribute_dict.get(field))
-                        remove_str = field_value_str.replace("\"adjacency\"", "adjacency")
-                        remove_str = remove_str.replace("\"angle\"", "angle")
-                        remove_str = remove_str.replace("\"horizontalOffset\"", "horizontalOffset")
-                        remove_str = remove_str.replace("\"orientation\"", "orientation")
-                        remove_str = remove_str.replace("\"verticalOffset\"", "verticalOffset")
-                        replace_str = remove_str.replace("\",", "\"\n")
-                        replace_str = replace_str.replace("\"street\"", "Street")
-                        replace_str = replace_str.replace("\"interior\"", "Interior")
-                        replace_str = replace_str.replace("\"side\"", "Side")
-                        replace_str = replace_str.replace("\"rear\"", "Rear")
-                        replace_str = replace_str.replace("\"front\"", "Front")
-                        field_value_str_list.append(replace_str)
-                    elif field == "Tiers":
-                        # pass
-                        # replace quotes, comma's and set EdgeInfo Enum
-                        edge_info_json = valid_json(local_attribute_dict.get(field))
-                        field_value_str = field + ": " + str(local_attribute_dict.get(field))
-                        remove_str = field_value_str.replace("\"setbacks\"", "setbacks")
-                        remove_str = remove_str.replace("\"startHeight\"", "startHeight")
-                        remove_str = remove_str.replace("\"front\"", "front")
-                        remove_str = remove_str.replace("\"rear\"", "rear")
-                        remove_str = remove_str.replace("\"side\"", "side")
-                        remove_str = remove_str.replace("\"interior\"", "interior")
-                        remove_str = remove_str.replace("\"street\"", "street")
-                        remove_str = remove_str.replace("\"value\"", "value")
-                        replace_str = remove_str.replace("\",", "\"\n")
-                        field_value_str_list.append(replace_str)
-                    else:
-                        field_value_str = field + ": " + "\"" + local_attribute_dict.get(field) + "\""
-                        field_value_str_list.append(field_value_str)
+NUMERIC_URBAN_TYPES = ['float', 'long', 'short', 'double', 'int']
+INTEGER_URBAN_TYPES = ['long', 'short', 'int']
+
+
+class AttributeSerializer(object):
+    '''
+    converts a whole attribute table to urban attribute dicts, one column at a time: numbers and booleans are
+    converted to the urban data type, json attributes get their enum values set and GlobalID and BranchID are
+    left out. The field conversions are resolved once per schema.
+    '''
+    def __init__(self, urban_type_dict):
+        self.conversions = dict()
+
+        for field, urban_data_type in urban_type_dict.items():
+            if field in ["GlobalID", "BranchID"]:
+                continue
+
+            urban_data_type = urban_data_type.lower()
+            if urban_data_type in NUMERIC_URBAN_TYPES:
+                self.conversions[field] = self.to_integer if urban_data_type in INTEGER_URBAN_TYPES \
+                    else self.to_number
+            elif urban_data_type == 'boolean':
+                self.conversions[field] = self.to_boolean
+            elif field in URBAN_ENUM_VALUES:
+                self.conversions[field] = self.enum_converter(URBAN_ENUM_VALUES[field], URBAN_ENUM_KEYS[field])
+            else:
+                self.conversions[field] = None
+
+    @staticmethod
+    def to_number(column):
+        return pd.to_numeric(column, errors='coerce').tolist()
+
+    @staticmethod
+    def to_integer(column):
+        numbers = pd.to_numeric(column, errors='coerce')
+        whole = (numbers % 1 == 0).tolist()
+        return [int(v) if is_whole else v for v, is_whole in zip(numbers.tolist(), whole)]
+
+    @staticmethod
+    def to_boolean(column):
+        numbers = pd.to_numeric(column, errors='coerce')
+        return (numbers != 0).astype(object).where(numbers.notna(), None).tolist()
+
+    @staticmethod
+    def enum_converter(enum_values, enum_keys):
+        def convert(column):
+            # attribute tables repeat the same json, each distinct value is parsed once
+            converted = dict()
+
+            def convert_value(value):
+                if isinstance(value, str) and value in converted:
+                    return converted[value]
+
+                json_value = valid_json(value) if isinstance(value, str) else value
+                result = None if json_value is False else set_enum_values(json_value, enum_values, enum_keys)
+
+                if isinstance(value, str):
+                    converted[value] = result
+                return result
+
+            return column.map(convert_value, na_action='ignore').tolist()
+
+        return convert
+
+    def serialize(self, attribute_list, branch_id):
+        '''
+        :param attribute_list: list of feature attribute dicts
+        :param branch_id: BranchID to set
+        :return: list of attribute dicts
+        '''
+        table = pd.DataFrame(attribute_list, dtype=object)
+        records = [{"BranchID": branch_id} for _ in range(len(table))]
+
+        for field in table.columns:
+            if field not in self.conversions:
+                continue
+
+            convert = self.conversions[field]
+            if convert:
+                values = convert(table[field])
+            else:
+                values = table[field].tolist()
+
+            for record, value in zip(records, values):
+                if value is not None and value == value:  # skip None and NaN
+                    record[field] = value
+
+        return records
+
+
+_serializers = dict()
 
-    # add "BranchID":
-    field_value_str = "BranchID: " + "\"" + branch_id + "\""
-    field_value_str_list.append(field_value_str)
 
-    final_string = ""
-    if len(field_value_str_list) > 0:
-        for e in field_value_str_list:
-            final_string = final_string + e + "\n"
+def get_attribute_serializer(urban_type_dict):
+    key = tuple(sorted(urban_type_dict.items()))
+    serializer = _serializers.get(key)
 
-        #  attr_list_as_string = '[%s]' % ', '.join(map(str, field_value_str_list))
+    if serializer is None:
+        serializer = _serializers[key] = AttributeSerializer(urban_type_dict)
 
-    return final_string
+    return serializer
+
+
+CREATE_PARCELS_ARGUMENTS = {'urbanDatabaseId': ('udb_id', 'PortalItemId!'),
+                            'parcels': ('parcels', '[CreateParcelInput!]!')}
+
+
+def create_parcels(urban_model, udb_id, branch_id, feature_json_dict,  wkid, max_bytes=MUTATION_BYTE_BUDGET,
+                   max_workers=MUTATION_WORKERS):
+    '''
+    creates the parcels, see create_parcels_batched. Parcels of batches that were created stay created when other
+    batches fail, they are not rolled back.
+    :return: list of created GlobalIDs, list of features that could not be created
+    '''
+    global_ids, failed_features = create_parcels_batched(urban_model, udb_id, branch_id, feature_json_dict, wkid,
+                                                         max_bytes, max_workers)
 
+    if global_ids and failed_features:
+        arcpy.AddWarning("Created " + str(len(global_ids)) + " parcels, " + str(len(failed_features)) +
+                         " parcels failed. The created parcels are kept, check the urban database before "
+                         "creating the failed parcels again: a batch that failed after it reached the server "
+                         "may have been created.")
 
-def create_parcels(urban_model, udb_id, branch_id, feature_json_dict,  wkid):
-    feature_template_list = list()
+    return global_ids, failed_features
+
+
+def create_parcels_batched(urban_model, udb_id, branch_id, feature_json_dict, wkid, max_bytes=MUTATION_BYTE_BUDGET,
+                           max_workers=MUTATION_WORKERS):
+    '''
+    creates the parcels with createParcels mutations of at most max_bytes serialized features each. A batch is
+    only sent again when its request could not be sent, sending it again after it reached the server could
+    create its parcels twice.
+    :return: list of created GlobalIDs, list of features that could not be created
+    '''
+    start_time = time.time()
+    parcel_list = list()
 
     feature_list = feature_json_dict.get('features')
     urban_type_dict = get_attribute_type_info(urban_model, "ParcelAttributes")
+    spatial_reference = {'wkid': wkid}
+    encoder = json.JSONEncoder(separators=(',', ':'))
+
+    attribute_list = get_attribute_serializer(urban_type_dict).serialize([feature.get('attributes')
+                                                                          for feature in feature_list], branch_id)
 
     # step through features and get geometry and attributes
-    for feature in feature_list:
-        rings_dict = feature.get('geometry')
-        rings_list = rings_dict.get('rings')
-        rings_list_as_string = '[%s]' % ', '.join(map(str, rings_list))
-
-        attr_list_as_string = get_attribute_list_as_string(feature.get('attributes'), urban_model,
-                                                           branch_id,
-                                                           urban_type_dict)
-
-        # remove [] and replace , with \n
-#        remove_str = attr_list_as_string.replace("[", "")
-#        remove_str = remove_str.replace("]", "")
-#        replace_str = remove_str.replace(",", "\n")
-
-        feature_template = Template("""{   
-                                            attributes:
-                                            {
-                                                $attr_list
-                                            }
-                                            geometry:
-                                            {
-                                                rings: $rings_list
-                                                spatialReference:
-                                                {
-                                                    wkid:$wkid
-                                                }
-                                            }
-                                            
-                                        }""")
-
-        feature_sub = feature_template.substitute(attr_list=attr_list_as_string,
-                                                  rings_list=rings_list_as_string,
-                                                  wkid=wkid)
-        feature_template_list.append(feature_sub)
-
-    clean_feature_attribute_list = '[%s]' % ', '.join(map(str, feature_template_list))
-
-    mutation_template = Template("""mutation{
-        createParcels(urbanDatabaseId: "$udb_id",
-                            parcels:
-                                $feature_attribute_list
-                        )
-            {
-                attributes{
-                    GlobalID
-                }
-            }
-        }""")
+    for feature, attributes in zip(feature_list, attribute_list):
+        parcel = {'attributes': attributes,
+                  'geometry': {'rings': feature.get('geometry').get('rings'),
+                               'spatialReference': spatial_reference}}
+        parcel_list.append((feature, parcel, len(encoder.encode(parcel))))
+
+    mutation = build_mutation(urban_model.urban_api_url, 'createParcels', CREATE_PARCELS_ARGUMENTS,
+                              "attributes{ GlobalID }")
+
+    def build_batch(batch):
+        return mutation, {'udb_id': udb_id, 'parcels': [parcel for feature, parcel, size in batch]}
+
+    batches = list(chunks_by_size(parcel_list, max_bytes, size=lambda item: item[2]))
+
+    rejected = threading.Event()
+    results = run_mutation_batches(urban_model.urban_api_url, build_batch, batches, 'createParcels',
+                                   max_workers=max_workers, on_rejected=lambda result: rejected.set())
+
+    if rejected.is_set():
+        # the cached schema may be out of date with the api
+        arcpy.AddWarning("The urban api rejected the parcel attributes. The cached urban schema is dropped, "
+                         "run the tool again to use the current schema.")
+        invalidate_urban_schema(urban_model)
+
+    global_ids = list()
+    failed_features = list()
+    for batch, query_result in zip(batches, results):
+        if query_result is None:
+            failed_features.extend(feature for feature, parcel, size in batch)
+        else:
+            global_ids.extend(r['attributes']['GlobalID'] for r in query_result)
 
-    query = mutation_template.substitute(udb_id=udb_id,
-                                         feature_attribute_list=clean_feature_attribute_list)
+    report_throughput("createParcels", len(global_ids), len(parcel_list),
+                      sum(size for feature, parcel, size in parcel_list),
+                      len(batches), results.count(None), start_time)
 
-    if query:
-        result = run_query(urban_model.urban_api_url, query, None)  # Execute the mutation
+    return global_ids, failed_features
 
-        if result:
-            if len(result) > 0:
-                if result['data']:
-                    query_result = result['data']['createParcels']
-                    if query_result:
-                        if len(query_result) > 0:
-                            return True
-                        else:
-                            return False
-                    else:
-                        return False
-                else:
-                    return False
-            else:
-                return False
-        else:
-            return False
-    else:
-        return False
 
+def upload_parcels(urban_model, udb_id, branch_id, feature_class, urban_wkid, max_bytes=MUTATION_BYTE_BUDGET,
+                   max_workers=MUTATION_WORKERS):
+    '''
+    validates the schema, coordinate system and attribute values of feature_class and creates its features as
+    parcels in the scenario. Nothing is uploaded when the validation fails.
+    :return: list of created GlobalIDs, list of features that could not be created; None, None if not valid
+    '''
+    if not check_feature_schema_wkid_in_urban(feature_class, urban_model, "ParcelAttributes", urban_wkid):
+        return None, None
+
+    feature_json_dict = json.loads(arcpy.FeatureSet(feature_class).JSON)
+
+    return create_parcels(urban_model, udb_id, branch_id, feature_json_dict, urban_wkid, max_bytes, max_workers)
 
-def check_feature_schema_wkid_in_urban(feature_class, feature_as_dict, urban_model, attributes, urban_wkid):
-    local_field_list = list()
-    local_field_dict_list = feature_as_dict.get('fields')
-    for lfd in local_field_dict_list:
-        field_name = lfd.get('name')
-        local_field_list.append(field_name)
 
+def check_feature_schema_wkid_in_urban(feature_class, urban_model, attributes, urban_wkid):
+    '''
+    checks the schema and coordinate system of feature_class against the urban attributes type and validates
+    all attribute values with validate_urban_features. The fields and spatial reference are read with Describe.
+    '''
     urban_type_dict = get_attribute_type_info(urban_model, attributes)
     urban_fields_list = list(urban_type_dict.keys())
 
+    desc = arcpy.Describe(feature_class)
+    local_field_list = [f.name for f in desc.fields]
+    wkid = desc.spatialReference.factoryCode
+
     # check if the local layer has all the needed fields
     result = all(elem in local_field_list for elem in urban_fields_list)
 
     if result:
-        sr_dict = feature_as_dict.get('spatialReference')
-        wkid = sr_dict.get("wkid")
-
         if wkid == urban_wkid:
-            result = True
+            report = validate_urban_features(feature_class, urban_type_dict,
+                                             get_required_attribute_fields(urban_model, attributes))
+            report.report(feature_class)
+            result = report.valid
         else:
             arcpy.AddWarning("Input layer: " + feature_class + " does not have the same coordinate system as the " \
                              "scenario parcel layer in Urban. Exiting...")
@@ -2547,6 +3153,123 @@ def check_feature_schema_wkid_in_urban(feature_class, feature_as_dict, urban_mod
     return result
 
 
+# value range per integer urban type
+URBAN_INTEGER_RANGES = {
+    'short': (-32768, 32767),
+    'long': (-2 ** 31, 2 ** 31 - 1),
+    'int': (-2 ** 31, 2 ** 31 - 1)
+}
+
+
+class ValidationReport(object):
+    '''
+    number of failing features and a few of their object ids per check and field
+    '''
+    def __init__(self, sample_size=VALIDATION_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.errors = dict()
+        self.checked = 0
+
+    def add(self, check, field, object_ids):
+        if len(object_ids) == 0:
+            return
+
+        entry = self.errors.setdefault((check, field), [0, list()])
+        entry[0] += len(object_ids)
+        room = self.sample_size - len(entry[1])
+        if room > 0:
+            entry[1].extend(int(i) for i in object_ids[:room])
+
+    @property
+    def valid(self):
+        return len(self.errors) == 0
+
+    def lines(self):
+        lines = list()
+        for (check, field), (count, samples) in self.errors.items():
+            lines.append("{}: {} features with {} (OBJECTID {}{}).".format(
+                field, count, check, ", ".join(str(i) for i in samples), ", ..." if count > len(samples) else ""))
+        return lines
+
+    def report(self, feature_class):
+        if self.valid:
+            arcpy.AddMessage("Validated " + str(self.checked) + " features in " + feature_class + ".")
+        else:
+            arcpy.AddWarning("Input layer: " + feature_class + " has features that can't be uploaded to Urban:")
+            for line in self.lines():
+                arcpy.AddWarning(line)
+
+
+def iter_feature_chunks(feature_class, fields, chunk_size=VALIDATION_CHUNK_SIZE):
+    '''
+    reads fields of feature_class in DataFrames of at most chunk_size rows, cursor tokens like OID@ and
+    SHAPE@AREA keep their name as column
+    '''
+    with arcpy.da.SearchCursor(feature_class, fields) as cursor:
+        while True:
+            rows = list(islice(cursor, chunk_size))
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=fields)
+
+
+def validate_urban_features(feature_class, urban_type_dict, required_fields=None,
+                            chunk_size=VALIDATION_CHUNK_SIZE):
+    '''
+    checks all features of feature_class before an upload, one column at a time: empty geometries, missing
+    required values, values that don't convert to the urban type and integers out of range.
+    :param urban_type_dict: field name: urban data type
+    :param required_fields: urban fields that need a value
+    :return: ValidationReport
+    '''
+    report = ValidationReport()
+    local_fields = [f.name for f in arcpy.ListFields(feature_class)]
+    fields = [f for f in urban_type_dict if f in local_fields and f not in ["GlobalID", "BranchID"]]
+    required_fields = [f for f in (required_fields or list()) if f in fields]
+    json_converted = dict()
+
+    for table in iter_feature_chunks(feature_class, ["OID@", "SHAPE@AREA"] + fields, chunk_size):
+        object_ids = table["OID@"].to_numpy()
+        report.checked += len(table)
+
+        area = pd.to_numeric(table["SHAPE@AREA"], errors='coerce')
+        report.add("an empty geometry", "Shape", object_ids[(area.isna() | (area == 0)).to_numpy()])
+
+        for field in fields:
+            column = table[field]
+            has_value = column.notna().to_numpy()
+            urban_data_type = urban_type_dict[field].lower()
+
+            if field in required_fields:
+                report.add("no value", field, object_ids[~has_value])
+
+            if urban_data_type in NUMERIC_URBAN_TYPES or urban_data_type == 'boolean':
+                numbers = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float)
+                is_number = ~np.isnan(numbers)
+                report.add("a value that is not a number", field, object_ids[has_value & ~is_number])
+
+                if urban_data_type in URBAN_INTEGER_RANGES:
+                    low, high = URBAN_INTEGER_RANGES[urban_data_type]
+                    with np.errstate(invalid='ignore'):
+                        out_of_range = is_number & ((numbers < low) | (numbers > high) | (numbers % 1 != 0))
+                    report.add("a value outside the " + urban_data_type + " range", field,
+                               object_ids[out_of_range])
+                elif urban_data_type != 'boolean':
+                    report.add("a value outside the " + urban_data_type + " range", field,
+                               object_ids[is_number & ~np.isfinite(numbers)])
+
+            elif field in URBAN_ENUM_VALUES:
+                # parse each distinct json value once
+                for value in column[has_value].unique():
+                    if value not in json_converted:
+                        json_converted[value] = isinstance(value, str) and valid_json(value) is not False
+
+                is_valid_json = column.map(json_converted, na_action='ignore').fillna(True).to_numpy(dtype=bool)
+                report.add("a value that is not valid json", field, object_ids[~is_valid_json])
+
+    return report
+
+
 def get_full_path_from_layer(in_layer):
     dir_name = os.path.dirname(arcpy.Describe(in_layer).catalogPath)
     layer_name = arcpy.Describe(in_layer).name
@@ -0,0 +1,171 @@
+# Local stand-in for the urban GraphQL api, used to exercise and benchmark the uc_common_lib queries
+# without a portal. Start it with MockUrbanService(records, ...) and use .url as the urban api url.
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_lod1_buildings(count, branch_id="branch"):
+    '''
+        creates count lod1 building records with a square footprint each
+    '''
+    records = list()
+    for i in range(count):
+        x, y = float(i % 1000) * 10, float(i // 1000) * 10
+        ring = [[x, y], [x, y + 5], [x + 5, y + 5], [x + 5, y], [x, y]]
+        records.append({"attributes": {"GlobalID": "{%08d-0000-0000-0000-000000000000}" % i,
+                                       "BranchID": branch_id, "CustomID": str(i), "Height": float(i % 30)},
+                        "geometry": {"rings": [ring], "spatialReference": {"wkid": 3857}}})
+    return records
+
+
+def make_parcels(count):
+    '''
+        creates count parcel records with only a GlobalID and spatial reference
+    '''
+    return [{"attributes": {"GlobalID": "{%08d-1111-0000-0000-000000000000}" % i},
+             "geometry": {"spatialReference": {"wkid": 3857}}} for i in range(count)]
+
+
+class MockUrbanService(object):
+    '''
+        serves list queries on <url>: each top level field of the query selects a record list, limit and offset
+        page through it. Mutations echo the GlobalIDs they received, create mutations return new GlobalIDs.
+        The first mutation_failures mutations return an error, to exercise retries.
+        usage:
+            with MockUrbanService({'lod1Buildings': make_lod1_buildings(1000)}) as service:
+                buildings = uc_common_lib.fetch_pages(service.url, build_query, 'lod1Buildings')
+    '''
+
+    def __init__(self, records=None, max_limit=100, delay=0, mutation_failures=0):
+        self.records = records or dict()
+        self.max_limit = max_limit
+        self.delay = delay
+        self.mutation_failures = mutation_failures
+        self.created = 0
+        self.requests = list()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/api/graphql".format(host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                payload = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+                with service._lock:
+                    service.requests.append(payload)
+                if service.delay:
+                    threading.Event().wait(service.delay)
+                body = json.dumps(service.handle(payload)).encode('utf-8')
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client timed out and closed the connection
+                    pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def handle(self, payload):
+        query = payload.get('query') or ''
+        variables = payload.get('variables') or dict()
+        match = re.search(r'^\s*(query|mutation)?\s*(?:\([^)]*\))?\s*\{', query)
+        if not match:
+            return {"errors": [{"message": "Unsupported query"}]}
+
+        operation = match.group(1) or 'query'
+        data = dict()
+
+        # top level fields, optionally aliased: [alias:] field[(arguments)] {
+        for alias, field, arguments in self.top_level_fields(query, match.end()):
+            arguments = re.sub(r'\$(\w+)', lambda m: json.dumps(variables.get(m.group(1))), arguments or '')
+            if operation == 'mutation':
+                result = self.mutation(field, arguments)
+            else:
+                result = self.query(field, arguments)
+            if result is None:
+                # an error raised while running the field, like a failed non-null mutation
+                return {"errors": [{"message": "Mock failure", "path": [alias or field]}], "data": None}
+            data[alias or field] = result
+
+        return {"data": data}
+
+    @staticmethod
+    def top_level_fields(query, start):
+        depth = 0
+        fields = list()
+        for m in re.finditer(r'(?:(\w+)\s*:\s*)?(\w+)\s*(?:\(([^)]*)\))?\s*\{|[{}]', query[start:]):
+            if m.group(0) == '{':
+                depth += 1
+            elif m.group(0) == '}':
+                depth -= 1
+            else:
+                if depth == 0:
+                    fields.append((m.group(1), m.group(2), m.group(3)))
+                depth += 1
+        return fields
+
+    def query(self, field, arguments):
+        limit = re.search(r'limit:\s*(\d+)', arguments)
+        offset = re.search(r'offset:\s*(\d+)', arguments)
+        limit = min(int(limit.group(1)), self.max_limit) if limit else self.max_limit
+        offset = int(offset.group(1)) if offset else 0
+        records = self.records.get(field, list())
+        if not isinstance(records, list):
+            # a single object, like the __schema of an introspection query
+            return records
+        return records[offset:offset + limit]
+
+    def mutation(self, field, arguments):
+        '''
+            echoes the GlobalID values in the mutation, create mutations get a new GlobalID per attributes block
+        '''
+        with self._lock:
+            if self.mutation_failures > 0:
+                self.mutation_failures -= 1
+                return None
+
+            if field == 'updateUrbanModelConfig':
+                config = re.search(r'urbanModelConfig:\s*(\{.*\})', arguments, re.DOTALL)
+                return json.loads(config.group(1)) if config else dict()
+
+            if field.startswith('create'):
+                count = len(re.findall(r'"?attributes"?\s*:', arguments))
+                ids = ["{%08d-2222-0000-0000-000000000000}" % (self.created + i) for i in range(count)]
+                self.created += count
+            else:
+                ids = re.findall(r'"?GlobalID"?:\s*"([^"]*)"', arguments)
+                ids += [i for ids_list in re.findall(r'globalIDs:\s*(\[[^\]]*\])', arguments)
+                        for i in json.loads(ids_list)]
+
+        return [{"attributes": {"GlobalID": global_id}} for global_id in ids]
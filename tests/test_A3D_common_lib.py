@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("arcpy")
+pytest.importorskip("arcgis")
+
+from scripts import A3D_common_lib
+from scripts.A3D_mock_service import MockFeatureService, make_point_features, make_polygon_features
+
+
+def test_download_features_paged_reads_every_page():
+    with MockFeatureService(make_point_features(250), max_record_count=100) as service:
+        table = A3D_common_lib.download_features_paged(service.url, token=None)
+
+    assert len(table) == 250
+    assert table.attributes['OBJECTID'].tolist() == list(range(1, 251))
+    assert table.object_id_field_name == 'OBJECTID'
+
+
+def test_post_json_does_not_retry_client_errors():
+    with MockFeatureService(make_point_features(1)) as service:
+        with pytest.raises(A3D_common_lib.ServiceError):
+            A3D_common_lib.post_json(service.url + '/unknown', {'f': 'json'})
+
+        assert len(service.requests) == 1
+
+
+def test_feature_table_keeps_nullable_integers_and_m():
+    fs_dict = {
+        'geometryType': 'esriGeometryPolyline',
+        'hasZ': False,
+        'hasM': True,
+        'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+                   {'name': 'floors', 'type': 'esriFieldTypeInteger'}],
+        'features': [{'attributes': {'OBJECTID': 1, 'floors': 5}, 'geometry': {'paths': [[[0, 0, 1], [1, 1, 2]]]}},
+                     {'attributes': {'OBJECTID': 2, 'floors': None}, 'geometry': {'paths': [[[2, 2, 3], [3, 3, 4]]]}}]
+    }
+    table = A3D_common_lib.FeatureTable.from_featureset_dict(fs_dict)
+    features = list(table.features())
+
+    assert features[0]['attributes'] == {'OBJECTID': 1, 'floors': 5}
+    assert features[1]['attributes'] == {'OBJECTID': 2, 'floors': None}
+    assert features[0]['geometry']['paths'] == [[[0, 0, 1], [1, 1, 2]]]
+    assert features[0]['geometry']['hasM'] is True
+
+    table.add_z([10, 20])
+    assert table.geometry(1)['paths'] == [[[2, 2, 20, 3], [3, 3, 20, 4]]]
+
+
+def test_polygons_add_z_sets_base_elevation():
+    with MockFeatureService(make_polygon_features(3), geometry_type='esriGeometryPolygon') as service:
+        spatial_info = A3D_common_lib.get_spatial_info_from_service_url(service.url, token='token')
+
+    assert A3D_common_lib.polygons_add_z(spatial_info, 'height', 'Meters', converted=True)
+    assert spatial_info.table.coords[:, 2].tolist() == [1.0] * 5 + [2.0] * 5 + [3.0] * 5
+
+
+def test_apply_edits_adds_reports_committed_batches_without_resending():
+    features = make_point_features(6)
+    for feature in features:
+        del feature['attributes']['OBJECTID']
+    features[4]['geometry'] = None
+    batch_bytes = len(A3D_common_lib.batch_features_by_size(features[:2])[0][2]) + 1
+
+    with MockFeatureService(list()) as service:
+        added, errors = A3D_common_lib.apply_edits_adds(service.url, 'token', features, rollback_on_failure=True,
+                                                        max_bytes=batch_bytes, max_workers=1)
+        posts = [path for path, params in service.requests if path.endswith('/applyEdits')]
+
+    # the last batch is rolled back, the batches before it stay committed and nothing is sent twice
+    assert added == 4
+    assert [index for index, error in errors] == [4, 5]
+    assert len(posts) == 3
+
+
+def test_run_job_steps_waits_for_all_jobs_together(monkeypatch):
+    calls = list()
+    wait_for_jobs = A3D_common_lib.wait_for_jobs
+
+    def record_wait(jobs, **kwargs):
+        calls.append([job.job_id for job in jobs])
+        return wait_for_jobs(jobs, **kwargs)
+
+    monkeypatch.setattr(A3D_common_lib, 'wait_for_jobs', record_wait)
+
+    def steps(token, url, job_ids):
+        statuses = list()
+        for job_id in job_ids:
+            status = yield A3D_common_lib.server_job_status_job(token, url, job_id)
+            statuses.append(status)
+        return statuses
+
+    with MockFeatureService(list(), job_polls=1) as service:
+        results = A3D_common_lib.run_job_steps([steps('token', service.url, ['a', 'b']),
+                                                steps('token', service.url, ['fail']),
+                                                steps('token', service.url, [])])
+
+    assert results == [['completed', 'completed'], ['failed'], []]
+    assert calls == [['a', 'fail'], ['b']]
+
+
+def test_wait_for_job_keeps_polling_after_fetch_errors():
+    class FlakyJob(A3D_common_lib.StatusJob):
+        def __init__(self, failures):
+            super().__init__('flaky', None, None)
+            self.failures = failures
+
+        def fetch(self):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError()
+            self.status = 'completed'
+            return self.status
+
+    def wait(job):
+        return A3D_common_lib.run_async(A3D_common_lib.wait_for_job(job, progress=None, is_cancelled=None,
+                                                                     initial_delay=0.01, max_delay=0.01))
+
+    assert wait(FlakyJob(A3D_common_lib.POLL_MAX_FETCH_ERRORS - 1)) == 'completed'
+    assert wait(FlakyJob(A3D_common_lib.POLL_MAX_FETCH_ERRORS)) == 'failed'
+
+
+def test_metadata_cache_keys_include_the_token():
+    params = {'f': 'json', 'token': 'user-a'}
+
+    assert A3D_common_lib.MetadataCache.request_key('url', params) == \
+        A3D_common_lib.MetadataCache.request_key('url', dict(params))
+    assert A3D_common_lib.MetadataCache.request_key('url', params) != \
+        A3D_common_lib.MetadataCache.request_key('url', dict(params, token='user-b'))
+    assert 'user-a' not in str(A3D_common_lib.MetadataCache.request_key('url', params))
+
+
+def test_metadata_cache_releases_pending_fetch_on_interrupt():
+    cache = A3D_common_lib.MetadataCache()
+
+    def interrupted():
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        cache.get('key', interrupted)
+
+    assert cache.get('key', lambda: 'value') == 'value'
+
+
+def test_elevation_cache_quantizes_in_meters(tmp_path):
+    # cell centers, so a few millimeters do not cross a cell boundary
+    quantum, angular = A3D_common_lib.elevation_cache_quantum(4326)
+    assert angular
+    lat = round(60.0 / quantum) * quantum
+    lon = round(10.0 * np.cos(np.radians(lat)) / quantum) * quantum / np.cos(np.radians(lat))
+
+    cache = A3D_common_lib.ElevationCache(str(tmp_path / 'elevation.sqlite'))
+    try:
+        cache.put('url', 4326, np.array([[lon, lat]]), np.array([5.0]))
+        cache.put('url', 3857, np.array([[1000.0, 2000.0]]), np.array([7.0]))
+
+        # about 3 mm and 50 cm away, a degree of longitude being about 56 km at 60 degrees north
+        z = cache.get('url', 4326, np.array([[lon + 5e-8, lat], [lon + 9e-6, lat]]))
+        assert z[0] == 5.0 and np.isnan(z[1])
+
+        z = cache.get('url', 3857, np.array([[1000.003, 2000.0], [1000.5, 2000.0]]))
+        assert z[0] == 7.0 and np.isnan(z[1])
+
+        assert np.isnan(cache.get('url', 3857, np.array([[lon, lat]]))).all()
+    finally:
+        cache.close()
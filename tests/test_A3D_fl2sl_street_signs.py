@@ -0,0 +1,18 @@
+import pytest
+
+pytest.importorskip("arcpy")
+pytest.importorskip("arcgis")
+
+from scripts import A3D_common_lib, A3D_fl2sl_street_signs
+
+
+def test_initial_shape_buffers_do_not_take_m_for_z():
+    square = [[0, 0, 7], [0, 1, 7], [1, 1, 7], [1, 0, 7], [0, 0, 7]]
+    table = A3D_common_lib.FeatureTable.from_featureset_dict({
+        'geometryType': 'esriGeometryPolygon', 'hasM': True,
+        'features': [{'attributes': {}, 'geometry': {'rings': [square]}}]})
+
+    vert_coord_list = A3D_fl2sl_street_signs.get_initial_shape_buffers(table, [2.0], 10)[0][0]
+
+    # x, z, -y per vertex, z from z_list scaled by the unit factor
+    assert vert_coord_list[1::3] == [20.0] * 4
@@ -0,0 +1,36 @@
+import pytest
+
+arcpy = pytest.importorskip("arcpy")
+
+from scripts_ddd._common import DensifyCache
+
+SR = {'wkid': 3857}
+# clockwise outer ring with an arc and a counterclockwise hole
+CURVED_POLYGON = {'curveRings': [[[0, 0], [0, 10], {'c': [[10, 10], [5, 15]]}, [10, 0], [0, 0]],
+                                 [[2, 2], [8, 2], [8, 8], [2, 8], [2, 2]]],
+                  'spatialReference': SR}
+CURVED_LINE_M = {'hasM': True, 'curvePaths': [[[0, 0, 1], {'c': [[10, 0, 2], [5, 5]]}]], 'spatialReference': SR}
+
+
+@pytest.mark.parametrize('geometry', [CURVED_POLYGON, CURVED_LINE_M])
+def test_densify_cache_round_trip_keeps_rings_and_m(tmp_path, geometry):
+    path = str(tmp_path / 'densify.npz')
+    shape = arcpy.AsShape(geometry, True)
+
+    with DensifyCache(path) as cache:
+        missed = cache.densify(1, shape)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    with DensifyCache(path) as cache:
+        hit = cache.densify(1, shape)
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    assert 'curve' not in hit.JSON
+    assert hit.JSON == missed.JSON
+    assert hit.hasM == shape.hasM
+    if shape.type == 'polygon':
+        # the hole is kept, not merged into the outer ring
+        assert hit.area == pytest.approx(shape.area, rel=0.01)
+        assert hit.boundary().partCount == 2
+    else:
+        assert (hit.firstPoint.M, hit.lastPoint.M) == (1, 2)
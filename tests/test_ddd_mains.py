@@ -0,0 +1,35 @@
+import pytest
+
+arcpy = pytest.importorskip("arcpy")
+
+from scripts_ddd._common import df_chunks_to_table, read_table_chunks
+from scripts_ddd.mains import CreateZFeatures
+
+CURVED_LINE = {'curvePaths': [[[0, 0], {'c': [[10, 0], [5, 5]]}]], 'spatialReference': {'wkid': 3857}}
+STRAIGHT_LINE = {'paths': [[[0, 10], [10, 10]]], 'spatialReference': {'wkid': 3857}}
+
+
+def make_lines(name, geometries):
+    workspace = arcpy.env.scratchGDB
+    fc = arcpy.CreateFeatureclass_management(workspace, name, 'POLYLINE',
+                                             spatial_reference=arcpy.SpatialReference(3857))[0]
+    with arcpy.da.InsertCursor(fc, ['SHAPE@']) as cursor:
+        for geometry in geometries:
+            cursor.insertRow([arcpy.AsShape(geometry, True)])
+    return fc
+
+
+def test_curved_mains_survive_the_write_without_densifying():
+    source = make_lines('mains_source', [STRAIGHT_LINE, CURVED_LINE])
+    target = make_lines('mains_target', [])
+    mains = CreateZFeatures(source, densify_curves=False)
+
+    chunks = [mains._convert_chunk(chunk, None)
+              for chunk in read_table_chunks(source, ['OID@', 'SHAPE@', 'SHAPE@JSON'], chunk_size=1)]
+    assert isinstance(chunks[0]['SHAPE@'].iloc[0], (bytes, bytearray))
+    assert df_chunks_to_table(chunks, target, ['SHAPE@']) == 2
+
+    with arcpy.da.SearchCursor(target, ['SHAPE@JSON']) as cursor:
+        written = [row[0] for row in cursor]
+    assert 'curvePaths' not in written[0]
+    assert 'curvePaths' in written[1]
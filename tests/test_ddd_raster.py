@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("arcpy")
+pytest.importorskip("scipy")
+
+from scripts_ddd.raster import RasterTrenching
+
+
+def test_depth_profile_steps_down_to_the_asset():
+    # width 3 at 1 map unit per cell gives 2 steps of depth 4 / 2
+    mask = np.zeros((1, 7), dtype=bool)
+    mask[0, 3] = True
+
+    profile = RasterTrenching(pixel_size=1).depth_profile(mask, depth=4, width=3)
+
+    np.testing.assert_array_equal(profile, [[np.nan, 2, 4, 4, 4, 2, np.nan]])
@@ -0,0 +1,271 @@
+import pytest
+
+pytest.importorskip("arcpy")
+pytest.importorskip("arcgis")
+
+import requests
+from types import SimpleNamespace
+
+from scripts_uc import uc_common_lib
+from scripts_uc.uc_mock_service import MockUrbanService, make_lod1_buildings, make_parcels
+
+
+def build_lod1_query(offset_nr, limit):
+    return "query { lod1Buildings(paging: {limit: %d, offset: %d}) { attributes { GlobalID } } }" % (limit, offset_nr)
+
+
+def test_fetch_pages_reads_every_page_in_order():
+    with MockUrbanService({'lod1Buildings': make_lod1_buildings(350)}) as service:
+        records = list(uc_common_lib.fetch_pages(service.url, build_lod1_query, 'lod1Buildings', page_size=100))
+
+    ids = [record['attributes']['GlobalID'] for record in records]
+    assert ids == [record['attributes']['GlobalID'] for record in make_lod1_buildings(350)]
+
+
+def test_fetch_pages_raises_when_a_page_fails(monkeypatch):
+    # the query is the offset, the page at 100 fails and must not be taken for the last page
+    pages = {0: {'data': {'lod1Buildings': [{'attributes': {'GlobalID': str(i)}} for i in range(100)]}}}
+    monkeypatch.setattr(uc_common_lib, 'run_query', lambda url, query, variables: pages.get(query))
+
+    with pytest.raises(uc_common_lib.QueryFailed):
+        list(uc_common_lib.fetch_pages('url', lambda offset_nr, limit: offset_nr, 'lod1Buildings', page_size=100))
+
+
+def test_run_mutation_batches_returns_records_per_batch():
+    def build_mutation(batch):
+        return ("mutation($parcels: [CreateParcelInput!]!){ createParcels(parcels: $parcels){ attributes{GlobalID} } }",
+                {'parcels': batch})
+
+    parcels = [{'attributes': {'CustomID': str(i)}} for i in range(5)]
+    batches = [parcels[i:i + 2] for i in range(0, len(parcels), 2)]
+
+    with MockUrbanService() as service:
+        results = uc_common_lib.run_mutation_batches(service.url, build_mutation, batches, 'createParcels')
+
+    assert [len(records) for records in results] == [2, 2, 1]
+    assert len({record['attributes']['GlobalID'] for records in results for record in records}) == 5
+
+
+def test_run_mutation_batches_resends_only_idempotent_mutations():
+    def build_mutation(field):
+        def build(batch):
+            return ("mutation($parcels: [ParcelInput!]!){ %s(parcels: $parcels){ attributes{GlobalID} } }" % field,
+                    {'parcels': batch})
+        return build
+
+    batches = [[{'attributes': {'GlobalID': '{a}'}}], [{'attributes': {'GlobalID': '{b}'}}]]
+
+    with MockUrbanService(mutation_failures=1) as service:
+        created = uc_common_lib.run_mutation_batches(service.url, build_mutation('createParcels'), batches,
+                                                     'createParcels', max_workers=1)
+        nr_create_requests = len(service.requests)
+
+    with MockUrbanService(mutation_failures=1) as service:
+        updated = uc_common_lib.run_mutation_batches(service.url, build_mutation('updateParcels'), batches,
+                                                     'updateParcels', max_workers=1, idempotent=True)
+
+    # the failed create is reported, not sent again
+    assert created[0] is None and len(created[1]) == 1
+    assert nr_create_requests == 2
+    assert [records[0]['attributes']['GlobalID'] for records in updated] == ['{a}', '{b}']
+
+
+def test_operation_batch_sends_aliased_mutations_in_one_document():
+    parcels = make_parcels(3)
+
+    with MockUrbanService() as service:
+        batch = uc_common_lib.OperationBatch(service.url, 'mutation')
+        indexes = [batch.add('updateParcels', {'parcels': ('[UpdateParcelInput!]!', [parcel])}, 'attributes{GlobalID}')
+                   for parcel in parcels]
+        results = batch.run()
+        nr_requests = len([r for r in service.requests if r['query'].startswith('mutation')])
+
+    assert nr_requests == 1
+    assert [results[i][0]['attributes']['GlobalID'] for i in indexes] == \
+        [parcel['attributes']['GlobalID'] for parcel in parcels]
+
+
+def test_operation_batch_does_not_resend_mutations_that_ran():
+    parcels = make_parcels(3)
+
+    with MockUrbanService(mutation_failures=1) as service:
+        batch = uc_common_lib.OperationBatch(service.url, 'mutation')
+        for parcel in parcels:
+            batch.add('updateParcels', {'parcels': ('[UpdateParcelInput!]!', [parcel])}, 'attributes{GlobalID}')
+        results = batch.run()
+        nr_requests = len([r for r in service.requests if r['query'].startswith('mutation')])
+
+    assert results == [None, None, None]
+    assert nr_requests == 1
+
+
+def test_run_query_does_not_resend_a_mutation_after_a_timeout():
+    with MockUrbanService(delay=0.5) as service:
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            uc_common_lib.run_query(service.url, "mutation{ deleteParcels(globalIDs: []){ attributes{GlobalID} } }",
+                                    None, timeout=(5, 0.1))
+
+        assert len(service.requests) == 1
+
+
+def test_build_mutation_declares_the_argument_types_of_the_schema():
+    def named(kind, name=None, of_type=None):
+        return {'kind': kind, 'name': name, 'ofType': of_type}
+
+    parcel = named('NON_NULL', None, named('INPUT_OBJECT', 'NewParcel'))
+    parcel_list = named('NON_NULL', None, named('LIST', None, parcel))
+    schema = {'queryType': {'fields': []},
+              'mutationType': {'fields': [{'name': 'createParcels',
+                                           'args': [{'name': 'urbanDatabaseId', 'type': named('SCALAR', 'ID')},
+                                                    {'name': 'parcels', 'type': parcel_list}]}]}}
+
+    with MockUrbanService({'__schema': schema}) as service:
+        mutation = uc_common_lib.build_mutation(service.url, 'createParcels', uc_common_lib.CREATE_PARCELS_ARGUMENTS,
+                                                "attributes{ GlobalID }")
+
+    assert "$udb_id: ID, $parcels: [NewParcel!]!" in mutation
+    assert "createParcels(urbanDatabaseId: $udb_id, parcels: $parcels)" in mutation
+
+
+def test_set_enum_values_only_converts_enum_keys():
+    edge_info = [{'adjacencies': [{'category': 'street', 'type': 'street', 'width': 0}], 'orientation': 'front'}]
+
+    assert uc_common_lib.set_enum_values(edge_info, uc_common_lib.URBAN_ENUM_VALUES['EdgeInfos'],
+                                         uc_common_lib.URBAN_ENUM_KEYS['EdgeInfos']) == \
+        [{'adjacencies': [{'category': 'street', 'type': 'Street', 'width': 0}], 'orientation': 'Front'}]
+
+
+def test_urban_catalog_indexes_lists_once_until_invalidated():
+    catalog = uc_common_lib.UrbanCatalog(max_lists=2)
+    scenarios = [uc_common_lib.Scenario(None, None, str(i), 'scenario ' + str(i), None, None) for i in range(3)]
+    index = catalog.scenarios(scenarios)
+
+    assert index['title']['scenario 1'] is scenarios[1]
+    assert catalog.scenarios(scenarios) is index
+
+    scenarios.append(uc_common_lib.Scenario(None, None, '3', 'scenario 3', None, None))
+    assert catalog.scenarios(scenarios)['title']['scenario 3'] is scenarios[3]
+
+    scenarios[1] = uc_common_lib.Scenario(None, None, 'new', 'scenario 1', None, None)
+    catalog.invalidate(scenarios)
+    assert catalog.scenarios(scenarios)['title']['scenario 1'] is scenarios[1]
+
+    for i in range(3):
+        catalog.scenarios(list(scenarios))
+    assert len(catalog._indexes) == 2
+
+
+def test_run_mutation_batches_reports_rejected_batches(monkeypatch):
+    rejected = {'errors': [{'message': 'Unknown type "CreateParcelInput"'}], 'data': None}
+    monkeypatch.setattr(uc_common_lib, 'run_query', lambda url, mutation, variables: rejected)
+    reported = list()
+
+    results = uc_common_lib.run_mutation_batches('url', lambda batch: ('mutation', None), [[1], [2]], 'createParcels',
+                                                 on_rejected=reported.append)
+
+    assert results == [None, None]
+    assert reported == [rejected, rejected]
+
+
+class FakeContent(object):
+    def __init__(self, items, outside_items):
+        self.items = items
+        self.outside_items = outside_items
+        self.searches = list()
+
+    def search(self, query, outside_org=False, max_items=10):
+        self.searches.append((query, outside_org))
+        return list(self.outside_items if outside_org else self.items)
+
+
+class FakeGIS(object):
+    def __init__(self, items, outside_items=()):
+        self.url = 'https://fake/' + str(id(self))
+        self.content = FakeContent(items, outside_items)
+
+
+def test_search_item_by_url_searches_outside_the_organization_only_without_a_match():
+    url = 'https://server/rest/services/parcels/FeatureServer/0'
+    item = SimpleNamespace(url=url, title='parcels')
+
+    gis = FakeGIS([item])
+    assert uc_common_lib.search_item_by_url(gis, 'Feature Layer', 'parcels', url) is item
+    assert not any(outside_org for query, outside_org in gis.content.searches)
+
+    gis = FakeGIS([], [item])
+    assert uc_common_lib.search_item_by_url(gis, 'Feature Layer', 'parcels', url) is item
+    assert [outside_org for query, outside_org in gis.content.searches].count(True) == 2
+
+    # existence checks don't use kept results
+    gis.content.outside_items = []
+    assert uc_common_lib.search_item_by_url(gis, 'Feature Layer', 'parcels', url) is None
+
+
+def test_portal_search_keys_results_on_the_sign_in():
+    item = SimpleNamespace(url='https://server/item', title='item')
+    signed_in = FakeGIS([item])
+    signed_in._con = SimpleNamespace(token='a')
+    other_user = FakeGIS([])
+    other_user.url, other_user._con = signed_in.url, SimpleNamespace(token='b')
+
+    assert uc_common_lib.portal_search.search(signed_in, query='title: item') == [item]
+    assert uc_common_lib.portal_search.search(other_user, query='title: item') == []
+    assert uc_common_lib.portal_search.search(signed_in, query='title: item') == [item]
+    assert len(signed_in.content.searches) == 1
+
+
+def test_update_parcels_edgeinfo_trusts_the_snapshot_unless_verified(monkeypatch, tmp_path):
+    monkeypatch.setattr(uc_common_lib.arcpy.env, 'scratchFolder', str(tmp_path), raising=False)
+    edge_info = [{'adjacencies': [{'category': 'road', 'type': 'Street', 'width': 5}], 'orientation': 'Front'}]
+    parcels = {'{a}': edge_info, '{b}': edge_info}
+
+    def mutation_ids(service):
+        return [parcel['attributes']['GlobalID'] for r in service.requests if r['query'].startswith('mutation')
+                for parcel in r['variables']['parcels']]
+
+    def parcel_reads(service):
+        return [r for r in service.requests if 'parcels(' in r['query'] and not r['query'].startswith('mutation')]
+
+    server_parcels = [{'attributes': {'GlobalID': '{a}', 'EdgeInfos': edge_info}},
+                      {'attributes': {'GlobalID': '{b}', 'EdgeInfos': []}}]
+
+    with MockUrbanService({'parcels': server_parcels}) as service:
+        url = service.url
+        assert uc_common_lib.update_parcels_edgeinfo(service.url, 'udb', parcels, branch_id='branch')
+        assert sorted(mutation_ids(service)) == ['{a}', '{b}']
+
+        # the snapshot has both parcels, nothing is pushed or read
+        del service.requests[:]
+        assert uc_common_lib.update_parcels_edgeinfo(service.url, 'udb', parcels, branch_id='branch')
+        assert mutation_ids(service) == [] and parcel_reads(service) == []
+
+        # with verify, only the one whose edge info differs on the server is pushed again
+        assert uc_common_lib.update_parcels_edgeinfo(service.url, 'udb', parcels, branch_id='branch', verify=True)
+        assert mutation_ids(service) == ['{b}']
+
+    # removing parcels does not add a branch
+    uc_common_lib.EdgeInfoSnapshot(url, 'udb').remove(['{a}'])
+    branches = uc_common_lib.EdgeInfoSnapshot(url, 'udb').read()
+    assert list(branches) == ['branch'] and list(branches['branch']) == ['{b}']
+
+
+def test_validate_urban_features_reports_each_check(monkeypatch):
+    import pandas as pd
+
+    urban_types = {'Name': 'string', 'Floors': 'short', 'Units': 'long', 'EdgeInfos': 'string'}
+    table = pd.DataFrame({'OID@': [1, 2, 3, 4], 'SHAPE@AREA': [10.0, 10.0, 10.0, 10.0],
+                          'Name': ['a', None, 'c', 'd'],
+                          'Floors': [3, 40000, None, -40000],
+                          'Units': [1.0, 2.5, 3.0, None],
+                          'EdgeInfos': ['[]', '[{"type": "Street"}]', '[{', None]})
+    monkeypatch.setattr(uc_common_lib.arcpy, 'ListFields',
+                        lambda feature_class: [SimpleNamespace(name=name) for name in urban_types], raising=False)
+    monkeypatch.setattr(uc_common_lib, 'iter_feature_chunks', lambda feature_class, fields, chunk_size: [table])
+
+    report = uc_common_lib.validate_urban_features('parcels', urban_types, required_fields=['Name'])
+
+    assert report.checked == 4
+    assert report.errors == {('no value', 'Name'): [1, [2]],
+                             ('a value outside the short range', 'Floors'): [2, [2, 4]],
+                             ('a value outside the long range', 'Units'): [1, [2]],
+                             ('a value that is not valid json', 'EdgeInfos'): [1, [3]]}